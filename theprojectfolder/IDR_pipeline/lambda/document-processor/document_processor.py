@@ -2,80 +2,1352 @@ import json
 import boto3
 import os
 import io
+import re
+import time
+import random
+import gzip
+import hashlib
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+
+try:
+    import resource  # Unix only — peak RSS is reported as 0 elsewhere
+except ImportError:
+    resource = None
 
 # PyPDF2 is available via Lambda layer
 import PyPDF2
 
-s3_client = boto3.client('s3')
-textract_client = boto3.client('textract')
-comprehend_client = boto3.client('comprehend')
-
 PROCESSED_BUCKET = os.environ.get('PROCESSED_BUCKET', '')
 
+# Upper bound on records processed concurrently per invocation
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8'))
+
+# Textract settings — synchronous AnalyzeDocument only handles single pages
+TEXTRACT_FEATURES = ['TABLES', 'FORMS']
+SYNC_PAGE_LIMIT = 1
+TEXTRACT_ASYNC_TIMEOUT = int(os.environ.get('TEXTRACT_ASYNC_TIMEOUT', '600'))
+TEXTRACT_POLL_INITIAL_DELAY = 1
+TEXTRACT_POLL_MAX_DELAY = 15
+
+# Born-digital PDFs already carry a text layer. Opt-in: pages whose PyPDF2
+# text passes the density/glyph checks skip Textract — FORMS/TABLES are
+# Textract only, so those pages carry no key/value pairs or tables. Leave
+# off for invoices and forms
+LOCAL_TEXT_EXTRACTION = os.environ.get('LOCAL_TEXT_EXTRACTION', 'false').lower() == 'true'
+LOCAL_TEXT_MIN_CHARS = int(os.environ.get('LOCAL_TEXT_MIN_CHARS', '40'))
+LOCAL_TEXT_MAX_UNMAPPED = float(os.environ.get('LOCAL_TEXT_MAX_UNMAPPED', '0.02'))
+LOCAL_TEXT_MIN_ALNUM = float(os.environ.get('LOCAL_TEXT_MIN_ALNUM', '0.5'))
+UNMAPPED_GLYPH = re.compile(r'\(cid:\d+\)|[\ufffd\ue000-\uf8ff]')
+
+# Large PDFs are split into page-range shards that Textract analyzes side
+# by side instead of as one long job (SHARD_THRESHOLD_PAGES=0 disables)
+SHARD_THRESHOLD_PAGES = int(os.environ.get('SHARD_THRESHOLD_PAGES', '100'))
+SHARD_PAGES = int(os.environ.get('SHARD_PAGES', '25'))
+SHARD_CONCURRENCY = int(os.environ.get('SHARD_CONCURRENCY', '4'))
+
+# PDF preprocessing — clean PDFs skip the PyPDF2 rewrite unless forced
+ALWAYS_NORMALIZE = os.environ.get('ALWAYS_NORMALIZE', 'false').lower() == 'true'
+SUPPORTED_PDF_VERSIONS = {b'1.0', b'1.1', b'1.2', b'1.3', b'1.4', b'1.5', b'1.6', b'1.7', b'2.0'}
+
+# PDFs are read through ranged GETs: block size, blocks fetched ahead per
+# request, and the most cached block data kept per document
+PDF_STREAM_BLOCK_SIZE = int(os.environ.get('PDF_STREAM_BLOCK_KB', '64')) * 1024
+PDF_STREAM_READAHEAD = int(os.environ.get('PDF_STREAM_READAHEAD', '1'))
+PDF_STREAM_MEMORY_BUDGET = int(os.environ.get('PDF_STREAM_MEMORY_MB', '32')) * 1024 * 1024
+
+# Resource governor — checked before any parsing. Textract's async API
+# rejects PDFs over 500 MB or 3,000 pages
+DOCUMENT_MAX_BYTES = int(os.environ.get('DOCUMENT_MAX_MB', '500')) * 1024 * 1024
+DOCUMENT_MAX_PAGES = int(os.environ.get('DOCUMENT_MAX_PAGES', '3000'))
+DOCUMENT_TIME_BUDGET = int(os.environ.get('DOCUMENT_TIME_BUDGET', '600'))
+# Memory one document may use — DOCUMENT_MEMORY_MB if set, otherwise half
+# of what the function's memory leaves after the result cache, split across
+# the records the invocation actually processes side by side (usually one,
+# S3 events rarely batch)
+FUNCTION_MEMORY_BYTES = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '1024')) * 1024 * 1024
+DOCUMENT_MEMORY_BUDGET = int(os.environ.get('DOCUMENT_MEMORY_MB', '0')) * 1024 * 1024
+# PDFs up to this size are fetched with one GET instead of ranged reads
+PDF_FULL_READ_MAX_BYTES = int(os.environ.get('PDF_FULL_READ_MAX_MB', '4')) * 1024 * 1024
+# PdfWriter holds roughly this multiple of the source size while rewriting,
+# at about this throughput
+NORMALIZE_MEMORY_FACTOR = 3
+NORMALIZE_BYTES_PER_SECOND = int(os.environ.get('NORMALIZE_MB_PER_SECOND', '2')) * 1024 * 1024
+# Time kept back from the Lambda deadline for Comprehend and saving results
+LAMBDA_RESERVE_SECONDS = 30
+
+# Normalized PDFs are uploaded as they are written (S3 parts must be >= 5 MB)
+MULTIPART_PART_SIZE = int(os.environ.get('MULTIPART_PART_SIZE_MB', '8')) * 1024 * 1024
+MULTIPART_CONCURRENCY = int(os.environ.get('MULTIPART_CONCURRENCY', '2'))
+
+# Per-stage timing/memory metrics, emitted as one CloudWatch EMF record
+# per document and embedded in the result JSON
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'DocumentProcessor')
+
+# Saved results: 'json' (one compact document) or 'ndjson' (a document
+# record followed by one record per page). RESULT_COMPRESSION=gzip stores
+# either with Content-Encoding: gzip
+RESULT_FORMAT = os.environ.get('RESULT_FORMAT', 'json')
+RESULT_COMPRESSION = os.environ.get('RESULT_COMPRESSION', 'none')
+
+# Result cache — bump PIPELINE_VERSION whenever extraction/analysis output
+# changes so stale cached results are not served. Settings that change the
+# output (see output_settings) are hashed into the key alongside it
+PIPELINE_VERSION = os.environ.get('PIPELINE_VERSION', 'phase4-v5')
+RESULT_CACHE_BACKEND = os.environ.get('RESULT_CACHE_BACKEND', 'memory')  # none | memory | s3 | sqlite
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', '256'))
+# The in-memory cache is also bounded by the serialized size of its results,
+# and that much is kept out of the per-document memory budget
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MB', '32')) * 1024 * 1024
+RESULT_CACHE_PREFIX = os.environ.get('RESULT_CACHE_PREFIX', 'cache/')
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH', '/tmp/result-cache.sqlite3')
+
+# Idempotency ledger — S3 delivers events at least once and Lambda retries
+# failures, so every object version is claimed before it is processed.
+# A claim whose lease runs out (crashed or timed-out owner) can be retaken.
+# The lease ends LEDGER_LEASE_MARGIN seconds after the invocation does, so
+# Lambda's retry a minute or so after a timeout can take the document over;
+# LEDGER_LEASE_SECONDS (the deployed function timeout) applies without a context
+LEDGER_BACKEND = os.environ.get('LEDGER_BACKEND', 'memory')  # none | memory | sqlite | s3
+LEDGER_LEASE_SECONDS = int(os.environ.get('LEDGER_LEASE_SECONDS', '60'))
+LEDGER_LEASE_MARGIN = int(os.environ.get('LEDGER_LEASE_MARGIN', '10'))
+LEDGER_PREFIX = os.environ.get('LEDGER_PREFIX', 'ledger/')
+LEDGER_PATH = os.environ.get('LEDGER_PATH', '/tmp/processing-ledger.sqlite3')
+LEDGER_MEMORY_SIZE = int(os.environ.get('LEDGER_MEMORY_SIZE', '4096'))
+
+# Comprehend limits — BatchDetect* accepts at most 25 documents per call,
+# each under 5,000 bytes of UTF-8. 'full' analyzes every chunk of a
+# document; 'truncate' only the first chunk (cost control)
+COMPREHEND_MODE = os.environ.get('COMPREHEND_MODE', 'full')
+COMPREHEND_MAX_BYTES = 5000
+COMPREHEND_BATCH_SIZE = 25
+COMPREHEND_WORKERS = int(os.environ.get('COMPREHEND_WORKERS', '6'))
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|\n+')
+WORD_BOUNDARY = re.compile(r'\s+')
+
+# AWS client tuning — pools are sized to the widest fan-out that uses each
+# client so concurrent work is not serialised on the default 10 connections
+CLIENT_MAX_ATTEMPTS = int(os.environ.get('CLIENT_MAX_ATTEMPTS', '6'))
+CLIENT_CONNECT_TIMEOUT = int(os.environ.get('CLIENT_CONNECT_TIMEOUT', '5'))
+CLIENT_READ_TIMEOUTS = {
+    's3': int(os.environ.get('S3_READ_TIMEOUT', '30')),
+    'textract': int(os.environ.get('TEXTRACT_READ_TIMEOUT', '120')),
+    'comprehend': int(os.environ.get('COMPREHEND_READ_TIMEOUT', '30')),
+}
+CLIENT_POOL_SIZES = {
+    # each record: one ranged GET stream plus its multipart part uploads
+    's3': MAX_WORKERS * (MULTIPART_CONCURRENCY + 1),
+    # each record: up to SHARD_CONCURRENCY shard jobs
+    'textract': MAX_WORKERS * SHARD_CONCURRENCY,
+    'comprehend': COMPREHEND_WORKERS,
+}
+THROTTLING_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException',
+    'ProvisionedThroughputExceededException', 'RequestLimitExceeded', 'SlowDown',
+    'RequestThrottled', 'RequestThrottledException', 'LimitExceededException',
+}
+# Error codes botocore retries as transient (alongside any 5xx). Other 4xx
+# codes — NoSuchKey on a cache or ledger miss, a 412 PreconditionFailed from
+# a conditional write — are expected outcomes and not counted
+TRANSIENT_ERROR_CODES = {
+    'RequestTimeout', 'RequestTimeoutException', 'PriorRequestNotComplete',
+    'InternalError', 'InternalFailure', 'InternalServerError', 'ServiceUnavailable',
+    'ServiceUnavailableException', 'BadGateway', 'GatewayTimeout', 'EC2ThrottledException',
+}
+
 
 def lambda_handler(event, context):
     """
     Main handler for document processing
     Triggered by S3 upload event
+
+    A single S3 notification can carry several records (bulk uploads), so
+    every record is processed on a bounded worker pool and the response
+    aggregates one result or error entry per record.
     """
+    records = event.get('Records', [])
+    print(f"Received {len(records)} record(s)")
+
+    if not records:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'error': 'No records in event'})
+        }
+
+    workers = max(1, min(MAX_WORKERS, len(records)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Phase 1: cache lookup, preprocessing and Textract per record.
+        # map() preserves record order in the aggregated response
+        invocation_deadline = claim_until = None
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            remaining = context.get_remaining_time_in_millis() / 1000
+            invocation_deadline = time.monotonic() + remaining - LAMBDA_RESERVE_SECONDS
+            claim_until = time.time() + remaining + LEDGER_LEASE_MARGIN
+        documents = list(executor.map(
+            lambda record: prepare_record(record, invocation_deadline, claim_until, workers), records))
+
+        # Phase 2: Comprehend for every document that still needs it, in
+        # batches of up to 25 instead of three calls per document
+        pending = [d for d in documents if d['status'] == 'pending']
+        batch_metrics = new_document_metrics()
+        with batch_metrics.span('comprehend') as span:
+            analyses = analyze_texts_batch([extraction_text(d['extraction']) for d in pending])
+            span.record(batch_documents=len(pending))
+        batch_stage = (batch_metrics.to_dict() or {'stages': {}})['stages'].get('comprehend', {})
+        for document, analysis in zip(pending, analyses):
+            document['analysis'] = analysis
+            # The batch is shared, so every document reports its full cost
+            document['metrics'].add_stage('comprehend', **batch_stage)
+
+        # Phase 3: assemble, cache and save each result
+        results = list(executor.map(finish_record, documents))
+
+    failed = [r for r in results if r['status'] == 'error']
+    duplicates = [r for r in results if r['status'] == 'duplicate']
+    summary = {
+        'total': len(results),
+        'succeeded': len(results) - len(failed) - len(duplicates),
+        'failed': len(failed),
+        'duplicates': len(duplicates),
+        'cache': result_cache.stats() if result_cache else None,
+        'ledger': ledger.stats() if ledger else None,
+        'clients': {service: dict(counts) for service, counts in client_stats.items()},
+        'results': results
+    }
+
+    return {
+        'statusCode': 200 if not failed else 500,
+        'body': json.dumps(summary)
+    }
+
+
+def prepare_record(record, invocation_deadline=None, claim_until=None, concurrent=1):
+    """
+    Run everything up to text analysis for one S3 event record.
+
+    Returns a working document dict whose status is 'cached' (a previous
+    result can be reused), 'pending' (extracted, waiting for Comprehend),
+    'duplicate' (another delivery of this object version owns it or has
+    finished it) or 'error'. Never raises, so one bad document does not
+    take down the rest of the batch.
+
+    The document gets DOCUMENT_TIME_BUDGET seconds, cut short by
+    `invocation_deadline` (time.monotonic()) when the invocation ends first,
+    and a share of memory for `concurrent` documents processed side by side.
+    Its ledger claim lapses at `claim_until` (time.time()).
+    """
+    metrics = new_document_metrics()
+    budget = new_document_budget(invocation_deadline, concurrent)
+    document = {'document_name': None, 'status': 'pending', 'metrics': metrics}
     try:
-        # Get bucket and key from S3 event
-        bucket = event['Records'][0]['s3']['bucket']['name']
-        key = event['Records'][0]['s3']['object']['key']
+        # Get bucket and key from S3 event record
+        bucket = record['s3']['bucket']['name']
+        key = record['s3']['object']['key']
+        document['document_name'] = key
+        metrics.document_name = key
 
         print(f"Processing document: {key} from bucket: {bucket}")
 
-        # Step 1: Preprocess document (NEW - Phase 4)
-        # Only applies to PDFs - images pass through unchanged
-        processed_bucket, processed_key = preprocess_document(bucket, key)
+        with use_metrics(metrics), use_budget(budget):
+            # Claim this object version so a redelivered or retried event
+            # running at the same time (or later) doesn't pay for it again
+            if ledger and not claim_document(document, bucket, key, record['s3']['object'], claim_until):
+                return document
+
+            # Identical uploads share an ETag — reuse the earlier result and
+            # skip the paid Textract/Comprehend calls
+            if result_cache:
+                with stage('cache_lookup'):
+                    document['cache_key'] = document_cache_key(bucket, key, record['s3']['object'].get('eTag'))
+                    cached = result_cache.get(document['cache_key'])
+                if cached:
+                    print(f"Cache hit for {key} ({document['cache_key']})")
+                    document['status'] = 'cached'
+                    document['cached'] = cached
+                    return document
+
+            # Step 1: Preprocess document (NEW - Phase 4)
+            # Only applies to PDFs - images pass through unchanged
+            # The PDF preprocessing opened is kept for the local text layer
+            opened = {} if LOCAL_TEXT_EXTRACTION else None
+            with stage('preprocess') as span:
+                try:
+                    processed_bucket, processed_key, page_count = preprocess_document(
+                        bucket, key, record['s3']['object'].get('size'), opened)
+                finally:
+                    if budget.strategy:
+                        document['preprocessing'] = budget.to_dict()
+                span.record(pages=page_count or 0)
+
+            # Step 2: Extract text — born-digital pages locally, the rest
+            # with Textract (preprocessed version if the PDF was normalized;
+            # multi-page PDFs go through the async job API)
+            document['extraction'] = extract_document(
+                processed_bucket, processed_key, page_count, (opened or {}).get('source'))
 
-        # Step 2: Extract text using Textract
-        # Now uses preprocessed version if PDF was normalized
-        extracted_data = extract_text_from_document(processed_bucket, processed_key)
+    except Exception as e:
+        print(f"Error processing document {document['document_name']}: {str(e)}")
+        document['status'] = 'error'
+        document['error'] = str(e)
 
-        # Step 3: Analyze text using Comprehend
-        analysis_results = analyze_text(extracted_data['full_text'])
+    return document
 
-        # Step 4: Combine results
-        final_result = {
-            'document_name': key,
-            'processed_at': datetime.now().isoformat(),
-            'extraction': extracted_data,
-            'analysis': analysis_results,
-            'status': 'success'
-        }
 
-        # Step 5: Save results to processed bucket
-        result_key = f"processed/{key.split('/')[-1]}.json"
-        s3_client.put_object(
-            Bucket=PROCESSED_BUCKET,
-            Key=result_key,
-            Body=json.dumps(final_result, indent=2),
-            ContentType='application/json'
-        )
+def claim_document(document, bucket, key, s3_object, claim_until=None):
+    """
+    Claim the document in the ledger; False (status 'duplicate') when it is taken.
+
+    The claim is leased until `claim_until` (time.time()), shortly after the
+    invocation ends, or for LEDGER_LEASE_SECONDS when that isn't known.
+
+    A ledger that can't be reached doesn't block processing — the worst
+    case is the duplicate work this guards against.
+    """
+    claimed = False
+    try:
+        with stage('ledger'):
+            ledger_key = document_ledger_key(bucket, key, s3_object)
+            owner = uuid.uuid4().hex
+            lease_seconds = None if claim_until is None else max(1, claim_until - time.time())
+            claimed, entry = ledger.claim(ledger_key, owner, lease_seconds)
+            if claimed:
+                ledger.start(ledger_key, owner, lease_seconds)
+    except Exception as e:
+        print(f"Ledger unavailable for {key}: {str(e)}, processing without a claim")
+        if claimed:
+            # Release the claim rather than leave it blocking redeliveries
+            # until the lease runs out
+            try:
+                ledger.fail(ledger_key, owner, error=f"ledger error: {str(e)}")
+            except Exception as release_error:
+                print(f"Could not release {ledger_key}: {str(release_error)}")
+        return True
+
+    if not claimed:
+        print(f"Skipping duplicate delivery of {key} ({ledger_key} is {entry['state']})")
+        document['status'] = 'duplicate'
+        document['ledger_state'] = entry['state']
+        return False
+
+    document['ledger_key'] = ledger_key
+    document['ledger_owner'] = owner
+    return True
+
+
+def settle_document(document, state, **fields):
+    """Record the outcome of a claimed document in the ledger"""
+    if not ledger or 'ledger_key' not in document:
+        return
+    try:
+        if state == 'done':
+            ledger.complete(document['ledger_key'], document['ledger_owner'], **fields)
+        else:
+            ledger.fail(document['ledger_key'], document['ledger_owner'], **fields)
+    except Exception as e:
+        print(f"Could not mark {document['ledger_key']} {state}: {str(e)}")
 
+
+def finish_record(document):
+    """
+    Combine extraction and analysis for one document and save the result.
+
+    Returns the per-record entry for the handler response. Never raises.
+    """
+    key = document['document_name']
+    metrics = document['metrics']
+    if document['status'] == 'duplicate':
+        metrics.emit(status='duplicate')
+        return {'document_name': key, 'status': 'duplicate', 'ledger_state': document['ledger_state']}
+    if document['status'] == 'error':
+        settle_document(document, 'failed', error=document['error'])
+        metrics.emit(status='error')
+        return {'document_name': key, 'status': 'error', 'error': document['error']}
+
+    try:
+        if document['status'] == 'cached':
+            final_result = dict(document['cached'])
+            final_result.pop('metrics', None)
+            final_result['document_name'] = key
+            final_result['processed_at'] = datetime.now().isoformat()
+            final_result['cache_hit'] = True
+        else:
+            # Step 4: Combine results
+            final_result = {
+                'document_name': key,
+                'processed_at': datetime.now().isoformat(),
+                'extraction': document['extraction'],
+                'analysis': document['analysis'],
+                'status': 'success'
+            }
+            if 'preprocessing' in document:
+                final_result['preprocessing'] = document['preprocessing']
+
+            # Only cache clean runs so a transient API error is retried next time
+            cache_key = document.get('cache_key')
+            if cache_key and 'error' not in document['extraction'] and 'error' not in document['analysis']:
+                result_cache.put(cache_key, final_result)
+
+        # Stages up to this point; the save itself shows up in the EMF record
+        if metrics.enabled:
+            final_result['metrics'] = metrics.to_dict()
+
+        # Step 5: Save results to processed bucket
+        with use_metrics(metrics), stage('save') as span:
+            body, extension, headers = encode_result(final_result)
+            result_key = f"processed/{key.split('/')[-1]}{extension}"
+            response = s3_client.put_object(
+                Bucket=PROCESSED_BUCKET,
+                Key=result_key,
+                Body=body,
+                **headers
+            )
+            span.record(bytes_out=len(body))
+            record_retries(response)
+
+        # A partial result (Textract/Comprehend error) is not cached, and
+        # likewise left re-claimable so a retried delivery can redo it
+        if any('error' in final_result.get(part, {}) for part in ('extraction', 'analysis')):
+            settle_document(document, 'failed', error='partial result')
+        else:
+            settle_document(document, 'done', result_key=result_key)
         print(f"Successfully processed {key}")
         print(f"Results saved to: {result_key}")
+        metrics.emit(status='cached' if document['status'] == 'cached' else 'success')
 
+        # The full result lives in S3 — the response only carries a summary
+        # so large batches stay well under the Lambda payload limit
         return {
-            'statusCode': 200,
-            'body': json.dumps(final_result)
+            'document_name': key,
+            'status': 'success',
+            'result_key': result_key,
+            'summary': summarize_result(final_result)
         }
 
     except Exception as e:
-        print(f"Error processing document: {str(e)}")
+        print(f"Error processing document {key}: {str(e)}")
+        settle_document(document, 'failed', error=str(e))
+        metrics.emit(status='error')
         return {
-            'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
+            'document_name': key,
+            'status': 'error',
+            'error': str(e)
         }
 
 
+def encode_result(result, result_format=None, compression=None):
+    """
+    Serialize a final result for the processed bucket.
+
+    Output is compact (no indentation), which roughly halves the size of
+    key/value-heavy results compared with pretty-printed JSON.
+
+    Returns (body, extension, headers) where headers are the extra
+    PutObject arguments (ContentType, plus ContentEncoding when gzipped).
+    """
+    result_format = result_format or RESULT_FORMAT
+    compression = compression or RESULT_COMPRESSION
+
+    if result_format == 'json':
+        text = json.dumps(result, separators=(',', ':'))
+        content_type = 'application/json'
+    elif result_format == 'ndjson':
+        text = ''.join(json.dumps(record, separators=(',', ':')) + '\n'
+                       for record in iter_result_records(result))
+        content_type = 'application/x-ndjson'
+    else:
+        raise ValueError(f"Unsupported RESULT_FORMAT: {result_format}")
+
+    body = text.encode('utf-8')
+    headers = {'ContentType': content_type}
+    if compression == 'gzip':
+        body = gzip.compress(body)
+        headers['ContentEncoding'] = 'gzip'
+    elif compression != 'none':
+        raise ValueError(f"Unsupported RESULT_COMPRESSION: {compression}")
+
+    return body, f'.{result_format}', headers
+
+
+def iter_result_records(result):
+    """
+    Split a result into NDJSON records.
+
+    The first record holds everything except the extraction's per-page
+    entries, which follow as one 'page' record each. A result without
+    pages is written as the document record alone.
+    """
+    extraction = result.get('extraction')
+    pages = extraction.get('pages') if isinstance(extraction, dict) else None
+
+    document = {'record': 'document', **result}
+    if pages is not None:
+        document['extraction'] = {k: v for k, v in extraction.items() if k != 'pages'}
+    yield document
+
+    for page in pages or ():
+        yield {'record': 'page', **page}
+
+
+def summarize_result(result):
+    """Small per-record digest returned by the handler in place of the full result"""
+    extraction = result.get('extraction') or {}
+    analysis = result.get('analysis') or {}
+    summary = {
+        'page_count': extraction.get('page_count', 0),
+        'textract_mode': extraction.get('textract_mode'),
+        'key_value_pairs': len(extraction_key_values(extraction)),
+        'tables': sum(len(page.get('tables', ())) for page in extraction.get('pages', ())),
+        'engines': extraction.get('engines', {}),
+        'entities': len(analysis.get('entities', [])),
+        'sentiment': (analysis.get('sentiment') or {}).get('overall'),
+        'cache_hit': result.get('cache_hit', False),
+    }
+    errors = [part['error'] for part in (extraction, analysis) if 'error' in part]
+    if errors:
+        summary['errors'] = errors
+    return summary
+
+
+# -------------------------------------------------------
+# AWS clients
+# -------------------------------------------------------
+
+client_stats = {}
+_client_stats_lock = threading.Lock()
+
+
+def create_client(service_name):
+    """
+    Create a boto3 client tuned for this pipeline's concurrency.
+
+    Uses adaptive retry mode (client-side rate limiting on throttles, with
+    jittered exponential backoff), explicit connect/read timeouts and a
+    connection pool sized from CLIENT_POOL_SIZES. Throttles and other
+    retryable errors are counted per service in client_stats and on the
+    open metrics stage.
+    """
+    config = Config(
+        max_pool_connections=max(10, CLIENT_POOL_SIZES.get(service_name, 10)),
+        retries={'mode': 'adaptive', 'max_attempts': CLIENT_MAX_ATTEMPTS},
+        connect_timeout=CLIENT_CONNECT_TIMEOUT,
+        read_timeout=CLIENT_READ_TIMEOUTS.get(service_name, 60)
+    )
+    client = boto3.client(service_name, config=config)
+    with _client_stats_lock:
+        client_stats.setdefault(service_name, {'throttles': 0, 'retryable_errors': 0})
+    # Each client has its own event emitter, so this only sees this service
+    client.meta.events.register(
+        'needs-retry',
+        lambda **kwargs: count_retryable_error(service_name, **kwargs)
+    )
+    return client
+
+
+def count_retryable_error(service_name, response=None, caught_exception=None, **kwargs):
+    """
+    botocore 'needs-retry' hook: tally throttles and retryable errors
+    (connection errors, 5xx and TRANSIENT_ERROR_CODES; not client errors).
+
+    Runs after every attempt; only observes, and returns None so botocore's
+    own retry decision is unchanged.
+    """
+    if caught_exception is not None:
+        kind = 'retryable_errors'
+    elif response is not None:
+        http_response, parsed = response
+        code = parsed.get('Error', {}).get('Code')
+        if code in THROTTLING_ERROR_CODES or http_response.status_code == 429:
+            kind = 'throttles'
+        elif code in TRANSIENT_ERROR_CODES or http_response.status_code >= 500:
+            kind = 'retryable_errors'
+        else:
+            return None
+    else:
+        return None
+
+    with _client_stats_lock:
+        client_stats[service_name][kind] += 1
+    current_metrics().current().add(**{kind: 1})
+    return None
+
+
+# -------------------------------------------------------
+# Per-stage instrumentation
+# -------------------------------------------------------
+
+class StageSpan:
+    """Fields recorded for one pipeline stage (wall time, bytes, pages, retries...)"""
+
+    __slots__ = ('fields',)
+
+    def __init__(self):
+        self.fields = {}
+
+    def record(self, **fields):
+        self.fields.update(fields)
+
+    def add(self, **counters):
+        for name, value in counters.items():
+            self.fields[name] = self.fields.get(name, 0) + value
+
+
+class DocumentMetrics:
+    """
+    Collects stage spans for one document.
+
+    Spans nest (e.g. triage inside preprocess); record_retries() and
+    friends attach to the innermost open span. Repeating a stage name
+    adds to its numeric fields.
+    """
+
+    enabled = True
+
+    def __init__(self, document_name=None):
+        self.document_name = document_name
+        self.stages = {}
+        self.active = []
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def span(self, name):
+        span = StageSpan()
+        rss_before = peak_rss_bytes()
+        started = time.perf_counter()
+        self.active.append(span)
+        try:
+            yield span
+        finally:
+            self.active.pop()
+            span.record(
+                wall_ms=round((time.perf_counter() - started) * 1000, 2),
+                peak_rss_delta_bytes=peak_rss_bytes() - rss_before
+            )
+            self.add_stage(name, **span.fields)
+
+    def add_stage(self, name, **fields):
+        stage_fields = self.stages.setdefault(name, {})
+        for field, value in fields.items():
+            if field in stage_fields and isinstance(value, (int, float)):
+                stage_fields[field] = stage_fields[field] + value
+            else:
+                stage_fields[field] = value
+
+    def current(self):
+        return self.active[-1] if self.active else NULL_SPAN
+
+    def to_dict(self):
+        return {
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'stages': {name: dict(fields) for name, fields in self.stages.items()}
+        }
+
+    def emit(self, status):
+        """Print one CloudWatch Embedded Metric Format record for this document"""
+        summary = self.to_dict()
+        metric_values = {'total_ms': summary['total_ms']}
+        for name, fields in summary['stages'].items():
+            for field in ('wall_ms', 'bytes_in', 'bytes_out', 'retries', 'throttles'):
+                if field in fields:
+                    metric_values[f'{name}_{field}'] = fields[field]
+
+        units = {'ms': 'Milliseconds', 'in': 'Bytes', 'out': 'Bytes', 'retries': 'Count', 'throttles': 'Count'}
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Status']],
+                    'Metrics': [
+                        {'Name': name, 'Unit': units[name.rsplit('_', 1)[1]]}
+                        for name in metric_values
+                    ]
+                }]
+            },
+            'Status': status,
+            'document_name': self.document_name,
+            'stages': summary['stages'],
+            **metric_values
+        }
+        print(json.dumps(record))
+
+
+class NullMetrics:
+    """Stand-in used when METRICS_ENABLED is false — every call is a no-op"""
+
+    enabled = False
+    document_name = None
+
+    def span(self, name):
+        return NULL_SPAN
+
+    def add_stage(self, name, **fields):
+        pass
+
+    def current(self):
+        return NULL_SPAN
+
+    def to_dict(self):
+        return None
+
+    def emit(self, status):
+        pass
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def record(self, **fields):
+        pass
+
+    def add(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+NULL_METRICS = NullMetrics()
+
+# Each record is processed on one worker thread, so the document being
+# measured is tracked per thread rather than passed through every helper
+_metrics_context = threading.local()
+
+
+def new_document_metrics():
+    return DocumentMetrics() if METRICS_ENABLED else NULL_METRICS
+
+
+@contextmanager
+def use_metrics(metrics):
+    """Make `metrics` the target of stage() calls on this thread"""
+    previous = getattr(_metrics_context, 'metrics', NULL_METRICS)
+    _metrics_context.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _metrics_context.metrics = previous
+
+
+def current_metrics():
+    return getattr(_metrics_context, 'metrics', NULL_METRICS)
+
+
+def stage(name):
+    """Time a pipeline stage for the document being processed on this thread"""
+    return current_metrics().span(name)
+
+
+def record_retries(response):
+    """Add botocore's retry count for one API response to the open stage"""
+    retries = response.get('ResponseMetadata', {}).get('RetryAttempts', 0) if response else 0
+    if retries:
+        current_metrics().current().add(retries=retries)
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# -------------------------------------------------------
+# Result cache (content-addressed by S3 ETag + pipeline version)
+# -------------------------------------------------------
+
+def document_cache_key(bucket, key, etag=None):
+    """
+    Build the cache key for a document.
+
+    S3 event records carry the object's ETag; fall back to HeadObject when
+    it is missing. The pipeline version is part of the key so a config
+    change never serves results produced by older code.
+    """
+    if not etag:
+        etag = s3_client.head_object(Bucket=bucket, Key=key)['ETag']
+    etag = etag.strip('"')
+    return f"{pipeline_fingerprint()}/{etag}"
+
+
+def output_settings():
+    """Environment settings that change what a result contains"""
+    return {
+        'comprehend_mode': COMPREHEND_MODE,
+        'textract_features': TEXTRACT_FEATURES,
+        'local_text': [LOCAL_TEXT_EXTRACTION, LOCAL_TEXT_MIN_CHARS, LOCAL_TEXT_MAX_UNMAPPED, LOCAL_TEXT_MIN_ALNUM],
+        'shards': [SHARD_THRESHOLD_PAGES, SHARD_PAGES],
+    }
+
+
+def pipeline_fingerprint():
+    """PIPELINE_VERSION plus a short hash of output_settings(), e.g. 'phase4-v5-3f2a9c1d0b7e'"""
+    settings = json.dumps(output_settings(), sort_keys=True).encode('utf-8')
+    return f"{PIPELINE_VERSION}-{hashlib.blake2b(settings, digest_size=6).hexdigest()}"
+
+
+class MemoryResultCache:
+    """
+    Thread-safe LRU of final results, lives as long as the warm container.
+
+    Bounded by entry count and by the serialized size of the results, so a
+    few large documents can't take over the container's memory. A result
+    bigger than the whole byte budget is not kept at all.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cache_key):
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(cache_key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, cache_key, result):
+        size = len(json.dumps(result, separators=(',', ':'), default=str).encode('utf-8'))
+        with self.lock:
+            if cache_key in self.entries:
+                self.bytes -= self.entries.pop(cache_key)[1]
+            if size > self.max_bytes:
+                return
+            self.entries[cache_key] = (result, size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.bytes -= self.entries.popitem(last=False)[1][1]
+
+    def stats(self):
+        return {'backend': 'memory', 'hits': self.hits, 'misses': self.misses,
+                'size': len(self.entries), 'bytes': self.bytes}
+
+
+class S3ResultCache:
+    """Persistent cache stored as JSON objects under a prefix in the processed bucket"""
+
+    def __init__(self, bucket=PROCESSED_BUCKET, prefix=RESULT_CACHE_PREFIX):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cache_key):
+        try:
+            response = s3_client.get_object(Bucket=self.bucket, Key=f"{self.prefix}{cache_key}.json")
+            result = json.loads(response['Body'].read())
+        except Exception:
+            # NoSuchKey is the normal miss; anything else is treated as a miss too
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return result
+
+    def put(self, cache_key, result):
+        s3_client.put_object(
+            Bucket=self.bucket,
+            Key=f"{self.prefix}{cache_key}.json",
+            Body=json.dumps(result),
+            ContentType='application/json'
+        )
+
+    def stats(self):
+        return {'backend': 's3', 'hits': self.hits, 'misses': self.misses}
+
+
+class SQLiteResultCache:
+    """Persistent cache in a local SQLite file (useful for tests and local runs)"""
+
+    def __init__(self, path=RESULT_CACHE_PATH):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS results (cache_key TEXT PRIMARY KEY, result TEXT NOT NULL)'
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cache_key):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT result FROM results WHERE cache_key = ?', (cache_key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, cache_key, result):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO results (cache_key, result) VALUES (?, ?)',
+                (cache_key, json.dumps(result))
+            )
+            self.connection.commit()
+
+    def stats(self):
+        return {'backend': 'sqlite', 'hits': self.hits, 'misses': self.misses}
+
+
+class TieredResultCache:
+    """In-memory LRU in front of a persistent backend"""
+
+    def __init__(self, memory, persistent):
+        self.memory = memory
+        self.persistent = persistent
+
+    def get(self, cache_key):
+        result = self.memory.get(cache_key)
+        if result is None:
+            result = self.persistent.get(cache_key)
+            if result is not None:
+                self.memory.put(cache_key, result)
+        return result
+
+    def put(self, cache_key, result):
+        self.memory.put(cache_key, result)
+        self.persistent.put(cache_key, result)
+
+    def stats(self):
+        return {'memory': self.memory.stats(), 'persistent': self.persistent.stats()}
+
+
+def build_result_cache(backend=RESULT_CACHE_BACKEND):
+    """Create the result cache selected by RESULT_CACHE_BACKEND (None when disabled)"""
+    if backend == 'none':
+        return None
+    memory = MemoryResultCache()
+    if backend == 'memory':
+        return memory
+    if backend == 's3':
+        return TieredResultCache(memory, S3ResultCache())
+    if backend == 'sqlite':
+        return TieredResultCache(memory, SQLiteResultCache())
+    raise ValueError(f"Unknown RESULT_CACHE_BACKEND: {backend}")
+
+
+# -------------------------------------------------------
+# Processing ledger (one claim per S3 object version)
+# -------------------------------------------------------
+
+class LedgerConflict(Exception):
+    """A conditional ledger write lost the race to another writer"""
+
+
+def document_ledger_key(bucket, key, s3_object):
+    """
+    Identify one S3 object version: bucket/key plus versionId, or ETag.
+
+    Redelivered events carry the same identity; a new upload to the same
+    key does not, so it is processed again. The key is prefixed with
+    PIPELINE_VERSION so a version bump reprocesses documents already done.
+    """
+    version = s3_object.get('versionId') or s3_object.get('eTag')
+    if not version:
+        version = s3_client.head_object(Bucket=bucket, Key=key)['ETag']
+    version = version.strip('"')
+    return f"{PIPELINE_VERSION}/{bucket}/{key}@{version}"
+
+
+class ProcessingLedger:
+    """
+    Tracks each document version through claimed -> in_progress -> done | failed.
+
+    Every change is a compare-and-swap on the store, so two deliveries
+    racing for the same document can't both win the claim. Claims carry a
+    lease: a claimed or in-progress entry whose lease has expired (the
+    owner crashed or timed out) may be claimed again, as may a failed one.
+    Only the owner that holds the claim can move it forward.
+    """
+
+    ACTIVE_STATES = ('claimed', 'in_progress')
+
+    def __init__(self, store, lease_seconds=None):
+        self.store = store
+        self.lease_seconds = lease_seconds or LEDGER_LEASE_SECONDS
+        self.lock = threading.Lock()
+        self.counts = {'claimed': 0, 'duplicates': 0, 'reclaimed': 0}
+
+    def claim(self, ledger_key, owner, lease_seconds=None):
+        """Returns (claimed, entry); entry is the blocking one when not claimed"""
+        now = time.time()
+        entry = {'state': 'claimed', 'owner': owner, 'attempts': 1,
+                 'lease_expires': now + (lease_seconds or self.lease_seconds), 'updated_at': now}
+        current, version = self.store.get(ledger_key)
+
+        if current is None:
+            claimed = self.store.create(ledger_key, entry)
+        elif current['state'] == 'done' or (
+                current['state'] in self.ACTIVE_STATES and current['lease_expires'] > now):
+            claimed = False
+        else:
+            entry['attempts'] = current.get('attempts', 0) + 1
+            claimed = self.store.replace(ledger_key, entry, version)
+
+        if not claimed and current is None:
+            current, _ = self.store.get(ledger_key)
+        with self.lock:
+            if not claimed:
+                self.counts['duplicates'] += 1
+            elif current is not None:
+                self.counts['reclaimed'] += 1
+            else:
+                self.counts['claimed'] += 1
+        return claimed, (entry if claimed else current or {'state': 'unknown'})
+
+    def start(self, ledger_key, owner, lease_seconds=None):
+        """Mark the claim in progress and renew its lease"""
+        self._transition(ledger_key, owner, 'in_progress',
+                         lease_expires=time.time() + (lease_seconds or self.lease_seconds))
+
+    def complete(self, ledger_key, owner, result_key=None):
+        self._transition(ledger_key, owner, 'done', result_key=result_key)
+
+    def fail(self, ledger_key, owner, error=None):
+        self._transition(ledger_key, owner, 'failed', error=(error or '')[:500])
+
+    def _transition(self, ledger_key, owner, state, **fields):
+        current, version = self.store.get(ledger_key)
+        if current is None or current['owner'] != owner:
+            raise LedgerConflict(f"{ledger_key} is no longer claimed by {owner}")
+        entry = dict(current, state=state, updated_at=time.time(), **fields)
+        if not self.store.replace(ledger_key, entry, version):
+            raise LedgerConflict(f"{ledger_key} changed while moving to {state}")
+
+    def stats(self):
+        with self.lock:
+            return {'backend': self.store.backend, **self.counts}
+
+
+class MemoryLedgerStore:
+    """
+    Versioned entries in an LRU dict — local stand-in for the persistent
+    stores. Only the `max_entries` most recently written entries are kept,
+    so a warm container doesn't accumulate every document it has seen.
+    """
+
+    backend = 'memory'
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or LEDGER_MEMORY_SIZE
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, ledger_key):
+        with self.lock:
+            entry, version = self.entries.get(ledger_key, (None, None))
+            return (dict(entry) if entry else None), version
+
+    def create(self, ledger_key, entry):
+        with self.lock:
+            if ledger_key in self.entries:
+                return False
+            self._store(ledger_key, entry, 1)
+            return True
+
+    def replace(self, ledger_key, entry, version):
+        with self.lock:
+            current = self.entries.get(ledger_key)
+            if current is None or current[1] != version:
+                return False
+            self._store(ledger_key, entry, version + 1)
+            return True
+
+    def _store(self, ledger_key, entry, version):
+        self.entries[ledger_key] = (dict(entry), version)
+        self.entries.move_to_end(ledger_key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class SQLiteLedgerStore:
+    """Versioned entries in a local SQLite file; the WHERE clause is the condition"""
+
+    backend = 'sqlite'
+
+    def __init__(self, path=LEDGER_PATH):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS ledger '
+            '(ledger_key TEXT PRIMARY KEY, version INTEGER NOT NULL, entry TEXT NOT NULL)'
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+
+    def get(self, ledger_key):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT entry, version FROM ledger WHERE ledger_key = ?', (ledger_key,)
+            ).fetchone()
+        if row is None:
+            return None, None
+        return json.loads(row[0]), row[1]
+
+    def create(self, ledger_key, entry):
+        with self.lock:
+            cursor = self.connection.execute(
+                'INSERT OR IGNORE INTO ledger (ledger_key, version, entry) VALUES (?, 1, ?)',
+                (ledger_key, json.dumps(entry))
+            )
+            self.connection.commit()
+            return cursor.rowcount == 1
+
+    def replace(self, ledger_key, entry, version):
+        with self.lock:
+            cursor = self.connection.execute(
+                'UPDATE ledger SET entry = ?, version = version + 1 WHERE ledger_key = ? AND version = ?',
+                (json.dumps(entry), ledger_key, version)
+            )
+            self.connection.commit()
+            return cursor.rowcount == 1
+
+
+class S3LedgerStore:
+    """
+    One JSON object per document under LEDGER_PREFIX in the processed bucket.
+
+    Uses S3 conditional writes: If-None-Match: * to create, If-Match on
+    the ETag read with the entry to replace. A 412/409 means another
+    writer got there first.
+    """
+
+    backend = 's3'
+    CONFLICT_CODES = {'PreconditionFailed', 'ConditionalRequestConflict'}
+
+    def __init__(self, bucket=PROCESSED_BUCKET, prefix=LEDGER_PREFIX):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def object_key(self, ledger_key):
+        return f"{self.prefix}{ledger_key}.json"
+
+    def get(self, ledger_key):
+        try:
+            response = s3_client.get_object(Bucket=self.bucket, Key=self.object_key(ledger_key))
+        except Exception as e:
+            if error_code(e) in ('NoSuchKey', '404'):
+                return None, None
+            raise
+        return json.loads(response['Body'].read()), response['ETag']
+
+    def create(self, ledger_key, entry):
+        return self._put(ledger_key, entry, IfNoneMatch='*')
+
+    def replace(self, ledger_key, entry, version):
+        return self._put(ledger_key, entry, IfMatch=version)
+
+    def _put(self, ledger_key, entry, **condition):
+        try:
+            s3_client.put_object(
+                Bucket=self.bucket,
+                Key=self.object_key(ledger_key),
+                Body=json.dumps(entry),
+                ContentType='application/json',
+                **condition
+            )
+        except Exception as e:
+            if error_code(e) in self.CONFLICT_CODES:
+                return False
+            raise
+        return True
+
+
+def error_code(exception):
+    """The AWS error code of a botocore ClientError (None for anything else)"""
+    return getattr(exception, 'response', {}).get('Error', {}).get('Code')
+
+
+def build_ledger(backend=LEDGER_BACKEND):
+    """Create the ledger selected by LEDGER_BACKEND (None when disabled)"""
+    if backend == 'none':
+        return None
+    if backend == 'memory':
+        return ProcessingLedger(MemoryLedgerStore())
+    if backend == 'sqlite':
+        return ProcessingLedger(SQLiteLedgerStore())
+    if backend == 's3':
+        return ProcessingLedger(S3LedgerStore())
+    raise ValueError(f"Unknown LEDGER_BACKEND: {backend}")
+
+
+# Module level so clients (and their connection pools) and the cache
+# survive across warm invocations
+s3_client = create_client('s3')
+textract_client = create_client('textract')
+comprehend_client = create_client('comprehend')
+
+result_cache = build_result_cache()
+ledger = build_ledger()
+
+
+# -------------------------------------------------------
+# Resource governor
+# -------------------------------------------------------
+
+class DocumentRejected(Exception):
+    """The document is over a hard limit and is not processed at all"""
+
+
+class DocumentBudget:
+    """
+    Time and memory one document may use, and the strategy chosen for it.
+
+    The deadline is a time.monotonic() value (None means unlimited). Long
+    steps check remaining() and fall back — skip a rewrite, leave pages
+    for Textract, stop polling — instead of running the container out of
+    time or memory.
+    """
+
+    def __init__(self, deadline=None, memory_bytes=None):
+        self.deadline = deadline
+        self.memory_bytes = memory_bytes or document_memory_budget()
+        self.strategy = None
+        self.reasons = []
+
+    def remaining(self):
+        if self.deadline is None:
+            return float('inf')
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def choose(self, strategy, reason=None):
+        self.strategy = strategy
+        if reason:
+            self.reasons.append(reason)
+        print(f"Strategy: {strategy}" + (f" ({reason})" if reason else ''))
+
+    def to_dict(self):
+        return {'strategy': self.strategy, 'reasons': list(self.reasons)}
+
+
+# Like metrics, the budget of the document on this thread is tracked per
+# thread so deep helpers (Textract polling) can honour it
+_budget_context = threading.local()
+
+
+def document_memory_budget(concurrent=1):
+    """Bytes each of `concurrent` documents in one invocation may use"""
+    available = FUNCTION_MEMORY_BYTES - (RESULT_CACHE_MAX_BYTES if result_cache else 0)
+    return DOCUMENT_MEMORY_BUDGET or available // (2 * max(1, concurrent))
+
+
+def new_document_budget(invocation_deadline=None, concurrent=1):
+    deadline = time.monotonic() + DOCUMENT_TIME_BUDGET
+    if invocation_deadline is not None:
+        deadline = min(deadline, invocation_deadline)
+    return DocumentBudget(deadline, document_memory_budget(concurrent))
+
+
+@contextmanager
+def use_budget(budget):
+    """Make `budget` the one current_budget() returns on this thread"""
+    previous = getattr(_budget_context, 'budget', None)
+    _budget_context.budget = budget
+    try:
+        yield budget
+    finally:
+        _budget_context.budget = previous
+
+
+def current_budget():
+    budget = getattr(_budget_context, 'budget', None)
+    return budget if budget is not None else DocumentBudget()
+
+
+def open_pdf_source(bucket, key, size, budget):
+    """
+    Check a PDF's size against the hard limit and open it for reading.
+
+    Small files are fetched with a single GET (one round trip instead of
+    a dozen ranged reads); anything larger is read through a RangeReader
+    so only the parts PyPDF2 touches are downloaded.
+    """
+    if size is None:
+        size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    if size > DOCUMENT_MAX_BYTES:
+        budget.choose('rejected', f'{size} bytes exceeds DOCUMENT_MAX_BYTES')
+        raise DocumentRejected(f"{key} is {size} bytes, over the {DOCUMENT_MAX_BYTES} byte limit")
+
+    if size <= PDF_FULL_READ_MAX_BYTES:
+        return io.BytesIO(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()), size
+    return RangeReader(s3_range_fetcher(bucket, key)), size
+
+
+def plan_normalization(size, page_count, issues, budget):
+    """
+    Decide how a PDF is rewritten, from its size, page count and triage issues.
+
+    Records the strategy on `budget` and returns True when the whole
+    document should be normalized now:
+      clean              — nothing to fix, the original goes to Textract
+      full / streaming   — rewrite from the in-memory copy / ranged reads
+      sharded            — big enough to be split, and every shard is
+                           rewritten by PdfWriter anyway
+      skip_normalization — the rewrite would not fit the memory or time
+                           budget, so Textract gets the original
+    An encrypted PDF that can't be decrypted within the budget is rejected
+    instead: Textract can't read it, so sending the original only hides why.
+    """
+    if page_count > DOCUMENT_MAX_PAGES:
+        budget.choose('rejected', f'{page_count} pages exceeds DOCUMENT_MAX_PAGES')
+        raise DocumentRejected(f"{page_count} pages is over the {DOCUMENT_MAX_PAGES} page limit")
+
+    if not issues and not ALWAYS_NORMALIZE:
+        budget.choose('clean')
+        return False
+
+    if SHARD_THRESHOLD_PAGES and page_count > SHARD_THRESHOLD_PAGES:
+        budget.choose('sharded', f'{page_count} pages will be rewritten shard by shard')
+        return False
+
+    projected_memory = size * NORMALIZE_MEMORY_FACTOR
+    projected_seconds = size / NORMALIZE_BYTES_PER_SECOND
+    reason = None
+    if projected_memory > budget.memory_bytes:
+        reason = f'rewrite needs ~{projected_memory} bytes, budget is {budget.memory_bytes}'
+    elif projected_seconds > budget.remaining():
+        reason = f'rewrite needs ~{projected_seconds:.0f}s, {budget.remaining():.0f}s left'
+    if reason and 'encrypted' in issues:
+        budget.choose('rejected', f'encrypted PDF cannot be decrypted: {reason}')
+        raise DocumentRejected(f"encrypted PDF of {size} bytes cannot be decrypted within budget: {reason}")
+    if reason:
+        budget.choose('skip_normalization', reason)
+        return False
+
+    budget.choose('full' if size <= PDF_FULL_READ_MAX_BYTES else 'streaming')
+    return True
+
+
 # -------------------------------------------------------
 # NEW IN PHASE 4: PDF Preprocessing
 # -------------------------------------------------------
 
-def preprocess_document(bucket, key):
+def preprocess_document(bucket, key, size=None, opened=None):
     """
     Triage and normalize documents before sending to Textract.
 
@@ -86,49 +1358,150 @@ def preprocess_document(bucket, key):
     PyPDF2 reads and rewrites the PDF, normalizing its structure so Textract
     can process it reliably.
 
+    `size` is the object's Content-Length (from the S3 event; fetched with
+    HeadObject when missing). Together with the page count from triage it
+    decides the strategy recorded on the current DocumentBudget; documents
+    over DOCUMENT_MAX_BYTES / DOCUMENT_MAX_PAGES raise DocumentRejected
+    before anything large is parsed.
+
     Returns the bucket and key to use for Textract — either the original
-    (for non-PDFs or already-clean PDFs) or a normalized version.
+    (for non-PDFs or already-clean PDFs) or a normalized version — plus the
+    page count PyPDF2 found (None when it is unknown). Given an `opened`
+    dict, the source read here is left in it under 'source' so the text
+    layer can be read without downloading the PDF again.
     """
 
     # Only preprocess PDFs — images (JPEG, PNG) go straight to Textract
     if not key.lower().endswith('.pdf'):
         print(f"Non-PDF file detected ({key}), skipping preprocessing")
-        return bucket, key
+        return bucket, key, None
 
     print(f"PDF detected, starting preprocessing for {key}")
+    budget = current_budget()
 
     try:
-        # Download the PDF from S3 into memory
-        response = s3_client.get_object(Bucket=bucket, Key=key)
-        pdf_bytes = response['Body'].read()
-
-        # Run validation and normalization
-        normalized_bytes = validate_and_normalize_pdf(pdf_bytes, key)
-
-        if normalized_bytes is None:
+        # Small PDFs are read in one GET; larger ones through ranged GETs,
+        # where PyPDF2 only pulls the header, trailer, xref and the objects
+        # it touches, so large scans never have to fit in memory in one piece
+        source, size = open_pdf_source(bucket, key, size, budget)
+        streamed = isinstance(source, RangeReader)
+        if opened is not None:
+            opened['source'] = source
+
+        # Most inbound PDFs are already clean — only rewrite when triage
+        # finds something Textract is likely to choke on
+        with stage('triage') as span:
+            issues, page_count = triage_pdf(source, key)
+            span.record(bytes_in=source.bytes_fetched if streamed else size, pages=page_count)
+        if not plan_normalization(size, page_count, issues, budget):
+            print(f"PDF {key} ({page_count} page(s)) goes to Textract unchanged")
+            if streamed:
+                print(f"Fetched for {key}: {source.stats()}")
+            return bucket, key, page_count or None
+
+        print(f"PDF {key} needs normalization: {', '.join(issues) or 'ALWAYS_NORMALIZE set'}")
+
+        # Run validation and normalization, streaming the rewritten PDF
+        # straight into a multipart upload under a temp prefix
+        normalized_key = f"preprocessed/{key.split('/')[-1]}"
+        fetched_before = source.bytes_fetched if streamed else 0
+        with stage('normalize') as span, \
+                S3MultipartWriter(bucket, normalized_key, content_type='application/pdf') as upload:
+            written, page_count = validate_and_normalize_pdf(source, key, upload)
+            if written is None:
+                upload.abort()
+            span.record(bytes_in=source.bytes_fetched - fetched_before if streamed else size,
+                        bytes_out=written or 0, pages=page_count)
+        if streamed:
+            print(f"Fetched for {key}: {source.stats()}")
+
+        if written is None:
             # Normalization failed — fall back to original and let
             # Textract try. Better to attempt than silently drop the doc.
             print(f"Normalization failed for {key}, falling back to original")
-            return bucket, key
+            return bucket, key, page_count or None
 
-        # Upload normalized PDF back to S3 under a temp prefix
-        normalized_key = f"preprocessed/{key.split('/')[-1]}"
-        s3_client.put_object(
-            Bucket=bucket,
-            Key=normalized_key,
-            Body=normalized_bytes,
-            ContentType='application/pdf'
-        )
-
-        print(f"Normalized PDF uploaded to: {normalized_key}")
-        return bucket, normalized_key
+        print(f"Normalized PDF uploaded to: {normalized_key} ({upload.parts_uploaded} part(s))")
+        return bucket, normalized_key, page_count
 
+    except DocumentRejected:
+        raise
     except Exception as e:
         print(f"Preprocessing error for {key}: {str(e)}, falling back to original")
-        return bucket, key
+        return bucket, key, None
+
+
+def triage_pdf(source, key):
+    """
+    Cheap structural check that decides whether a PDF needs rewriting.
+
+    Looks at the header and version, the startxref pointer (via PyPDF2's
+    own _get_xref_issues), the encryption flag and the page tree. The
+    reader runs in strict mode so anything PyPDF2 would silently repair
+    counts as an issue.
 
+    `source` is the PDF as bytes or a seekable binary stream.
 
-def validate_and_normalize_pdf(pdf_bytes, key):
+    Returns (issues, page_count). An empty issue list means the original
+    file can go straight to Textract.
+    """
+    issues = []
+    stream = as_stream(source)
+
+    stream.seek(0)
+    header = stream.read(8)
+    if not header.startswith(b'%PDF-'):
+        issues.append('missing %PDF header')
+    elif header[5:8] not in SUPPORTED_PDF_VERSIONS:
+        issues.append(f"unsupported PDF version {header[5:8].decode('latin-1')}")
+
+    size = stream.seek(0, io.SEEK_END)
+    stream.seek(max(0, size - 1024))
+    tail = stream.read(1024)
+    startxref = tail.rfind(b'startxref')
+    if b'%%EOF' not in tail or startxref == -1:
+        issues.append('missing startxref/%%EOF trailer')
+    if issues:
+        return issues, 0
+
+    try:
+        offset = int(tail[startxref + 9:].split()[0])
+        if PyPDF2.PdfReader._get_xref_issues(stream, offset) != 0:
+            return ['startxref does not point at an xref table'], 0
+
+        reader = PyPDF2.PdfReader(stream, strict=True)
+        if reader.is_encrypted:
+            return ['encrypted'], 0
+
+        # The declared count is a cheap probe — don't walk the page tree of
+        # a document that is going to be rejected anyway. /Count may be an
+        # indirect reference; resolve it before comparing
+        declared = reader.trailer['/Root']['/Pages'].get('/Count')
+        if declared is not None:
+            declared = declared.get_object()
+            if not isinstance(declared, int):
+                return [f'page tree /Count is not a number ({declared!r})'], 0
+        if declared is not None and declared > DOCUMENT_MAX_PAGES:
+            return [f'page tree declares {declared} pages'], declared
+        page_count = len(reader.pages)
+        if page_count == 0:
+            issues.append('no pages')
+        elif declared != page_count:
+            issues.append(f'page tree /Count {declared} != {page_count} pages')
+        return issues, page_count
+
+    except Exception as e:
+        return [f'structure error ({e})'], 0
+
+
+def as_stream(source):
+    """Wrap raw PDF bytes in a stream; pass file-like objects through"""
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source)
+    return source
+
+
+def validate_and_normalize_pdf(source, key, destination=None):
     """
     Inspect the PDF and rewrite it using PyPDF2.
 
@@ -144,10 +1517,20 @@ def validate_and_normalize_pdf(pdf_bytes, key):
     3. Non-standard encoding: Some PDF generators use unusual character
        encoding. The rewrite normalizes this to standard encoding.
 
-    Returns normalized PDF bytes, or None if normalization fails.
+    `source` is the PDF as bytes or a seekable binary stream (such as a
+    RangeReader over S3). When `destination` is given (any object with
+    write() and tell(), such as an S3MultipartWriter) the output is
+    written there instead of being collected in memory.
+
+    Returns (normalized PDF bytes, page count) — or (bytes written, page
+    count) when writing to `destination`. The first item is None if
+    normalization fails; the page count is 0 when it could not be read.
     """
+    page_count = 0
     try:
-        input_buffer = io.BytesIO(pdf_bytes)
+        input_buffer = as_stream(source)
+        input_size = input_buffer.seek(0, io.SEEK_END)
+        input_buffer.seek(0)
         reader = PyPDF2.PdfReader(input_buffer)
 
         # Check for encryption
@@ -157,14 +1540,14 @@ def validate_and_normalize_pdf(pdf_bytes, key):
             if decrypt_result == 0:
                 # Empty password failed — document is password protected
                 print(f"PDF {key} is password protected, cannot decrypt")
-                return None
+                return None, page_count
             print(f"PDF decrypted successfully: {key}")
 
         # Check the PDF has at least one page
         page_count = len(reader.pages)
         if page_count == 0:
             print(f"PDF {key} has no pages, skipping")
-            return None
+            return None, page_count
 
         print(f"PDF {key} has {page_count} page(s), normalizing...")
 
@@ -175,156 +1558,1121 @@ def validate_and_normalize_pdf(pdf_bytes, key):
         for page in reader.pages:
             writer.add_page(page)
 
+        if destination is not None:
+            writer.write(destination)
+            written = destination.tell()
+            print(f"Normalization complete: {key} ({input_size} → {written} bytes)")
+            return written, page_count
+
         # Write normalized PDF to a bytes buffer
         output_buffer = io.BytesIO()
         writer.write(output_buffer)
-        output_buffer.seek(0)
 
-        normalized_bytes = output_buffer.read()
-        print(f"Normalization complete: {key} ({len(pdf_bytes)} → {len(normalized_bytes)} bytes)")
+        normalized_bytes = output_buffer.getvalue()
+        print(f"Normalization complete: {key} ({input_size} → {len(normalized_bytes)} bytes)")
 
-        return normalized_bytes
+        return normalized_bytes, page_count
 
     except Exception as e:
         print(f"PDF normalization error for {key}: {str(e)}")
-        return None
+        return None, page_count
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Seekable, read-only file object backed by ranged reads.
+
+    Bytes are fetched in aligned blocks — plus `readahead` following
+    blocks in the same request — and kept in an LRU sized by
+    memory_budget, so PdfReader can consume a large remote PDF directly
+    while only the ranges it touches are downloaded.
+
+    fetch_range(start, end) must return (data, total_size) for the
+    inclusive byte range, like an HTTP 206 response with Content-Range.
+    """
+
+    def __init__(self, fetch_range, block_size=None, memory_budget=None, readahead=None):
+        super().__init__()
+        self.fetch_range = fetch_range
+        self.block_size = block_size or PDF_STREAM_BLOCK_SIZE
+        self.readahead = PDF_STREAM_READAHEAD if readahead is None else readahead
+        budget = memory_budget or PDF_STREAM_MEMORY_BUDGET
+        self.max_blocks = max(self.readahead + 1, budget // self.block_size)
+        self.blocks = OrderedDict()
+        self.size = None
+        self.position = 0
+        self.requests = 0
+        self.bytes_fetched = 0
+        self.block_hits = 0
+        self.block_misses = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self._total_size() + offset
+        else:
+            raise ValueError(f"invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"negative seek position {position}")
+        self.position = position
+        return position
+
+    def read(self, size=-1):
+        total = self._total_size()
+        end = total if size is None or size < 0 else min(total, self.position + size)
+        out = bytearray()
+        while self.position < end:
+            index = self.position // self.block_size
+            block = self._block(index)
+            start = self.position - index * self.block_size
+            piece = block[start:start + end - self.position]
+            if not piece:
+                break
+            out += piece
+            self.position += len(piece)
+        return bytes(out)
+
+    def readall(self):
+        return self.read(-1)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'bytes_fetched': self.bytes_fetched,
+            'requests': self.requests,
+            'block_hits': self.block_hits,
+            'block_misses': self.block_misses
+        }
+
+    def _total_size(self):
+        # The first response's Content-Range tells us the object size
+        if self.size is None:
+            self._load(0)
+        return self.size
+
+    def _block(self, index):
+        block = self.blocks.get(index)
+        if block is None:
+            self.block_misses += 1
+            self._load(index)
+            block = self.blocks.get(index, b'')
+        else:
+            self.block_hits += 1
+            self.blocks.move_to_end(index)
+        return block
+
+    def _load(self, index):
+        """Fetch block `index` and up to `readahead` uncached blocks after it in one request"""
+        last = index + self.readahead
+        if self.size is not None:
+            last = min(last, max(index, (self.size - 1) // self.block_size))
+        for following in range(index + 1, last + 1):
+            if following in self.blocks:
+                last = following - 1
+                break
+
+        start = index * self.block_size
+        data, self.size = self.fetch_range(start, (last + 1) * self.block_size - 1)
+        self.requests += 1
+        self.bytes_fetched += len(data)
+
+        for offset in range(0, len(data), self.block_size):
+            block_index = index + offset // self.block_size
+            self.blocks[block_index] = data[offset:offset + self.block_size]
+            self.blocks.move_to_end(block_index)
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+
+def s3_range_fetcher(bucket, key):
+    """Build a RangeReader fetch function backed by S3 ranged GetObject calls"""
+    def fetch_range(start, end):
+        response = s3_client.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end}')
+        total = int(response['ContentRange'].rsplit('/', 1)[1])
+        return response['Body'].read(), total
+    return fetch_range
+
+
+class S3MultipartWriter:
+    """
+    Write-only stream that uploads to S3 as a multipart upload.
+
+    Bytes are cut into MULTIPART_PART_SIZE parts as they are written and
+    up to MULTIPART_CONCURRENCY parts upload in the background, so at most
+    a few parts are ever resident. Outputs smaller than one part are sent
+    with a single PutObject on close. Leaving the `with` block with an
+    exception, or calling abort(), aborts the upload so no orphaned parts
+    are left behind.
+    """
+
+    def __init__(self, bucket, key, content_type='application/octet-stream',
+                 part_size=None, concurrency=None):
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.part_size = part_size or MULTIPART_PART_SIZE
+        self.concurrency = concurrency or MULTIPART_CONCURRENCY
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+        self.parts_uploaded = 0
+        self.executor = None
+        self.in_flight = threading.BoundedSemaphore(self.concurrency)
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed S3MultipartWriter')
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._submit_part(part)
+        return len(data)
+
+    def close(self):
+        """Flush the last part and complete the upload"""
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                s3_client.put_object(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    Body=bytes(self.buffer),
+                    ContentType=self.content_type
+                )
+                self.parts_uploaded = 1
+            else:
+                if self.buffer:
+                    self._submit_part(bytes(self.buffer))
+                parts = [future.result() for future in self.parts]
+                self.parts_uploaded = len(parts)
+                s3_client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self.upload_id,
+                    MultipartUpload={'Parts': parts}
+                )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._release()
+
+    def abort(self):
+        """Abandon the upload and discard any parts already sent"""
+        if self.closed:
+            return
+        self._release()
+        if self.upload_id is not None:
+            try:
+                s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+                print(f"Aborted multipart upload for {self.key}")
+            except Exception as e:
+                print(f"Failed to abort multipart upload for {self.key}: {str(e)}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+        return False
+
+    def _submit_part(self, part):
+        if self.upload_id is None:
+            response = s3_client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                ContentType=self.content_type
+            )
+            self.upload_id = response['UploadId']
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        # Blocks once `concurrency` parts are in flight, capping memory
+        self.in_flight.acquire()
+        part_number = len(self.parts) + 1
+        self.parts.append(self.executor.submit(self._upload_part, part_number, part))
+
+    def _upload_part(self, part_number, part):
+        try:
+            response = s3_client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=part_number,
+                Body=part
+            )
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self.in_flight.release()
+
+    def _release(self):
+        self.closed = True
+        self.buffer = bytearray()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
 
 
 # -------------------------------------------------------
-# UNCHANGED FROM PHASE 3 BELOW
+# Text extraction (local text layer, Textract) and Comprehend analysis
 # -------------------------------------------------------
 
-def extract_text_from_document(bucket, key):
+def extract_document(bucket, key, page_count=None, source=None):
     """
-    Extract text from document using AWS Textract
-    Supports both synchronous and asynchronous processing
+    Extract every page, reading text layers locally where they can be trusted.
+
+    With LOCAL_TEXT_EXTRACTION on, pages that PyPDF2 can read (see
+    has_text_layer) are taken as they are and only the remaining,
+    scanned-looking pages are sent to Textract. Every page record notes
+    the 'engine' that produced it. `source` is the PDF as preprocessing
+    opened it, reused instead of reading the object again.
     """
-    print(f"Starting Textract analysis on {key}")
+    local_pages = {}
+    if LOCAL_TEXT_EXTRACTION and page_count and key.lower().endswith('.pdf'):
+        with stage('local_text') as span:
+            local_pages = extract_local_text(bucket, key, source)
+            span.record(pages=len(local_pages))
+        if local_pages:
+            print(f"Warning: {len(local_pages)} page(s) of {key} read from the text layer "
+                  f"have no FORMS/TABLES analysis (LOCAL_TEXT_EXTRACTION is on)")
+
+    if local_pages and len(local_pages) >= page_count:
+        print(f"Text layer covers all {page_count} page(s) of {key}, skipping Textract")
+        extraction = {'pages': [], 'page_count': 0, 'extraction_confidence': 0, 'textract_mode': 'none'}
+    else:
+        remaining = None
+        if local_pages:
+            remaining = [number for number in range(1, page_count + 1) if number not in local_pages]
+            print(f"Text layer covers {len(local_pages)} of {page_count} page(s) of {key}, "
+                  f"sending {len(remaining)} to Textract")
+        with stage('textract') as span:
+            extraction = extract_text_from_document(bucket, key, page_count, remaining)
+            span.record(pages=extraction['page_count'],
+                        bytes_out=sum(len(line) for page in extraction['pages'] for line in page['lines']))
+
+    if local_pages:
+        pages = {page['page']: page for page in extraction['pages']}
+        for number, lines in local_pages.items():
+            pages[number] = {
+                'page': number, 'engine': 'pypdf2', 'lines': lines,
+                'key_value_pairs': {}, 'tables': [], 'confidence': None
+            }
+        extraction['pages'] = [pages[number] for number in sorted(pages)]
+        extraction['page_count'] = len(extraction['pages'])
+
+    engines = {}
+    for page in extraction['pages']:
+        engines[page['engine']] = engines.get(page['engine'], 0) + 1
+    extraction['engines'] = engines
+    return extraction
+
+
+def extract_local_text(bucket, key, source=None):
+    """
+    Read the text layer of every page with PyPDF2.
+
+    Reads `source` when given (bytes or a seekable stream that already
+    holds the PDF), otherwise the object through ranged GETs.
 
+    Returns {page_number: lines} for the pages whose text passes
+    has_text_layer(); a page that fails to parse is simply left for
+    Textract, and an unreadable PDF yields {}.
+    """
     try:
-        response = textract_client.analyze_document(
-            Document={
-                'S3Object': {
-                    'Bucket': bucket,
-                    'Name': key
-                }
-            },
-            FeatureTypes=['TABLES', 'FORMS']
-        )
+        if source is None:
+            source = RangeReader(s3_range_fetcher(bucket, key))
+        reader = PyPDF2.PdfReader(as_stream(source))
+        if reader.is_encrypted:
+            reader.decrypt('')
+        page_objects = list(reader.pages)
+    except Exception as e:
+        print(f"Local text extraction unavailable for {key}: {str(e)}")
+        return {}
+
+    local_pages = {}
+    budget = current_budget()
+    for number, page in enumerate(page_objects, start=1):
+        if budget.expired():
+            print(f"Time budget spent reading {key}, leaving pages {number}+ for Textract")
+            break
+        try:
+            text = page.extract_text()
+        except Exception as e:
+            print(f"Could not read text layer of {key} page {number}: {str(e)}")
+            continue
+        if has_text_layer(text):
+            local_pages[number] = [line.strip() for line in text.splitlines() if line.strip()]
+    return local_pages
+
+
+def has_text_layer(text):
+    """
+    Decide whether PyPDF2's text for one page can stand in for OCR.
 
-        full_text = []
-        key_value_pairs = {}
+    Scanned pages have no text layer, or only a few stray characters
+    (density check). Fonts without a usable ToUnicode map come out as
+    replacement characters, private-use glyphs or (cid:NN) placeholders
+    (glyph-mapping check), and garbage encodings are mostly symbols
+    (alphanumeric ratio check).
+    """
+    visible = len(text) - sum(1 for ch in text if ch.isspace())
+    if visible < LOCAL_TEXT_MIN_CHARS:
+        return False
 
-        for block in response['Blocks']:
-            if block['BlockType'] == 'LINE':
-                full_text.append(block['Text'])
+    unmapped = sum(len(match) for match in UNMAPPED_GLYPH.findall(text))
+    if unmapped / visible > LOCAL_TEXT_MAX_UNMAPPED:
+        return False
 
-            elif block['BlockType'] == 'KEY_VALUE_SET':
-                if 'KEY' in block.get('EntityTypes', []):
-                    key_text = extract_text_from_relationship(block, response['Blocks'])
-                    value_text = extract_value_text(block, response['Blocks'])
-                    if key_text and value_text:
-                        key_value_pairs[key_text] = value_text
+    alnum = sum(1 for ch in text if ch.isalnum())
+    return alnum / visible >= LOCAL_TEXT_MIN_ALNUM
 
-        return {
-            'full_text': ' '.join(full_text),
-            'key_value_pairs': key_value_pairs,
-            'page_count': len(set(b.get('Page', 1) for b in response['Blocks'])),
-            'extraction_confidence': calculate_average_confidence(response['Blocks'])
-        }
+
+def extract_text_from_document(bucket, key, page_count=None, pages=None):
+    """
+    Extract text from document using AWS Textract
+    Supports both synchronous and asynchronous processing
+
+    Synchronous AnalyzeDocument only accepts single-page documents, so any
+    PDF that preprocessing found to have more than SYNC_PAGE_LIMIT pages
+    goes through StartDocumentAnalysis instead. PDFs over
+    SHARD_THRESHOLD_PAGES are split into shards analyzed in parallel.
+    Either way the blocks are fed one at a time into a TextractAccumulator.
+
+    `pages` restricts the analysis to those 1-based page numbers (the rest
+    were read locally); they are cut into their own PDF first so Textract
+    only bills for them.
+    """
+    if pages is not None:
+        result = extract_text_from_shards(bucket, key, pages)
+        if result is not None:
+            return result
+    elif SHARD_THRESHOLD_PAGES and page_count and page_count > SHARD_THRESHOLD_PAGES:
+        result = extract_text_from_shards(bucket, key, list(range(1, page_count + 1)))
+        if result is not None:
+            return result
+
+    use_async = bool(page_count) and page_count > SYNC_PAGE_LIMIT
+    mode = 'async' if use_async else 'sync'
+    print(f"Starting Textract analysis on {key} ({mode}, pages: {page_count or 'unknown'})")
+
+    try:
+        accumulator = TextractAccumulator()
+        for block in iter_document_blocks(bucket, key, use_async):
+            accumulator.add(block)
+
+        result = accumulator.result()
+        result['textract_mode'] = mode
+        current_metrics().current().record(blocks=accumulator.block_count)
+        return result
 
     except Exception as e:
         print(f"Textract error: {str(e)}")
         return {
-            'full_text': '',
-            'key_value_pairs': {},
+            'pages': [],
             'page_count': 0,
+            'textract_mode': mode,
             'error': str(e)
         }
 
 
-def extract_text_from_relationship(block, all_blocks):
-    """Helper to extract text from relationships"""
-    text = []
-    if 'Relationships' in block:
-        for relationship in block['Relationships']:
-            if relationship['Type'] == 'CHILD':
-                for child_id in relationship['Ids']:
-                    child = next((b for b in all_blocks if b['Id'] == child_id), None)
-                    if child and child['BlockType'] == 'WORD':
-                        text.append(child['Text'])
-    return ' '.join(text)
-
-
-def extract_value_text(key_block, all_blocks):
-    """Helper to extract value associated with key"""
-    if 'Relationships' in key_block:
-        for relationship in key_block['Relationships']:
-            if relationship['Type'] == 'VALUE':
-                for value_id in relationship['Ids']:
-                    value_block = next((b for b in all_blocks if b['Id'] == value_id), None)
-                    if value_block:
-                        return extract_text_from_relationship(value_block, all_blocks)
-    return None
+def iter_document_blocks(bucket, key, use_async):
+    """Return the Textract blocks for one S3 object, from the async or sync API"""
+    if use_async:
+        return iter_async_analysis_blocks(bucket, key)
 
+    response = textract_client.analyze_document(
+        Document={
+            'S3Object': {
+                'Bucket': bucket,
+                'Name': key
+            }
+        },
+        FeatureTypes=TEXTRACT_FEATURES
+    )
+    record_retries(response)
+    return response['Blocks']
 
-def calculate_average_confidence(blocks):
-    """Calculate average confidence score from Textract blocks"""
-    confidences = [block.get('Confidence', 0) for block in blocks if 'Confidence' in block]
-    return round(sum(confidences) / len(confidences), 2) if confidences else 0
 
+def extract_text_from_shards(bucket, key, pages):
+    """
+    Analyze the given pages of a PDF as shards running in parallel.
+
+    Textract works through one async job's pages in sequence, so a
+    300-page scan is one long wait. Splitting it into SHARD_PAGES-page
+    PDFs lets up to SHARD_CONCURRENCY jobs run side by side. Shard blocks
+    are rebased onto document page numbers and the per-shard accumulators
+    are merged back in page order, so the result looks exactly like a
+    single-job extraction.
+
+    Returns None when the PDF can't be split, so the caller falls back to
+    one job over the whole document. A failed shard doesn't discard the
+    others — its pages are reported in 'error' instead. The shard PDFs are
+    deleted once every job has finished.
+    """
+    try:
+        with stage('shard') as span:
+            shards = split_pdf(bucket, key, pages)
+            span.record(shards=len(shards))
+    except Exception as e:
+        print(f"Could not shard {key}: {str(e)}, analyzing it as one document")
+        return None
 
-def analyze_text(text):
+    if len(shards) > 1:
+        mode = 'sharded'
+    else:
+        mode = 'async' if len(pages) > SYNC_PAGE_LIMIT else 'sync'
+    print(f"Starting Textract analysis on {key} ({mode}, {len(shards)} shard(s), pages: {len(pages)})")
+
+    workers = max(1, min(SHARD_CONCURRENCY, len(shards)))
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            budget = current_budget()
+            futures = [
+                executor.submit(run_with_budget, budget, analyze_shard, bucket, shard_key, page_numbers)
+                for shard_key, page_numbers in shards
+            ]
+    finally:
+        delete_shards(bucket, shards)
+
+    accumulator = TextractAccumulator()
+    errors = []
+    for (shard_key, page_numbers), future in zip(shards, futures):
+        try:
+            accumulator.merge(future.result())
+        except Exception as e:
+            print(f"Textract error on {shard_key}: {str(e)}")
+            errors.append(f"pages {format_pages(page_numbers)}: {str(e)}")
+
+    result = accumulator.result()
+    result['textract_mode'] = mode
+    result['shards'] = len(shards)
+    if errors:
+        result['error'] = '; '.join(errors)
+    current_metrics().current().record(blocks=accumulator.block_count, shards=len(shards))
+    return result
+
+
+def split_pdf(bucket, key, pages, shard_pages=None):
     """
-    Analyze text using AWS Comprehend
-    Extracts entities, sentiment, and key phrases
+    Write the given pages of a PDF to S3 objects of `shard_pages` pages each.
+
+    The source is read through ranged GETs and each shard streams into its
+    own upload, so only one shard's pages are handled at a time.
+
+    Returns [(shard_key, page_numbers)] with the 1-based document page
+    number of every page in the shard, in shard order. Shard keys are
+    preprocessed/shards/<name>-<run id>/pages-<first>-<last>.pdf.
     """
-    if not text or len(text.strip()) < 3:
-        return {'error': 'Text too short for analysis'}
+    shard_pages = shard_pages or SHARD_PAGES
+    reader = PyPDF2.PdfReader(RangeReader(s3_range_fetcher(bucket, key)))
+    if reader.is_encrypted:
+        reader.decrypt('')
+    pages = [number for number in pages if 1 <= number <= len(reader.pages)]
+
+    # Each split gets its own prefix, so documents sharing a file name (or a
+    # re-upload while the first is in flight) never overwrite or delete
+    # each other's shards
+    name = key.split('/')[-1].rsplit('.', 1)[0]
+    prefix = f"preprocessed/shards/{name}-{uuid.uuid4().hex[:12]}"
+    shards = []
+    try:
+        for start in range(0, len(pages), shard_pages):
+            page_numbers = pages[start:start + shard_pages]
+            writer = PyPDF2.PdfWriter()
+            for number in page_numbers:
+                writer.add_page(reader.pages[number - 1])
+
+            shard_key = f"{prefix}/pages-{page_numbers[0]:05d}-{page_numbers[-1]:05d}.pdf"
+            with S3MultipartWriter(bucket, shard_key, content_type='application/pdf') as upload:
+                writer.write(upload)
+            shards.append((shard_key, page_numbers))
+    except Exception:
+        delete_shards(bucket, shards)
+        raise
+
+    return shards
 
-    text = text[:5000]
-    results = {}
 
+def delete_shards(bucket, shards):
+    """
+    Remove shard PDFs once Textract is done with them. A failed delete is
+    logged rather than raised — it only leaves objects behind.
+    """
+    objects = [{'Key': shard_key} for shard_key, _ in shards]
     try:
-        entities_response = comprehend_client.detect_entities(
-            Text=text,
-            LanguageCode='en'
-        )
-        results['entities'] = [
-            {
-                'text': e['Text'],
-                'type': e['Type'],
-                'score': round(e['Score'], 2)
+        for start in range(0, len(objects), 1000):  # DeleteObjects takes at most 1,000 keys
+            response = s3_client.delete_objects(
+                Bucket=bucket, Delete={'Objects': objects[start:start + 1000], 'Quiet': True}
+            )
+            for error in response.get('Errors', ()):
+                print(f"Could not delete shard {error.get('Key')}: {error.get('Code')}")
+    except Exception as e:
+        print(f"Could not delete shards of {bucket}: {str(e)}")
+
+
+def run_with_budget(budget, function, *args):
+    """Call `function` on a pool thread under the submitting document's budget"""
+    with use_budget(budget):
+        return function(*args)
+
+
+def analyze_shard(bucket, shard_key, page_numbers):
+    """Run Textract on one shard and map its blocks back onto document page numbers"""
+    accumulator = TextractAccumulator()
+    for block in iter_document_blocks(bucket, shard_key, len(page_numbers) > SYNC_PAGE_LIMIT):
+        block['Page'] = page_numbers[block.get('Page', 1) - 1]
+        accumulator.add(block)
+    return accumulator
+
+
+def format_pages(page_numbers):
+    """'4-6' for a contiguous run of pages, '2, 5, 7' otherwise"""
+    if page_numbers == list(range(page_numbers[0], page_numbers[-1] + 1)):
+        return f"{page_numbers[0]}-{page_numbers[-1]}"
+    return ', '.join(str(number) for number in page_numbers)
+
+
+def iter_async_analysis_blocks(bucket, key):
+    """
+    Run an asynchronous Textract job and yield its blocks page by page.
+
+    Results are paginated (up to 1,000 blocks per GetDocumentAnalysis
+    call), so only one page of blocks is held here at a time.
+    """
+    job = textract_client.start_document_analysis(
+        DocumentLocation={
+            'S3Object': {
+                'Bucket': bucket,
+                'Name': key
             }
-            for e in entities_response['Entities']
-        ]
+        },
+        FeatureTypes=TEXTRACT_FEATURES
+    )
+    job_id = job['JobId']
+    print(f"Started Textract job {job_id} for {key}")
 
-        sentiment_response = comprehend_client.detect_sentiment(
-            Text=text,
-            LanguageCode='en'
-        )
-        results['sentiment'] = {
-            'overall': sentiment_response['Sentiment'],
-            'scores': {
-                k: round(v, 2)
-                for k, v in sentiment_response['SentimentScore'].items()
+    response = wait_for_analysis(job_id)
+
+    while True:
+        yield from response.get('Blocks', [])
+
+        next_token = response.get('NextToken')
+        if not next_token:
+            break
+        response = textract_client.get_document_analysis(JobId=job_id, NextToken=next_token)
+        record_retries(response)
+
+
+def wait_for_analysis(job_id):
+    """
+    Poll an async Textract job with exponential backoff until it finishes.
+
+    Returns the first page of results so it doesn't have to be fetched twice.
+    """
+    delay = TEXTRACT_POLL_INITIAL_DELAY
+    timeout = min(TEXTRACT_ASYNC_TIMEOUT, current_budget().remaining())
+    deadline = time.monotonic() + timeout
+
+    while True:
+        response = textract_client.get_document_analysis(JobId=job_id)
+        record_retries(response)
+        status = response['JobStatus']
+
+        if status == 'SUCCEEDED':
+            return response
+        if status == 'PARTIAL_SUCCESS':
+            print(f"Textract job {job_id} partially succeeded: {response.get('StatusMessage', '')}")
+            return response
+        if status == 'FAILED':
+            raise Exception(f"Textract job {job_id} failed: {response.get('StatusMessage', 'unknown error')}")
+
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(f"Textract job {job_id} still {status} after {timeout:.0f}s")
+
+        time.sleep(delay)
+        # Full-range jitter keeps many concurrent jobs from polling in lockstep
+        delay = min(delay * 2, TEXTRACT_POLL_MAX_DELAY) * random.uniform(0.5, 1.0)
+
+
+class TextractAccumulator:
+    """
+    Build the page-structured extraction result from a stream of Textract blocks.
+
+    Lines and confidence are accumulated per page as blocks arrive. Only
+    the block types that relationships point at are kept in the index, and
+    KEY and TABLE blocks are resolved at the end because their children may
+    arrive on a later results page.
+    """
+
+    INDEXED_TYPES = {'WORD', 'KEY_VALUE_SET', 'SELECTION_ELEMENT', 'CELL', 'MERGED_CELL'}
+
+    def __init__(self):
+        self.index = BlockIndex()
+        self.pages = {}
+        self.block_count = 0
+        self.confidence_total = 0.0
+        self.confidence_count = 0
+
+    def page(self, number):
+        page = self.pages.get(number)
+        if page is None:
+            page = self.pages[number] = {
+                'lines': [], 'key_blocks': [], 'table_blocks': [],
+                'confidence_total': 0.0, 'confidence_count': 0
             }
+        return page
+
+    def add(self, block):
+        block_type = block['BlockType']
+        self.block_count += 1
+        page = self.page(block.get('Page', 1))
+
+        if 'Confidence' in block:
+            self.confidence_total += block['Confidence']
+            self.confidence_count += 1
+            page['confidence_total'] += block['Confidence']
+            page['confidence_count'] += 1
+
+        if block_type == 'LINE':
+            page['lines'].append(block['Text'])
+        elif block_type == 'KEY_VALUE_SET' and 'KEY' in block.get('EntityTypes', []):
+            page['key_blocks'].append(block)
+        elif block_type == 'TABLE':
+            page['table_blocks'].append(block)
+
+        if block_type in self.INDEXED_TYPES:
+            self.index.add(block)
+
+    def merge(self, other):
+        """Append another accumulator's blocks, e.g. the next shard of the same document"""
+        self.index.merge(other.index)
+        for number, other_page in other.pages.items():
+            page = self.page(number)
+            page['lines'].extend(other_page['lines'])
+            page['key_blocks'].extend(other_page['key_blocks'])
+            page['table_blocks'].extend(other_page['table_blocks'])
+            page['confidence_total'] += other_page['confidence_total']
+            page['confidence_count'] += other_page['confidence_count']
+        self.block_count += other.block_count
+        self.confidence_total += other.confidence_total
+        self.confidence_count += other.confidence_count
+
+    def result(self):
+        pages = []
+        for number in sorted(self.pages):
+            page = self.pages[number]
+            key_value_pairs = {}
+            for block in page['key_blocks']:
+                key_text = extract_text_from_relationship(block, self.index)
+                value_text = extract_value_text(block, self.index)
+                if key_text and value_text:
+                    key_value_pairs[key_text] = value_text
+
+            pages.append({
+                'page': number,
+                'engine': 'textract',
+                'lines': page['lines'],
+                'key_value_pairs': key_value_pairs,
+                'tables': [extract_table(block, self.index) for block in page['table_blocks']],
+                'confidence': average_confidence(page['confidence_total'], page['confidence_count'])
+            })
+
+        return {
+            'pages': pages,
+            'page_count': len(pages),
+            'extraction_confidence': average_confidence(self.confidence_total, self.confidence_count)
         }
 
-        phrases_response = comprehend_client.detect_key_phrases(
-            Text=text,
-            LanguageCode='en'
-        )
-        results['key_phrases'] = [
-            {
-                'text': p['Text'],
-                'score': round(p['Score'], 2)
-            }
-            for p in phrases_response['KeyPhrases'][:10]
-        ]
 
-    except Exception as e:
-        results['error'] = str(e)
-        print(f"Comprehend error: {str(e)}")
+def average_confidence(total, count):
+    return round(total / count, 2) if count else 0
+
+
+def extraction_text(extraction):
+    """
+    Flat document text, joined from the page records only when needed.
+
+    Results no longer store a document-wide full_text string; consumers
+    that want one (Comprehend, reporting) derive it here.
+    """
+    return ' '.join(line for page in extraction.get('pages', ()) for line in page['lines'])
+
+
+def extraction_key_values(extraction):
+    """Key/value pairs of every page merged into one dict (later pages win)"""
+    merged = {}
+    for page in extraction.get('pages', ()):
+        merged.update(page['key_value_pairs'])
+    return merged
+
+
+class BlockIndex:
+    """
+    One-pass index over a Textract block list.
+
+    Textract relationships reference blocks by Id, so resolving a KEY's
+    words with a linear scan per child is O(words x blocks). Building the
+    index once makes every lookup O(1) and gives the parsing helpers
+    shared per-page and per-type buckets (in document order).
+    """
+
+    def __init__(self, blocks=()):
+        self.by_id = {}
+        self.by_page = {}
+        self.by_type = {}
+        for block in blocks:
+            self.add(block)
+
+    def add(self, block):
+        self.by_id[block['Id']] = block
+        self.by_page.setdefault(block.get('Page', 1), []).append(block)
+        self.by_type.setdefault(block['BlockType'], []).append(block)
+
+    def merge(self, other):
+        """Append every block of `other`, keeping bucket order"""
+        self.by_id.update(other.by_id)
+        for page, blocks in other.by_page.items():
+            self.by_page.setdefault(page, []).extend(blocks)
+        for block_type, blocks in other.by_type.items():
+            self.by_type.setdefault(block_type, []).extend(blocks)
+
+    def get(self, block_id):
+        return self.by_id.get(block_id)
+
+    def of_type(self, block_type):
+        return self.by_type.get(block_type, [])
+
+    def on_page(self, page):
+        return self.by_page.get(page, [])
+
+    def related(self, block, relationship_type):
+        """Yield the blocks linked to `block` by the given relationship type"""
+        for relationship in block.get('Relationships', []):
+            if relationship['Type'] == relationship_type:
+                for related_id in relationship['Ids']:
+                    related_block = self.by_id.get(related_id)
+                    if related_block is not None:
+                        yield related_block
+
+    @property
+    def page_count(self):
+        return len(self.by_page)
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+def extract_text_from_relationship(block, index):
+    """Helper to extract text from relationships"""
+    return ' '.join(
+        child['Text'] for child in index.related(block, 'CHILD')
+        if child['BlockType'] == 'WORD'
+    )
+
+
+def extract_value_text(key_block, index):
+    """Helper to extract value associated with key"""
+    for value_block in index.related(key_block, 'VALUE'):
+        return extract_text_from_relationship(value_block, index)
+    return None
+
+
+def extract_table(table_block, index):
+    """
+    Rebuild one TABLE block as a row/column grid of cell text.
+
+    Cells are placed by their RowIndex/ColumnIndex in a single pass over
+    the table's CHILD relationships, and every lookup goes through the
+    block index, so the work is linear in the number of cells and words.
+    A MERGED_CELL (or a CELL that spans several positions) puts its text
+    in its top-left position and leaves the positions it covers empty;
+    its 1-based position and spans are listed under 'merged'.
+    """
+    cells = [cell for cell in index.related(table_block, 'CHILD') if cell['BlockType'] == 'CELL']
+    rows = max((cell['RowIndex'] + cell.get('RowSpan', 1) - 1 for cell in cells), default=0)
+    columns = max((cell['ColumnIndex'] + cell.get('ColumnSpan', 1) - 1 for cell in cells), default=0)
+
+    grid = [[''] * columns for _ in range(rows)]
+    header_rows = set()
+    for cell in cells:
+        grid[cell['RowIndex'] - 1][cell['ColumnIndex'] - 1] = extract_text_from_relationship(cell, index)
+        if 'COLUMN_HEADER' in cell.get('EntityTypes', []):
+            header_rows.add(cell['RowIndex'])
+
+    spanning = [cell for cell in cells if cell.get('RowSpan', 1) > 1 or cell.get('ColumnSpan', 1) > 1]
+    spanning.extend(index.related(table_block, 'MERGED_CELL'))
+    merged = []
+    for block in spanning:
+        row, column = block['RowIndex'] - 1, block['ColumnIndex'] - 1
+        row_span, column_span = block.get('RowSpan', 1), block.get('ColumnSpan', 1)
+        covered = [(r, c) for r in range(row, min(row + row_span, rows))
+                   for c in range(column, min(column + column_span, columns))]
+        text = ' '.join(grid[r][c] for r, c in covered if grid[r][c])
+        for r, c in covered:
+            grid[r][c] = ''
+        grid[row][column] = text
+        merged.append({'row': row + 1, 'column': column + 1, 'row_span': row_span, 'column_span': column_span})
+
+    return {
+        'rows': rows,
+        'columns': columns,
+        'cells': grid,
+        'header_rows': sorted(header_rows),
+        'merged': merged,
+        'confidence': round(table_block.get('Confidence', 0), 2)
+    }
+
+
+def analyze_text(text, mode=None):
+    """
+    Analyze text using AWS Comprehend
+    Extracts entities, sentiment, and key phrases
+
+    Single-document convenience wrapper around analyze_texts_batch.
+    """
+    return analyze_texts_batch([text], mode)[0]
+
 
-    return results
\ No newline at end of file
+def analyze_texts_batch(texts, mode=None):
+    """
+    Analyze many documents with the Comprehend BatchDetect* APIs.
+
+    In 'full' mode each text is cut into UTF-8 chunks under Comprehend's
+    byte limit and every chunk is analyzed; in 'truncate' mode only the
+    first chunk-sized prefix is (cheaper, but ignores the rest of long
+    documents). Chunks from all documents are grouped 25 at a time (the
+    batch API limit) and the entity, sentiment and key phrase batches run
+    concurrently.
+
+    Returns one analysis dict per input text, in order. Entity offsets are
+    rebased onto the full text, key phrases are deduplicated and sentiment
+    is the length-weighted average over chunks. Per-item and per-call
+    failures land in that document's 'error'.
+    """
+    mode = mode or COMPREHEND_MODE
+    results = [{} for _ in texts]
+
+    # Flatten every document into (document index, char offset, chunk)
+    segments = []
+    for i, text in enumerate(texts):
+        if not text or len(text.strip()) < 3:
+            results[i] = {'error': 'Text too short for analysis'}
+        elif mode == 'truncate':
+            segments.append((i, 0, truncate_to_bytes(text, COMPREHEND_MAX_BYTES)))
+        else:
+            segments.extend((i, offset, chunk) for offset, chunk in chunk_text(text))
+
+    if not segments:
+        return results
+
+    features = {
+        'entities': comprehend_client.batch_detect_entities,
+        'sentiment': comprehend_client.batch_detect_sentiment,
+        'key_phrases': comprehend_client.batch_detect_key_phrases,
+    }
+    segment_results = [{} for _ in segments]
+
+    with ThreadPoolExecutor(max_workers=COMPREHEND_WORKERS) as executor:
+        futures = []
+        for start in range(0, len(segments), COMPREHEND_BATCH_SIZE):
+            batch = list(range(start, min(start + COMPREHEND_BATCH_SIZE, len(segments))))
+            batch_texts = [segments[j][2] for j in batch]
+            for name, call in features.items():
+                future = executor.submit(call, TextList=batch_texts, LanguageCode='en')
+                futures.append((future, batch, name))
+
+        for future, batch, name in futures:
+            try:
+                response = future.result()
+            except Exception as e:
+                print(f"Comprehend {name} batch error: {str(e)}")
+                for doc in sorted({segments[j][0] for j in batch}):
+                    add_analysis_error(results[doc], name, str(e))
+                continue
+
+            # Index is the position within this batch's TextList
+            for item in response.get('ResultList', []):
+                segment_results[batch[item['Index']]][name] = item
+            for error in response.get('ErrorList', []):
+                message = f"{error.get('ErrorCode')}: {error.get('ErrorMessage')}"
+                add_analysis_error(results[segments[batch[error['Index']]][0]], name, message)
+
+    by_document = {}
+    for segment, segment_result in zip(segments, segment_results):
+        by_document.setdefault(segment[0], []).append((segment[1], segment[2], segment_result))
+
+    for doc, parts in by_document.items():
+        merge_chunk_analyses(results[doc], parts)
+
+    return results
+
+
+def merge_chunk_analyses(analysis, parts):
+    """Fold per-chunk Comprehend results (offset, chunk, result) into one analysis"""
+    entities = []
+    phrases = {}
+    weighted_scores = {}
+    sentiment_weight = 0
+
+    for offset, chunk, result in parts:
+        if 'entities' in result:
+            entities.extend(format_entities(result['entities']['Entities'], offset))
+
+        if 'key_phrases' in result:
+            for phrase in format_key_phrases(result['key_phrases']['KeyPhrases']):
+                # Same phrase in several chunks: keep the first, best score
+                seen = phrases.setdefault(phrase['text'].lower(), phrase)
+                seen['score'] = max(seen['score'], phrase['score'])
+
+        if 'sentiment' in result:
+            weight = len(chunk)
+            sentiment_weight += weight
+            for label, score in result['sentiment']['SentimentScore'].items():
+                weighted_scores[label] = weighted_scores.get(label, 0) + score * weight
+
+    if any('entities' in result for _, _, result in parts):
+        analysis['entities'] = entities
+    if sentiment_weight:
+        scores = {label: total / sentiment_weight for label, total in weighted_scores.items()}
+        analysis['sentiment'] = format_sentiment({
+            'Sentiment': max(scores, key=scores.get).upper(),
+            'SentimentScore': scores
+        })
+    if any('key_phrases' in result for _, _, result in parts):
+        analysis['key_phrases'] = list(phrases.values())[:10]
+
+
+def chunk_text(text, max_bytes=None):
+    """
+    Split text into (char offset, chunk) pieces of at most max_bytes UTF-8.
+
+    Cuts at sentence or line boundaries where possible, then at
+    whitespace, and only splits inside a word when a single word is over
+    the limit. Offsets index into the original string so entity offsets
+    can be rebased; whitespace-only chunks are dropped.
+    """
+    max_bytes = max_bytes or COMPREHEND_MAX_BYTES
+    chunks = []
+    current = []
+    current_bytes = 0
+    current_offset = 0
+    position = 0
+
+    for piece in _split_keeping_separators(text, SENTENCE_BOUNDARY):
+        for part in _fit_piece(piece, max_bytes):
+            part_bytes = len(part.encode('utf-8'))
+            if current and current_bytes + part_bytes > max_bytes:
+                chunks.append((current_offset, ''.join(current)))
+                current, current_bytes = [], 0
+            if not current:
+                current_offset = position
+            current.append(part)
+            current_bytes += part_bytes
+            position += len(part)
+
+    if current:
+        chunks.append((current_offset, ''.join(current)))
+
+    return [(offset, chunk) for offset, chunk in chunks if chunk.strip()]
+
+
+def _split_keeping_separators(text, pattern):
+    """Split text after each match of pattern; the pieces join back to text"""
+    pieces = []
+    start = 0
+    for match in pattern.finditer(text):
+        if match.end() > start:
+            pieces.append(text[start:match.end()])
+            start = match.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+
+def _fit_piece(piece, max_bytes):
+    """Break one sentence into parts that each fit in max_bytes"""
+    if len(piece.encode('utf-8')) <= max_bytes:
+        return [piece]
+    parts = []
+    for word in _split_keeping_separators(piece, WORD_BOUNDARY):
+        while len(word.encode('utf-8')) > max_bytes:
+            head = truncate_to_bytes(word, max_bytes)
+            parts.append(head)
+            word = word[len(head):]
+        if word:
+            parts.append(word)
+    return parts
+
+
+def truncate_to_bytes(text, max_bytes):
+    """Longest prefix of text whose UTF-8 encoding fits in max_bytes"""
+    return text.encode('utf-8')[:max_bytes].decode('utf-8', errors='ignore')
+
+
+def add_analysis_error(analysis, feature, message):
+    """Record a per-feature Comprehend failure on one document's analysis"""
+    error = f"{feature}: {message}"
+    analysis['error'] = f"{analysis['error']}; {error}" if 'error' in analysis else error
+
+
+def format_entities(entities, offset=0):
+    return [
+        {
+            'text': e['Text'],
+            'type': e['Type'],
+            'score': round(e['Score'], 2),
+            'begin_offset': e['BeginOffset'] + offset,
+            'end_offset': e['EndOffset'] + offset
+        }
+        for e in entities
+    ]
+
+
+def format_sentiment(sentiment_response):
+    return {
+        'overall': sentiment_response['Sentiment'],
+        'scores': {
+            k: round(v, 2)
+            for k, v in sentiment_response['SentimentScore'].items()
+        }
+    }
+
+
+def format_key_phrases(phrases):
+    return [
+        {
+            'text': p['Text'],
+            'score': round(p['Score'], 2)
+        }
+        for p in phrases
+    ]
@@ -1,142 +1,1016 @@
+import io
+import csv
 import json
 import boto3
 import os
+import re
+import gzip
+import shutil
+import tempfile
+import time
+import hashlib
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 
-# Initialize AWS clients
-tagging_client = boto3.client('resourcegroupstaggingapi')
 sns_client = boto3.client('sns')
+s3_client = boto3.client('s3')
 
 # Environment variables
 SNS_TOPIC_ARN = os.environ['SNS_TOPIC_ARN']
 REQUIRED_TAGS = ['Project', 'CostCenter', 'Environment','CreatedDate', 'ManagedBy']
 
+# Tag policy: config/tag-policy.json, packaged next to this file or read from
+# the repo's config/ directory. Without one the audit only checks REQUIRED_TAGS
+TAG_POLICY_PATH = os.environ.get('TAG_POLICY_PATH', '')
+TAG_POLICY_CANDIDATES = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tag-policy.json'),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'config', 'tag-policy.json'),
+]
+
+# Regions audited side by side (defaults to the function's own region)
+AUDIT_REGIONS = [
+    region.strip()
+    for region in os.environ.get('AUDIT_REGIONS', os.environ.get('AWS_REGION', 'us-east-1')).split(',')
+    if region.strip()
+]
+AUDIT_MAX_WORKERS = int(os.environ.get('AUDIT_MAX_WORKERS', '8'))
+
+# Audit plan. AUDIT_RESOURCE_TYPES ('s3,lambda:function,ec2:instance', in
+# ResourceTypeFilters syntax) scopes get_resources server-side and splits
+# each region into one shard per service; empty audits every type in one
+# shard. Exempt types are dropped from the filters, or skipped as they
+# stream past when they cannot be (e.g. 'ec2' with 'ec2:vpc' exempt).
+# Nothing is exempt by default: a type listed here drops out of the audit
+# entirely, the project's own resources of that type included.
+AUDIT_RESOURCE_TYPES = [t.strip() for t in os.environ.get('AUDIT_RESOURCE_TYPES', '').split(',') if t.strip()]
+EXEMPT_RESOURCE_TYPES = {
+    t.strip()
+    for t in os.environ.get('EXEMPT_RESOURCE_TYPES', '').split(',')
+    if t.strip()
+}
+# Optional TagFilters, e.g. [{"Key": "Environment", "Values": ["prod"]}].
+# They only match resources that carry the tag, so they narrow the scope of
+# an audit; they cannot select the resources missing a tag
+AUDIT_TAG_FILTERS = json.loads(os.environ.get('AUDIT_TAG_FILTERS', '[]'))
+# ResourceTypeFilters accepts at most 100 entries per request
+MAX_TYPE_FILTERS = 100
+# get_resources returns at most 100 mappings per page
+RESOURCES_PER_PAGE = 100
+# Non-compliant resources kept per type for the report; everything else is
+# only counted, so memory stays flat however large the account is
+REPORT_SAMPLES_PER_TYPE = 5
+# Time kept back from the Lambda deadline for the report and SNS publish
+LAMBDA_RESERVE_SECONDS = 30
+
+# Incremental audits keep a snapshot of ARN -> tag-set hash and compliance
+# between runs and report only what changed since the last one: 'file'
+# (AUDIT_SNAPSHOT_PATH), 's3' (AUDIT_SNAPSHOT_BUCKET/KEY) or 'none'
+# The s3 backend needs s3:GetObject and s3:PutObject on the key, and
+# s3:ListBucket so the first run sees NoSuchKey rather than AccessDenied
+AUDIT_SNAPSHOT_BACKEND = os.environ.get('AUDIT_SNAPSHOT_BACKEND', 'none').lower()
+AUDIT_SNAPSHOT_PATH = os.environ.get('AUDIT_SNAPSHOT_PATH', '/tmp/tag-audit-snapshot.json.gz')
+AUDIT_SNAPSHOT_BUCKET = os.environ.get('AUDIT_SNAPSHOT_BUCKET', '')
+AUDIT_SNAPSHOT_KEY = os.environ.get('AUDIT_SNAPSHOT_KEY', 'tag-audit/snapshot.json.gz')
+SNAPSHOT_WRITE_ATTEMPTS = 3
+# Incremental runs with no changes skip the SNS email unless this is set
+NOTIFY_UNCHANGED = os.environ.get('NOTIFY_UNCHANGED', 'false').lower() == 'true'
+# Changed resources listed per kind in an incremental report
+REPORT_DELTA_LIMIT = 50
+DELTA_KINDS = ('newly_non_compliant', 'newly_fixed', 'deleted')
+
+# SNS rejects messages over 256 KB. The emailed report is cut to fit this
+# budget; with AUDIT_REPORT_BUCKET set the full report (text, a CSV of every
+# non-compliant resource and the JSON summary) goes to S3 and the email
+# carries only the summary and links to it.
+SNS_MESSAGE_BUDGET = int(os.environ.get('SNS_MESSAGE_BUDGET', str(240 * 1024)))
+AUDIT_REPORT_BUCKET = os.environ.get('AUDIT_REPORT_BUCKET', '')
+AUDIT_REPORT_PREFIX = os.environ.get('AUDIT_REPORT_PREFIX', 'tag-audit/reports/')
+REPORT_LINK_EXPIRY = int(os.environ.get('REPORT_LINK_EXPIRY', str(7 * 24 * 3600)))
+
+# One tagging client per region, created on the handler thread (boto3
+# client creation is not thread-safe; the clients themselves are)
+tagging_clients = {}
+_clients_lock = threading.Lock()
+
+
 def lambda_handler(event, context):
     """
     Audit all AWS resources for required tags
     Send email report via SNS
+
+    The event may narrow the audit so shards can be scheduled on their own,
+    e.g. {"regions": ["eu-west-1"], "resource_types": ["s3"]}.
     """
-    print(f"Starting tag audit at {datetime.now().isoformat()}")
-    
-    # Get all resources with pagination
-    all_resources = []
-    paginator = tagging_client.get_paginator('get_resources')
-    
-    for page in paginator.paginate():
-        all_resources.extend(page['ResourceTagMappingList'])
-    
-    print(f"Found {len(all_resources)} total resources")
-    
-    # Check each resource for missing tags
-    non_compliant_resources = []
-    
-    for resource in all_resources:
-        resource_arn = resource['ResourceARN']
-        existing_tags = {tag['Key']: tag['Value'] for tag in resource.get('Tags', [])}
-        
-        missing_tags = []
-        for required_tag in REQUIRED_TAGS:
-            if required_tag not in existing_tags:
-                missing_tags.append(required_tag)
-        
-        if missing_tags:
-            non_compliant_resources.append({
-                'arn': resource_arn,
-                'type': extract_resource_type(resource_arn),
-                'missing_tags': missing_tags,
-                'existing_tags': existing_tags
-            })
-    
-    # Generate report
-    report = generate_report(all_resources, non_compliant_resources)
-    
-    # Send via SNS
-    send_notification(report)
-    
+    event = event or {}
+    regions = event.get('regions') or AUDIT_REGIONS
+    resource_types = event.get('resource_types') or AUDIT_RESOURCE_TYPES
+    plan = build_audit_plan(regions, resource_types)
+    print(f"Starting tag audit at {datetime.now().isoformat()}: {len(plan)} shards "
+          f"across regions {', '.join(regions)}")
+
+    deadline = None
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - LAMBDA_RESERVE_SECONDS
+
+    # The previous snapshot turns this run into a diff; without one (or
+    # when it cannot be read) the full report is sent and a baseline saved
+    store = build_snapshot_store()
+    previous, version = None, None
+    if store is not None:
+        previous = {}
+        try:
+            previous, version = store.load()
+        except Exception as e:
+            print(f"Could not read audit snapshot, reporting in full: {str(e)}")
+    incremental = bool(previous)
+
+    counters = run_audit_plan(plan, deadline, previous, details=bool(AUDIT_REPORT_BUCKET))
+    print(f"Found {counters.total} total resources, {counters.non_compliant} non-compliant")
+
+    if store is not None:
+        if incremental:
+            counters.record_deleted(previous, plan)
+        try:
+            save_snapshot(store, counters, plan, previous, version)
+        except Exception as e:
+            print(f"Could not save audit snapshot: {str(e)}")
+
+    summary = counters.summary()
+    summary['incremental'] = incremental
+    notify = not incremental or counters.has_changes or NOTIFY_UNCHANGED
+
+    if notify:
+        # Keep the full report in S3 when a bucket is configured; the
+        # email then only needs the summary and links
+        links = None
+        if AUDIT_REPORT_BUCKET:
+            try:
+                links = save_report_artifacts(counters, incremental)
+                summary['report_location'] = links[0][1]
+            except Exception as e:
+                print(f"Could not save the full report to S3, emailing it instead: {str(e)}")
+
+        # Generate report
+        report = generate_report(counters, incremental, limit=SNS_MESSAGE_BUDGET, links=links)
+
+        # Send via SNS
+        send_notification(report)
+    else:
+        print("No compliance changes since the last audit; skipping notification")
+    summary['notified'] = notify
+    if counters.details is not None:
+        counters.details.close()
+
     # Return summary
     return {
         'statusCode': 200,
-        'body': json.dumps({
-            'total_resources': len(all_resources),
-            'compliant': len(all_resources) - len(non_compliant_resources),
-            'non_compliant': len(non_compliant_resources),
-            'compliance_rate': f"{((len(all_resources) - len(non_compliant_resources)) / len(all_resources) * 100):.1f}%"
-        })
+        'body': json.dumps(summary)
     }
 
+
+def get_tagging_client(region):
+    """Tagging API client for one region, created once per container"""
+    with _clients_lock:
+        if region not in tagging_clients:
+            tagging_clients[region] = boto3.client(
+                'resourcegroupstaggingapi',
+                region_name=region,
+                config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
+            )
+        return tagging_clients[region]
+
+
+def build_audit_plan(regions, resource_types=None, exempt_types=None):
+    """
+    Split an audit into shards of (region, service, ResourceTypeFilters).
+
+    Each service gets its own shard per region, so shards run side by side
+    and a service can be audited on its own. Exempt types are removed from
+    the filters; `skip_types` lists the exempt types a shard still has to
+    drop itself because its filter is broader than they are.
+    """
+    exempt_types = EXEMPT_RESOURCE_TYPES if exempt_types is None else set(exempt_types)
+    by_service = {}
+    for resource_type in resource_types or []:
+        if resource_type not in exempt_types:
+            by_service.setdefault(resource_type.split(':')[0], []).append(resource_type)
+
+    if not by_service:
+        services = [('*', [])]
+    else:
+        services = []
+        for service, types in sorted(by_service.items()):
+            for start in range(0, len(types), MAX_TYPE_FILTERS):
+                services.append((service, types[start:start + MAX_TYPE_FILTERS]))
+
+    plan = []
+    for region in regions:
+        for service, types in services:
+            skip_types = sorted(
+                exempt for exempt in exempt_types
+                if not types or any(type_matches(exempt, t) for t in types)
+            )
+            plan.append({
+                'region': region,
+                'service': service,
+                'resource_types': types,
+                'skip_types': skip_types
+            })
+    return plan
+
+
+def type_matches(resource_type, type_filter):
+    """Whether a 'service:type' falls under a ResourceTypeFilters entry"""
+    return resource_type == type_filter or resource_type.startswith(type_filter + ':')
+
+
+def run_audit_plan(plan, deadline=None, previous=None, details=False):
+    """
+    Audit every shard on a thread pool and merge the per-shard counters.
+
+    Given a previous snapshot ({arn: (tag hash, compliant, region)}, empty
+    for the first run) the counters also collect the next snapshot and
+    record what changed since the previous one was taken. With `details`
+    every non-compliant resource is also spooled to a ViolationFile.
+    """
+    clients = {shard['region']: get_tagging_client(shard['region']) for shard in plan}
+    counters = AuditCounters(details=ViolationFile(header=True) if details else None)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(AUDIT_MAX_WORKERS, len(plan)))) as executor:
+        futures = [
+            executor.submit(audit_shard, shard, clients[shard['region']], deadline, previous, details)
+            for shard in plan
+        ]
+    for future in futures:
+        counters.merge(future.result())
+
+    return counters
+
+
+def audit_shard(shard, client, deadline=None, previous=None, details=False):
+    """
+    Stream one shard's resources through the compliance check.
+
+    Each page is evaluated as it arrives and then dropped. A failing shard
+    is recorded in its counters instead of failing the whole audit.
+    """
+    region = shard['region']
+    shard_id = f"{region}/{shard['service']}"
+    counters = AuditCounters(previous, ViolationFile() if details else None)
+    counters.shards[shard_id] = {
+        'region': region, 'total': 0, 'non_compliant': 0, 'exempt': 0, 'pages': 0, 'complete': False
+    }
+    shard_stats = counters.shards[shard_id]
+
+    try:
+        for page in iter_resource_pages(client, shard['resource_types'], AUDIT_TAG_FILTERS):
+            counters.add_page(page, shard_id, shard['skip_types'])
+            shard_stats['pages'] += 1
+            if deadline is not None and time.monotonic() > deadline:
+                print(f"{shard_id}: stopping after {shard_stats['pages']} pages, out of time")
+                break
+        else:
+            shard_stats['complete'] = True
+    except Exception as e:
+        print(f"{shard_id}: audit failed after {shard_stats['pages']} pages: {str(e)}")
+        shard_stats['error'] = str(e)
+
+    print(f"{shard_id}: {shard_stats['total']} resources, {shard_stats['non_compliant']} non-compliant, "
+          f"{shard_stats['exempt']} exempt")
+    return counters
+
+
+def is_exempt(resource_type, exempt_types):
+    return any(type_matches(resource_type, exempt) for exempt in exempt_types)
+
+
+def iter_resource_pages(client, resource_types=None, tag_filters=None):
+    """Yield get_resources pages one at a time as the paginator fetches them"""
+    kwargs = {'ResourcesPerPage': RESOURCES_PER_PAGE}
+    if resource_types:
+        kwargs['ResourceTypeFilters'] = resource_types
+    if tag_filters:
+        kwargs['TagFilters'] = tag_filters
+    paginator = client.get_paginator('get_resources')
+    for page in paginator.paginate(**kwargs):
+        yield page['ResourceTagMappingList']
+
+
+class CompiledRules:
+    """
+    The rules for one resource type, ready to evaluate with set operations.
+
+    evaluate() returns (missing tags in policy order, [(rule, tag, value)]
+    for present tags with a disallowed or malformed value).
+    """
+
+    __slots__ = ('required_order', 'required', 'allowed', 'patterns', 'value_tags')
+
+    def __init__(self, required, allowed, patterns):
+        self.required_order = tuple(required)
+        self.required = frozenset(required)
+        self.allowed = allowed
+        self.patterns = patterns
+        # (tag, allowed values or None, compiled pattern or None), sorted by tag
+        self.value_tags = tuple(
+            (tag, allowed.get(tag), patterns.get(tag).fullmatch if tag in patterns else None)
+            for tag in sorted(set(allowed) | set(patterns))
+        )
+
+    def evaluate(self, existing_tags):
+        # dict_keys >= frozenset is a C-level subset test; most resources pass it
+        if existing_tags.keys() >= self.required:
+            missing = []
+        else:
+            missing = [tag for tag in self.required_order if tag not in existing_tags]
+
+        invalid = []
+        for tag, allowed, fullmatch in self.value_tags:
+            value = existing_tags.get(tag)
+            if value is None:
+                continue
+            if allowed is not None and value not in allowed:
+                invalid.append(('allowed', tag, value))
+            if fullmatch is not None and fullmatch(value) is None:
+                invalid.append(('pattern', tag, value))
+        if len(invalid) > 1:
+            invalid.sort()
+        return missing, invalid
+
+
+class TagPolicy:
+    """
+    Tag rules from tag-policy.json: required tags, allowed values and
+    value patterns, with per-resource-type additions keyed in
+    ResourceTypeFilters syntax ('s3', 'lambda:function'). A resource type
+    gets the defaults, then its service's rules, then its own; they are
+    merged and compiled the first time the type is seen.
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.by_type = policy.get('resource_types', {})
+        self.required_tags = list(policy.get('required', []))
+        self._compiled = {}
+        # Compile every section now so a bad pattern fails at import
+        for spec in [policy] + list(self.by_type.values()):
+            self._compile_specs([spec])
+
+    def rules_for(self, resource_type):
+        rules = self._compiled.get(resource_type)
+        if rules is None:
+            specs = [self.policy] + [
+                self.by_type[key]
+                for key in sorted(self.by_type, key=len)
+                if type_matches(resource_type, key)
+            ]
+            rules = self._compiled.setdefault(resource_type, self._compile_specs(specs))
+        return rules
+
+    @staticmethod
+    def _compile_specs(specs):
+        required = []
+        allowed = {}
+        patterns = {}
+        for spec in specs:
+            required.extend(tag for tag in spec.get('required', []) if tag not in required)
+            for tag, values in spec.get('allowed_values', {}).items():
+                allowed[tag] = frozenset(values)
+            for tag, pattern in spec.get('patterns', {}).items():
+                patterns[tag] = re.compile(pattern)
+        return CompiledRules(required, allowed, patterns)
+
+
+def load_tag_policy(path=None):
+    """The tag policy from tag-policy.json, or REQUIRED_TAGS when there is none"""
+    for candidate in [path] if path else TAG_POLICY_CANDIDATES:
+        if path or os.path.exists(candidate):
+            with open(candidate) as f:
+                policy = json.load(f)
+            print(f"Loaded tag policy from {candidate}")
+            return TagPolicy(policy)
+    return TagPolicy({'required': REQUIRED_TAGS})
+
+
+tag_policy = load_tag_policy(TAG_POLICY_PATH or None)
+
+
+class AuditCounters:
+    """
+    Compliance counters for a stream of resources.
+
+    Only totals and the first REPORT_SAMPLES_PER_TYPE non-compliant
+    resources of each type are kept. Counters from separate regions
+    combine with merge().
+
+    When snapshots are in use (`previous` is not None) every resource's
+    tag-set hash and compliance go into `seen` for the next snapshot, and
+    resources whose compliance changed since the previous one are counted
+    (the first REPORT_DELTA_LIMIT of each kind are kept).
+
+    With a ViolationFile as `details`, every non-compliant resource is
+    also written out as it is found, for the full report in S3.
+    """
+
+    def __init__(self, previous=None, details=None):
+        self.total = 0
+        self.non_compliant = 0
+        self.by_type = {}           # type -> non-compliant count
+        self.samples = {}           # type -> first few non-compliant resources
+        self.missing_by_tag = {}    # tag -> resources missing it
+        self.rule_violations = {}   # 'required:Project', 'allowed:Environment', ... -> count
+        self.shards = {}            # 'region/service' -> per-shard stats
+        self.previous = previous
+        self.seen = {}              # arn -> (tag hash, compliant, region)
+        self.tags_changed = 0
+        self.delta_counts = {kind: 0 for kind in DELTA_KINDS}
+        self.delta_samples = {kind: [] for kind in DELTA_KINDS}
+        self.details = details
+
+    def add(self, resource, shard_id=None):
+        self.add_page([resource], shard_id)
+
+    def add_page(self, resources, shard_id=None, skip_types=()):
+        """
+        Evaluate one get_resources page. This is the audit's hot loop, so
+        lookups are bound once per page and compliant resources only pay
+        for the tag dict, the type and the rule check.
+        """
+        rules_for = tag_policy.rules_for
+        tracking = self.previous is not None
+        stats = self.shards[shard_id] if shard_id is not None else None
+        region = stats['region'] if stats is not None else None
+        evaluated = 0
+
+        for resource in resources:
+            resource_arn = resource['ResourceARN']
+            rtype = extract_resource_type(resource_arn)
+            if skip_types and is_exempt(rtype, skip_types):
+                stats['exempt'] += 1
+                continue
+            evaluated += 1
+            existing_tags = {tag['Key']: tag['Value'] for tag in resource.get('Tags', ())}
+            missing_tags, invalid_tags = rules_for(rtype).evaluate(existing_tags)
+            compliant = not missing_tags and not invalid_tags
+            if tracking:
+                self.track(resource_arn, rtype, existing_tags, compliant, missing_tags, invalid_tags, region)
+            if not compliant:
+                self.record_violation(resource_arn, rtype, existing_tags, missing_tags, invalid_tags, stats)
+
+        self.total += evaluated
+        if stats is not None:
+            stats['total'] += evaluated
+
+    def record_violation(self, resource_arn, rtype, existing_tags, missing_tags, invalid_tags, stats=None):
+        self.non_compliant += 1
+        if stats is not None:
+            stats['non_compliant'] += 1
+        for tag in missing_tags:
+            self.missing_by_tag[tag] = self.missing_by_tag.get(tag, 0) + 1
+            rule = f"required:{tag}"
+            self.rule_violations[rule] = self.rule_violations.get(rule, 0) + 1
+        for rule, tag, _ in invalid_tags:
+            rule = f"{rule}:{tag}"
+            self.rule_violations[rule] = self.rule_violations.get(rule, 0) + 1
+
+        self.by_type[rtype] = self.by_type.get(rtype, 0) + 1
+        if self.details is not None:
+            self.details.write(resource_arn, rtype, stats['region'] if stats is not None else '',
+                               missing_tags, invalid_tags, existing_tags)
+        samples = self.samples.setdefault(rtype, [])
+        if len(samples) < REPORT_SAMPLES_PER_TYPE:
+            samples.append({
+                'arn': resource_arn,
+                'type': rtype,
+                'missing_tags': missing_tags,
+                'invalid_tags': invalid_tags,
+                'existing_tags': existing_tags
+            })
+
+    def track(self, resource_arn, rtype, existing_tags, compliant, missing_tags, invalid_tags, region):
+        tag_hash = tag_set_hash(existing_tags)
+        self.seen[resource_arn] = (tag_hash, compliant, region)
+        if not self.previous:
+            return  # first snapshot: nothing to compare with
+
+        before = self.previous.get(resource_arn)
+        if before is not None and before[0] != tag_hash:
+            self.tags_changed += 1
+        if not compliant and (before is None or before[1]):
+            self.record_delta('newly_non_compliant', {
+                'arn': resource_arn,
+                'type': rtype,
+                'missing_tags': missing_tags,
+                'invalid_tags': invalid_tags
+            })
+        elif compliant and before is not None and not before[1]:
+            self.record_delta('newly_fixed', {'arn': resource_arn, 'type': rtype})
+
+    def record_delta(self, kind, entry):
+        self.delta_counts[kind] += 1
+        if len(self.delta_samples[kind]) < REPORT_DELTA_LIMIT:
+            self.delta_samples[kind].append(entry)
+
+    def record_deleted(self, previous, plan):
+        """Count previous resources that a completed shard no longer returned"""
+        for resource_arn, entry in previous.items():
+            if resource_arn not in self.seen and self.covers(plan, resource_arn, entry[2]):
+                self.record_delta('deleted', {'arn': resource_arn, 'type': extract_resource_type(resource_arn)})
+
+    def covers(self, plan, resource_arn, region):
+        """Whether a shard that ran to completion audited this ARN's region and type"""
+        rtype = extract_resource_type(resource_arn)
+        for shard in plan:
+            if shard['region'] != region:
+                continue
+            stats = self.shards.get(f"{region}/{shard['service']}")
+            if not stats or not stats['complete']:
+                continue
+            in_types = not shard['resource_types'] or any(type_matches(rtype, t) for t in shard['resource_types'])
+            if in_types and not is_exempt(rtype, shard['skip_types']):
+                return True
+        return False
+
+    @property
+    def has_changes(self):
+        return any(self.delta_counts.values())
+
+    def merge(self, other):
+        self.total += other.total
+        self.non_compliant += other.non_compliant
+        for rtype, count in other.by_type.items():
+            self.by_type[rtype] = self.by_type.get(rtype, 0) + count
+        for rtype, samples in other.samples.items():
+            kept = self.samples.setdefault(rtype, [])
+            kept.extend(samples[:REPORT_SAMPLES_PER_TYPE - len(kept)])
+        for tag, count in other.missing_by_tag.items():
+            self.missing_by_tag[tag] = self.missing_by_tag.get(tag, 0) + count
+        for rule, count in other.rule_violations.items():
+            self.rule_violations[rule] = self.rule_violations.get(rule, 0) + count
+        self.shards.update(other.shards)
+        self.seen.update(other.seen)
+        self.tags_changed += other.tags_changed
+        for kind in DELTA_KINDS:
+            self.delta_counts[kind] += other.delta_counts[kind]
+            kept = self.delta_samples[kind]
+            kept.extend(other.delta_samples[kind][:REPORT_DELTA_LIMIT - len(kept)])
+        if other.details is not None:
+            if self.details is not None:
+                self.details.extend(other.details)
+            other.details.close()
+
+    @property
+    def compliant(self):
+        return self.total - self.non_compliant
+
+    @property
+    def compliance_rate(self):
+        return (self.compliant / self.total * 100) if self.total > 0 else 0
+
+    @property
+    def complete(self):
+        return all(stats['complete'] for stats in self.shards.values())
+
+    @property
+    def exempt(self):
+        return sum(stats['exempt'] for stats in self.shards.values())
+
+    @property
+    def regions(self):
+        """Shard stats rolled up per region"""
+        regions = {}
+        for shard_id, stats in self.shards.items():
+            region = regions.setdefault(stats['region'], {
+                'total': 0, 'non_compliant': 0, 'exempt': 0, 'pages': 0, 'complete': True
+            })
+            for field in ('total', 'non_compliant', 'exempt', 'pages'):
+                region[field] += stats[field]
+            region['complete'] = region['complete'] and stats['complete']
+            if 'error' in stats:
+                region.setdefault('errors', {})[shard_id] = stats['error']
+        return regions
+
+    def summary(self):
+        return {
+            'total_resources': self.total,
+            'compliant': self.compliant,
+            'non_compliant': self.non_compliant,
+            'compliance_rate': f"{self.compliance_rate:.1f}%",
+            'complete': self.complete,
+            'exempt': self.exempt,
+            'missing_by_tag': self.missing_by_tag,
+            'rule_violations': self.rule_violations,
+            'regions': self.regions,
+            'shards': self.shards,
+            'changes': dict(self.delta_counts, tags_changed=self.tags_changed)
+        }
+
+
+class ViolationFile:
+    """
+    Every non-compliant resource as a CSV row, spooled to a temporary file
+    rather than held in memory. Each shard writes its own; merge() appends
+    them into the audit's file, which is uploaded as-is.
+    """
+
+    COLUMNS = ['arn', 'type', 'region', 'missing_tags', 'invalid_tags', 'tags']
+
+    def __init__(self, header=False):
+        self.file = tempfile.TemporaryFile()
+        self.text = io.TextIOWrapper(self.file, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.text)
+        self.rows = 0
+        if header:
+            self.writer.writerow(self.COLUMNS)
+
+    def write(self, resource_arn, rtype, region, missing_tags, invalid_tags, existing_tags):
+        self.writer.writerow([
+            resource_arn, rtype, region, ';'.join(missing_tags), format_invalid_tags(invalid_tags),
+            json.dumps(existing_tags, separators=(',', ':'))
+        ])
+        self.rows += 1
+
+    def extend(self, other):
+        other.text.flush()
+        other.file.seek(0)
+        self.text.flush()
+        shutil.copyfileobj(other.file, self.file)
+        self.rows += other.rows
+
+    def open_for_upload(self):
+        """The file, rewound, as a binary stream for put_object"""
+        self.text.flush()
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.text.close()
+
+
+# Services whose ARNs end in a bare name, with no resource type segment
+SINGLE_TYPE_SERVICES = {'s3': 'bucket', 'sns': 'topic', 'sqs': 'queue'}
+
 def extract_resource_type(arn):
     """Extract readable resource type from ARN"""
-    parts = arn.split(':')
+    parts = arn.split(':', 5)
     if len(parts) >= 3:
         service = parts[2]
-        if len(parts) >= 6:
-            resource = parts[5].split('/')[0]
+        if len(parts) == 6:
+            resource = parts[5]
+            if service in SINGLE_TYPE_SERVICES and ':' not in resource and '/' not in resource:
+                return f"{service}:{SINGLE_TYPE_SERVICES[service]}"
+            resource = resource.split(':', 1)[0].split('/', 1)[0]
             return f"{service}:{resource}"
         return service
     return "unknown"
 
-def generate_report(all_resources, non_compliant):
-    """Generate human-readable email report"""
-    total = len(all_resources)
-    compliant = total - len(non_compliant)
-    compliance_rate = (compliant / total * 100) if total > 0 else 0
-    
-    report = f"""
+def tag_set_hash(existing_tags):
+    """Short, order-independent hash of a resource's tags"""
+    canonical = json.dumps(sorted(existing_tags.items()), separators=(',', ':'))
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class SnapshotConflict(Exception):
+    """Another audit saved the snapshot since this one read it"""
+
+
+def encode_snapshot(resources):
+    """gzip JSON: {arn: [tag hash, 0/1 compliant, region index]}"""
+    regions = sorted({entry[2] or '' for entry in resources.values()})
+    region_index = {region: i for i, region in enumerate(regions)}
+    document = {
+        'version': 1,
+        'saved_at': datetime.now().isoformat(),
+        'regions': regions,
+        'resources': {
+            arn: [tag_hash, int(compliant), region_index[region or '']]
+            for arn, (tag_hash, compliant, region) in resources.items()
+        }
+    }
+    return gzip.compress(json.dumps(document, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_snapshot(body):
+    document = json.loads(gzip.decompress(body))
+    regions = document['regions']
+    return {
+        arn: (tag_hash, bool(compliant), regions[region])
+        for arn, (tag_hash, compliant, region) in document['resources'].items()
+    }
+
+
+class FileSnapshotStore:
+    """Snapshot in a local file (only lasts as long as /tmp in Lambda)"""
+
+    backend = 'file'
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """Returns (resources, version); ({}, None) when there is no snapshot yet"""
+        try:
+            with open(self.path, 'rb') as f:
+                return decode_snapshot(f.read()), os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return {}, None
+
+    def save(self, resources, version):
+        current = os.stat(self.path).st_mtime_ns if os.path.exists(self.path) else None
+        if current != version:
+            raise SnapshotConflict(self.path)
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(encode_snapshot(resources))
+        os.replace(temp_path, self.path)
+
+
+class S3SnapshotStore:
+    """Snapshot object in S3, written with conditional puts on its ETag"""
+
+    backend = 's3'
+
+    def __init__(self, bucket, key, client=None):
+        self.bucket = bucket
+        self.key = key
+        self.client = client or s3_client
+
+    def load(self):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        except Exception as e:
+            if error_code(e) in ('NoSuchKey', '404'):
+                return {}, None
+            raise
+        return decode_snapshot(response['Body'].read()), response['ETag']
+
+    def save(self, resources, version):
+        condition = {'IfMatch': version} if version else {'IfNoneMatch': '*'}
+        try:
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=encode_snapshot(resources),
+                ContentType='application/json',
+                ContentEncoding='gzip',
+                **condition
+            )
+        except Exception as e:
+            if error_code(e) in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise SnapshotConflict(self.key)
+            raise
+
+
+def error_code(exception):
+    """AWS error code of a botocore ClientError, if it is one"""
+    return getattr(exception, 'response', {}).get('Error', {}).get('Code')
+
+
+def build_snapshot_store():
+    if AUDIT_SNAPSHOT_BACKEND == 'file':
+        return FileSnapshotStore(AUDIT_SNAPSHOT_PATH)
+    if AUDIT_SNAPSHOT_BACKEND == 's3':
+        if not AUDIT_SNAPSHOT_BUCKET:
+            raise ValueError('AUDIT_SNAPSHOT_BUCKET is required for the s3 snapshot backend')
+        return S3SnapshotStore(AUDIT_SNAPSHOT_BUCKET, AUDIT_SNAPSHOT_KEY)
+    if AUDIT_SNAPSHOT_BACKEND == 'none':
+        return None
+    raise ValueError(f"Unknown AUDIT_SNAPSHOT_BACKEND: {AUDIT_SNAPSHOT_BACKEND}")
+
+
+def save_snapshot(store, counters, plan, snapshot, version):
+    """
+    Write this run's resources over the snapshot it started from.
+
+    Entries outside this run's completed shards are carried over untouched,
+    so shards scheduled on their own share one snapshot. When another run
+    saved in between, its snapshot is reloaded and the merge redone.
+    """
+    for attempt in range(SNAPSHOT_WRITE_ATTEMPTS):
+        resources = {
+            arn: entry for arn, entry in snapshot.items()
+            if not counters.covers(plan, arn, entry[2])
+        }
+        resources.update(counters.seen)
+        try:
+            store.save(resources, version)
+            print(f"Saved {store.backend} audit snapshot of {len(resources)} resources")
+            return
+        except SnapshotConflict:
+            print(f"Audit snapshot changed while auditing; merging again (attempt {attempt + 1})")
+            snapshot, version = store.load()
+    raise SnapshotConflict(f"gave up after {SNAPSHOT_WRITE_ATTEMPTS} attempts")
+
+
+class ReportBuffer:
+    """
+    Report text written into a StringIO against a byte budget.
+
+    A write that would go over `limit` (less `reserve`, kept back for the
+    closing lines) is dropped along with everything after it, and
+    `truncated` is set. Sections write whole entries at a time, so a cut
+    report never ends halfway through one. `force` writes past the budget.
+    """
+
+    def __init__(self, limit=None, reserve=0):
+        self.buffer = io.StringIO()
+        self.size = 0
+        self.budget = None if limit is None else limit - reserve
+        self.truncated = False
+
+    def write(self, text, force=False):
+        if self.truncated and not force:
+            return False
+        size = len(text.encode('utf-8'))
+        if not force and self.budget is not None and self.size + size > self.budget:
+            self.truncated = True
+            return False
+        self.buffer.write(text)
+        self.size += size
+        return True
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+
+def generate_report(counters, incremental=False, limit=None, links=None):
+    """
+    Generate human-readable email report
+
+    With a `limit` (bytes) the report stops at the last entry that fits and
+    says so. Given `links` to the full report in S3, per-resource detail is
+    left to the linked files and only the summary sections are written.
+    """
+    trailer = "\n" + "=" * 60 + "\n"
+    if links:
+        trailer += "\nFULL REPORT\n-----------\n"
+        for name, uri, url in links:
+            trailer += f"{name}: {uri}\n" + (f"  {url}\n" if url else "")
+        trailer += "\nACTION ITEMS:\n1. Review non-compliant resources in the full report\n"
+    else:
+        trailer += "\nACTION ITEMS:\n1. Review non-compliant resources above\n"
+    trailer += "2. Apply missing tags using: ./fix-tags.sh <resource-arn>\n"
+    trailer += "3. Update TAGGING_STRATEGY.md if needed\n"
+    note_room = 256  # for the truncation note
+    out = ReportBuffer(limit, len(trailer.encode('utf-8')) + note_room)
+
+    out.write(f"""
 AWS TAG COMPLIANCE AUDIT REPORT
 ================================
 Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S UTC')}
 
 SUMMARY
 -------
-Total Resources: {total}
-Compliant: {compliant}
-Non-Compliant: {len(non_compliant)}
-Compliance Rate: {compliance_rate:.1f}%
+Total Resources: {counters.total}
+Compliant: {counters.compliant}
+Non-Compliant: {counters.non_compliant}
+Compliance Rate: {counters.compliance_rate:.1f}%
+
+Required Tags: {', '.join(tag_policy.required_tags)}
+Exempt Types: {', '.join(sorted(EXEMPT_RESOURCE_TYPES)) or 'none'}
+
+""")
 
-Required Tags: {', '.join(REQUIRED_TAGS)}
+    if counters.rule_violations:
+        out.write("VIOLATIONS BY RULE\n------------------\n")
+        for rule, count in sorted(counters.rule_violations.items(), key=lambda item: (-item[1], item[0])):
+            if not out.write(f"{rule}: {count} resources\n"):
+                break
+        out.write("\n")
 
-"""
-    
-    if not non_compliant:
-        report += "✅ ALL RESOURCES ARE COMPLIANT!\n"
+    out.write("REGIONS\n-------\n")
+    for region, stats in sorted(counters.regions.items()):
+        line = f"{region}: {stats['total']} resources, {stats['non_compliant']} non-compliant"
+        if stats['exempt']:
+            line += f", {stats['exempt']} exempt"
+        if 'errors' in stats:
+            failed = '; '.join(f"{shard_id}: {error}" for shard_id, error in sorted(stats['errors'].items()))
+            line += f" (FAILED: {failed})"
+        elif not stats['complete']:
+            line += f" (INCOMPLETE: stopped after {stats['pages']} pages)"
+        if not out.write(line + "\n"):
+            break
+    out.write("\n")
+
+    if incremental:
+        write_changes_section(out, counters, detail=not links)
+    elif not counters.non_compliant:
+        out.write("✅ ALL RESOURCES ARE COMPLIANT!\n")
+    elif links:
+        out.write(f"❌ NON-COMPLIANT RESOURCES ({counters.non_compliant})\n")
+        out.write("=" * 60 + "\n")
+        for rtype, count in sorted(counters.by_type.items()):
+            if not out.write(f"{rtype}: {count} resources\n"):
+                break
     else:
-        report += f"❌ NON-COMPLIANT RESOURCES ({len(non_compliant)})\n"
-        report += "=" * 60 + "\n\n"
-        
-        # Group by resource type
-        by_type = {}
-        for resource in non_compliant:
-            rtype = resource['type']
-            if rtype not in by_type:
-                by_type[rtype] = []
-            by_type[rtype].append(resource)
-        
-        for rtype, resources in sorted(by_type.items()):
-            report += f"\n{rtype} ({len(resources)} resources)\n"
-            report += "-" * 60 + "\n"
-            
-            for resource in resources[:5]:  # Limit to first 5 per type
-                report += f"\nARN: {resource['arn']}\n"
-                report += f"Missing Tags: {', '.join(resource['missing_tags'])}\n"
-                if resource['existing_tags']:
-                    report += f"Existing Tags: {json.dumps(resource['existing_tags'], indent=2)}\n"
-            
-            if len(resources) > 5:
-                report += f"\n... and {len(resources) - 5} more {rtype} resources\n"
-    
-    report += "\n" + "=" * 60 + "\n"
-    report += "\nACTION ITEMS:\n"
-    report += "1. Review non-compliant resources above\n"
-    report += "2. Apply missing tags using: ./fix-tags.sh <resource-arn>\n"
-    report += "3. Update TAGGING_STRATEGY.md if needed\n"
-    report += "\nNext audit: 1 week from now\n"
-    
-    return report
+        out.write(f"❌ NON-COMPLIANT RESOURCES ({counters.non_compliant})\n")
+        out.write("=" * 60 + "\n\n")
+        write_resource_samples(out, counters)
+
+    if out.truncated:
+        where = "see the full report below" if links else "set AUDIT_REPORT_BUCKET to keep the full report in S3"
+        out.write(f"\n... report cut at {out.size // 1024} KB to fit the email; {where}\n", force=True)
+    out.write(trailer, force=True)
+    return out.getvalue()
+
+def write_resource_samples(out, counters):
+    """The sampled non-compliant resources of each type, as grouped during the audit"""
+    for rtype, count in sorted(counters.by_type.items()):
+        if not out.write(f"\n{rtype} ({count} resources)\n" + "-" * 60 + "\n"):
+            return
+        samples = counters.samples[rtype]
+        for resource in samples:
+            entry = f"\nARN: {resource['arn']}\n"
+            if resource['missing_tags']:
+                entry += f"Missing Tags: {', '.join(resource['missing_tags'])}\n"
+            if resource['invalid_tags']:
+                entry += f"Invalid Tags: {format_invalid_tags(resource['invalid_tags'])}\n"
+            if resource['existing_tags']:
+                entry += f"Existing Tags: {format_tags(resource['existing_tags'])}\n"
+            if not out.write(entry):
+                return
+        if count > len(samples):
+            out.write(f"\n... and {count - len(samples)} more {rtype} resources\n")
+
+def format_tags(existing_tags):
+    return ', '.join(f"{key}={value}" for key, value in sorted(existing_tags.items()))
+
+def format_invalid_tags(invalid_tags):
+    reasons = {'allowed': 'not an allowed value', 'pattern': 'does not match the pattern'}
+    return '; '.join(f"{tag}={value} ({reasons[rule]})" for rule, tag, value in invalid_tags)
+
+def write_changes_section(out, counters, detail=True):
+    """Report section listing only what changed since the last audit"""
+    counts = counters.delta_counts
+    out.write(
+        "CHANGES SINCE LAST AUDIT\n"
+        + "=" * 60 + "\n"
+        + f"Newly Non-Compliant: {counts['newly_non_compliant']}\n"
+        + f"Newly Fixed: {counts['newly_fixed']}\n"
+        + f"Deleted: {counts['deleted']}\n"
+        + f"Tag Sets Changed: {counters.tags_changed}\n"
+    )
+
+    titles = {
+        'newly_non_compliant': "❌ NEWLY NON-COMPLIANT",
+        'newly_fixed': "✅ NEWLY FIXED",
+        'deleted': "🗑️  DELETED"
+    }
+    for kind in DELTA_KINDS if detail else ():
+        if not counts[kind]:
+            continue
+        out.write(f"\n{titles[kind]} ({counts[kind]})\n" + "-" * 60 + "\n")
+        for entry in counters.delta_samples[kind]:
+            line = f"{entry['arn']}\n"
+            if entry.get('missing_tags'):
+                line += f"  Missing Tags: {', '.join(entry['missing_tags'])}\n"
+            if entry.get('invalid_tags'):
+                line += f"  Invalid Tags: {format_invalid_tags(entry['invalid_tags'])}\n"
+            if not out.write(line):
+                return
+        if counts[kind] > len(counters.delta_samples[kind]):
+            out.write(f"... and {counts[kind] - len(counters.delta_samples[kind])} more\n")
+
+    if counters.non_compliant:
+        out.write("\nStill non-compliant by type:\n")
+        for rtype, count in sorted(counters.by_type.items()):
+            if not out.write(f"  {rtype}: {count}\n"):
+                return
+
+def save_report_artifacts(counters, incremental=False):
+    """
+    Put the full report in AUDIT_REPORT_BUCKET: the unabridged text report,
+    a CSV of every non-compliant resource (when they were collected) and the
+    JSON summary. Returns [(name, s3 uri, presigned url or None)].
+    """
+    prefix = f"{AUDIT_REPORT_PREFIX}{datetime.now().strftime('%Y-%m-%d-%H%M%S')}/"
+    artifacts = [('report.txt', 'text/plain; charset=utf-8', generate_report(counters, incremental).encode('utf-8'))]
+    if counters.details is not None:
+        artifacts.append(('non_compliant.csv', 'text/csv; charset=utf-8', counters.details.open_for_upload()))
+    artifacts.append(('summary.json', 'application/json', json.dumps(counters.summary(), indent=2).encode('utf-8')))
+
+    links = []
+    for name, content_type, body in artifacts:
+        key = prefix + name
+        s3_client.put_object(Bucket=AUDIT_REPORT_BUCKET, Key=key, Body=body, ContentType=content_type)
+        try:
+            url = s3_client.generate_presigned_url(
+                'get_object', Params={'Bucket': AUDIT_REPORT_BUCKET, 'Key': key}, ExpiresIn=REPORT_LINK_EXPIRY
+            )
+        except Exception as e:
+            print(f"Could not presign {key}: {str(e)}")
+            url = None
+        links.append((name, f"s3://{AUDIT_REPORT_BUCKET}/{key}", url))
+    print(f"Saved full report to s3://{AUDIT_REPORT_BUCKET}/{prefix}")
+    return links
 
 def send_notification(report):
     """Send report via SNS"""
     subject = f"AWS Tag Audit Report - {datetime.now().strftime('%Y-%m-%d')}"
-    
+    print(f"Publishing {len(report.encode('utf-8')) / 1024:.1f} KB report")
+
     try:
         response = sns_client.publish(
             TopicArn=SNS_TOPIC_ARN,
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 """
-Check processing results for a test document.
+Check processing results for a test document, or a whole manifest of them.
 
 This script:
 1. Checks if processing is complete
@@ -9,18 +9,37 @@ This script:
 4. Calculates performance statistics
 
 Usage: python check-results.py <filename>
+       python check-results.py --manifest <test_manifest.json> [--workers N] [--fresh]
+       python check-results.py --report [--manifest <test_manifest.json>] [--baseline <report.json>]
 Example: python check-results.py invoice_001_DOC-2025-2288.pdf
+Example: python check-results.py --manifest test-documents/phase3/test_manifest.json
+
+Bulk mode lists processed/ once, downloads results concurrently and writes the
+aggregated metrics and cost to phase3-results/bulk_summary.json. Finished
+documents are appended to phase3-results/bulk_checkpoint.jsonl, so an
+interrupted run picks up where it stopped (--fresh starts over).
+
+Report mode does the same over the manifest (or every processed result) and
+joins each result with its upload time and stage timings. It prints p50/p90/p99
+end-to-end latency, throughput and cost per page, and writes the same numbers
+to phase3-results/latency_report_<timestamp>.json; pass an earlier report as
+--baseline to compare two pipeline releases.
 """
 
 import sys
 import json
+import gzip
 import os
+import re
 import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone
 
 try:
     import boto3
+    from botocore.config import Config
     from botocore.exceptions import ClientError
 except ImportError:
     print("❌ Error: boto3 not installed")
@@ -32,6 +51,9 @@ PROJECT_NAME = os.environ.get('PROJECT_NAME', 'doc-processing-demo')
 ACCOUNT_ID = os.environ.get('ACCOUNT_ID', '')
 REGION = os.environ.get('REGION', 'us-east-1')
 RESULTS_DIR = Path('./phase3-results')
+CHECKPOINT_FILE = RESULTS_DIR / 'bulk_checkpoint.jsonl'
+SUMMARY_FILE = RESULTS_DIR / 'bulk_summary.json'
+DEFAULT_WORKERS = int(os.environ.get('CHECK_WORKERS', '16'))
 
 # Check environment
 if not ACCOUNT_ID:
@@ -40,9 +62,18 @@ if not ACCOUNT_ID:
     sys.exit(1)
 
 PROCESSED_BUCKET = f"{PROJECT_NAME}-processed-{ACCOUNT_ID}"
+UPLOAD_BUCKET = f"{PROJECT_NAME}-uploads-{ACCOUNT_ID}"
+UPLOAD_PREFIX = os.environ.get('UPLOAD_PREFIX', 'uploads/')
+
+# upload-document.sh stores uploads as <epoch>_<filename>
+UPLOAD_TIMESTAMP_PREFIX = re.compile(r'^\d+_')
+
+# The processor writes compact JSON or NDJSON, optionally gzip-encoded
+RESULT_EXTENSIONS = ('.json', '.ndjson')
 
-# AWS clients
-s3 = boto3.client('s3', region_name=REGION)
+# AWS clients (boto3 clients are thread-safe; size the pool for bulk downloads)
+s3 = boto3.client('s3', region_name=REGION,
+                  config=Config(max_pool_connections=max(DEFAULT_WORKERS, 10)))
 
 def print_header(text):
     """Print a formatted header."""
@@ -50,53 +81,150 @@ def print_header(text):
     print(text)
     print("="*70)
 
-def check_processing_status(filename):
-    """Check if the document has been processed."""
-    # Results are saved as: processed/<timestamp>_<filename>.json
+def list_processed_results():
+    """
+    List processed/ once (every page) into {document filename: latest result}.
+
+    Each result is indexed under its stored name and, for uploads made by
+    upload-document.sh, under the original filename as well.
+    """
+    # Results are saved as: processed/<filename>.json (or .ndjson)
     prefix = "processed/"
-    
-    try:
-        response = s3.list_objects_v2(
-            Bucket=PROCESSED_BUCKET,
-            Prefix=prefix
-        )
-        
-        if 'Contents' not in response:
-            return None, "No processed documents found"
-        
-        # Find matching results (look for filename in the key)
-        base_filename = filename.replace('.pdf', '')
-        matching_results = []
-        
-        for obj in response['Contents']:
+    index = {}
+    paginator = s3.get_paginator('list_objects_v2')
+
+    for page in paginator.paginate(Bucket=PROCESSED_BUCKET, Prefix=prefix):
+        for obj in page.get('Contents', []):
             key = obj['Key']
-            if base_filename in key and key.endswith('.json'):
-                matching_results.append({
-                    'key': key,
-                    'last_modified': obj['LastModified'],
-                    'size': obj['Size']
-                })
-        
-        if not matching_results:
-            return None, f"No results found for {filename}"
-        
-        # Get the most recent result
-        latest = sorted(matching_results, key=lambda x: x['last_modified'], reverse=True)[0]
-        return latest, None
-        
+            if not key.endswith(RESULT_EXTENSIONS):
+                continue
+            name = key[len(prefix):].rsplit('.', 1)[0]
+            info = {
+                'name': name,
+                'key': key,
+                'last_modified': obj['LastModified'],
+                'size': obj['Size']
+            }
+            for alias in {name, UPLOAD_TIMESTAMP_PREFIX.sub('', name)}:
+                if alias not in index or index[alias]['last_modified'] < info['last_modified']:
+                    index[alias] = info
+
+    return index
+
+def list_upload_times():
+    """List the upload bucket once into {object name: upload time}."""
+    uploads = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=UPLOAD_BUCKET, Prefix=UPLOAD_PREFIX):
+        for obj in page.get('Contents', []):
+            # The processor names results after the last path segment only
+            name = obj['Key'].split('/')[-1]
+            if name not in uploads or uploads[name] < obj['LastModified']:
+                uploads[name] = obj['LastModified']
+    return uploads
+
+def check_processing_status(filename, index=None):
+    """Check if the document has been processed."""
+    try:
+        if index is None:
+            index = list_processed_results()
     except ClientError as e:
         return None, f"Error checking S3: {e}"
 
+    if not index:
+        return None, "No processed documents found"
+
+    if filename in index:
+        return index[filename], None
+
+    # Fall back to a partial match on the filename (e.g. without .pdf)
+    base_filename = filename.replace('.pdf', '')
+    matching_results = [info for name, info in index.items() if base_filename in name]
+
+    if not matching_results:
+        return None, f"No results found for {filename}"
+
+    # Get the most recent result
+    latest = max(matching_results, key=lambda x: x['last_modified'])
+    return latest, None
+
 def download_results(s3_key):
-    """Download and parse the results JSON."""
+    """Download and parse the results (JSON or NDJSON, plain or gzip)."""
     try:
         response = s3.get_object(Bucket=PROCESSED_BUCKET, Key=s3_key)
-        results_json = response['Body'].read().decode('utf-8')
-        return json.loads(results_json), None
+        body = response['Body'].read()
+        return decode_results(body, s3_key, response.get('ContentEncoding')), None
     except ClientError as e:
         return None, f"Error downloading results: {e}"
-    except json.JSONDecodeError as e:
-        return None, f"Error parsing JSON: {e}"
+    except (json.JSONDecodeError, OSError) as e:
+        return None, f"Error parsing results: {e}"
+
+def decode_results(body, s3_key, content_encoding=None):
+    """Turn a stored result body back into one result dict."""
+    # boto3 does not undo Content-Encoding, so check the gzip magic too
+    if content_encoding == 'gzip' or body[:2] == b'\x1f\x8b':
+        body = gzip.decompress(body)
+    text = body.decode('utf-8')
+
+    if not s3_key.endswith('.ndjson'):
+        return json.loads(text)
+
+    # NDJSON: a document record, then one record per page
+    results = {}
+    pages = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        kind = record.pop('record', 'document')
+        if kind == 'page':
+            pages.append(record)
+        else:
+            results.update(record)
+    if pages:
+        results.setdefault('extraction', {})['pages'] = pages
+    return results
+
+def extraction_text(extraction):
+    """Document text — joined from the page records (older results store full_text)."""
+    if 'pages' not in extraction:
+        return extraction.get('full_text', '')
+    return ' '.join(line for page in extraction['pages'] for line in page.get('lines', []))
+
+def extraction_key_values(extraction):
+    """Key/value pairs of every page merged (older results store them flat)."""
+    if 'pages' not in extraction:
+        return extraction.get('key_value_pairs', {})
+    merged = {}
+    for page in extraction['pages']:
+        merged.update(page.get('key_value_pairs', {}))
+    return merged
+
+def parse_timestamp(value):
+    """Parse an ISO timestamp; naive values are UTC (the Lambda clock)."""
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        try:
+            parsed = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def calculate_timing(results, result_info):
+    """When a result was written and how long its stages took."""
+    processed_at = parse_timestamp(results.get('processed_at')) or parse_timestamp(result_info['last_modified'])
+    run_metrics = results.get('metrics', {})
+    return {
+        'processed_at': processed_at.isoformat(),
+        'processing_ms': run_metrics.get('total_ms'),
+        'stages_ms': {
+            name: fields['wall_ms']
+            for name, fields in run_metrics.get('stages', {}).items()
+            if 'wall_ms' in fields
+        },
+        'cache_hit': results.get('cache_hit', False)
+    }
 
 def calculate_metrics(results):
     """Calculate key metrics from results."""
@@ -108,9 +236,13 @@ def calculate_metrics(results):
     
     # Extraction metrics
     extraction = results.get('extraction', {})
-    metrics['full_text_length'] = len(extraction.get('full_text', ''))
-    metrics['key_value_pairs'] = len(extraction.get('key_value_pairs', {}))
+    metrics['full_text_length'] = len(extraction_text(extraction))
+    metrics['key_value_pairs'] = len(extraction_key_values(extraction))
     metrics['page_count'] = extraction.get('page_count', 0)
+    # Pages read from the PDF's own text layer are not billed by Textract
+    engines = extraction.get('engines')
+    metrics['textract_pages'] = engines.get('textract', 0) if engines is not None else metrics['page_count']
+    metrics['tables'] = sum(len(page.get('tables', [])) for page in extraction.get('pages', []))
     
     # Analysis metrics
     analysis = results.get('analysis', {})
@@ -159,7 +291,8 @@ def display_metrics(metrics):
     print_header("📄 TEXT EXTRACTION METRICS")
     print(f"Text Length: {metrics['full_text_length']:,} characters")
     print(f"Key-Value Pairs: {metrics['key_value_pairs']}")
-    print(f"Page Count: {metrics['page_count']}")
+    print(f"Page Count: {metrics['page_count']} ({metrics['textract_pages']} via Textract)")
+    print(f"Tables: {metrics['tables']}")
     
     print_header("🏷️  ENTITY DETECTION")
     print(f"Total Entities: {metrics['entities_found']}")
@@ -183,9 +316,9 @@ def display_metrics(metrics):
     
     print("\n" + "="*70)
 
-def estimate_cost(metrics):
-    """Estimate the processing cost."""
-    pages = metrics['page_count']
+def calculate_cost(metrics):
+    """Estimate the processing cost of one document."""
+    pages = metrics['textract_pages']
     
     # Textract: $1.50 per 1,000 pages (after free tier)
     textract_cost = (pages / 1000) * 1.50
@@ -198,17 +331,28 @@ def estimate_cost(metrics):
     # Lambda: ~$0.0000002 per invocation (negligible)
     lambda_cost = 0.0000002
     
-    total_cost = textract_cost + comprehend_cost + lambda_cost
-    
+    return {
+        'textract': textract_cost,
+        'comprehend': comprehend_cost,
+        'lambda': lambda_cost,
+        'total': textract_cost + comprehend_cost + lambda_cost
+    }
+
+def display_cost(cost):
+    """Print a cost breakdown."""
     print_header("💰 ESTIMATED COST")
-    print(f"Textract: ${textract_cost:.6f}")
-    print(f"Comprehend: ${comprehend_cost:.6f}")
-    print(f"Lambda: ${lambda_cost:.6f}")
-    print(f"Total: ${total_cost:.6f}")
+    print(f"Textract: ${cost['textract']:.6f}")
+    print(f"Comprehend: ${cost['comprehend']:.6f}")
+    print(f"Lambda: ${cost['lambda']:.6f}")
+    print(f"Total: ${cost['total']:.6f}")
     print("\n(Note: First 1,000 Textract pages/month are free for 3 months)")
     print("=" * 70 + "\n")
 
-def save_results_locally(filename, results, metrics):
+def estimate_cost(metrics):
+    """Estimate and print the processing cost."""
+    display_cost(calculate_cost(metrics))
+
+def save_results_locally(filename, results, metrics, quiet=False):
     """Save results to local directory for offline analysis."""
     RESULTS_DIR.mkdir(exist_ok=True)
     
@@ -222,19 +366,328 @@ def save_results_locally(filename, results, metrics):
     with open(metrics_file, 'w') as f:
         json.dump(metrics, f, indent=2)
     
+    if quiet:
+        return
     print(f"📁 Results saved to: {RESULTS_DIR}")
     print(f"  • Full results: {json_file.name}")
     print(f"  • Metrics: {metrics_file.name}\n")
 
-def main():
-    if len(sys.argv) < 2:
-        print("❌ Error: No filename provided")
-        print("\nUsage: python check-results.py <filename>")
-        print("Example: python check-results.py invoice_001_DOC-2025-2288.pdf")
+def load_manifest(manifest_path):
+    """Filenames listed in a test manifest (see select-test-documents.py)."""
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    return [doc['filename'] for doc in manifest.get('documents', [])]
+
+def load_checkpoint():
+    """
+    Documents already checked by an earlier run, by filename.
+
+    A last line cut short by an interrupted run is skipped, and the file is
+    terminated so the next append starts on a line of its own.
+    """
+    done = {}
+    if not CHECKPOINT_FILE.exists():
+        return done
+    with open(CHECKPOINT_FILE) as f:
+        line = ''
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by an interrupted run
+            done[entry['filename']] = entry
+    if line and not line.endswith('\n'):
+        with open(CHECKPOINT_FILE, 'a') as f:
+            f.write('\n')
+    return done
+
+def append_checkpoint(entry):
+    """Record one finished document so a rerun can skip it."""
+    with open(CHECKPOINT_FILE, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+def check_document(filename, result_info):
+    """Download one result and compute its metrics and cost (runs on a worker)."""
+    entry = {
+        'filename': filename,
+        'key': result_info['key'],
+        'last_modified': result_info['last_modified'].isoformat()
+    }
+    results, error = download_results(result_info['key'])
+    if error:
+        entry.update(status='error', error=error)
+        return entry
+
+    metrics = calculate_metrics(results)
+    save_results_locally(filename, results, metrics, quiet=True)
+    entry.update(status='checked', metrics=metrics, cost=calculate_cost(metrics),
+                 timing=calculate_timing(results, result_info))
+    return entry
+
+def aggregate_entries(entries):
+    """Batch totals for a list of bulk entries."""
+    checked = [e for e in entries if e['status'] == 'checked']
+    totals = {
+        'documents': len(entries),
+        'checked': len(checked),
+        'missing': sum(1 for e in entries if e['status'] == 'missing'),
+        'errors': sum(1 for e in entries if e['status'] == 'error')
+    }
+
+    for field in ('page_count', 'textract_pages', 'full_text_length', 'key_value_pairs',
+                  'tables', 'entities_found', 'key_phrases_count'):
+        totals[field] = sum(e['metrics'][field] for e in checked)
+
+    sentiments = {}
+    entity_types = {}
+    for entry in checked:
+        sentiment = entry['metrics']['sentiment']
+        sentiments[sentiment] = sentiments.get(sentiment, 0) + 1
+        for entity_type, count in entry['metrics']['entity_types'].items():
+            entity_types[entity_type] = entity_types.get(entity_type, 0) + count
+
+    confidences = [e['metrics']['avg_entity_confidence'] for e in checked if e['metrics']['entities_found']]
+    cost = {
+        component: sum(e['cost'][component] for e in checked)
+        for component in ('textract', 'comprehend', 'lambda', 'total')
+    }
+
+    return {
+        'generated_at': datetime.now().isoformat(),
+        'bucket': PROCESSED_BUCKET,
+        'totals': totals,
+        'avg_entity_confidence': round(sum(confidences) / len(confidences), 1) if confidences else 0,
+        'sentiments': sentiments,
+        'entity_types': entity_types,
+        'cost': cost,
+        'cost_per_document': cost['total'] / len(checked) if checked else 0,
+        'missing': [e['filename'] for e in entries if e['status'] == 'missing'],
+        'errors': {e['filename']: e['error'] for e in entries if e['status'] == 'error'}
+    }
+
+def display_bulk_summary(summary):
+    """Print the batch totals."""
+    totals = summary['totals']
+    print_header("📊 BULK RESULTS")
+    print(f"\nDocuments: {totals['documents']}")
+    print(f"Checked: {totals['checked']}")
+    print(f"Missing: {totals['missing']}")
+    print(f"Errors: {totals['errors']}")
+
+    print_header("📄 TEXT EXTRACTION METRICS")
+    print(f"Text Length: {totals['full_text_length']:,} characters")
+    print(f"Key-Value Pairs: {totals['key_value_pairs']}")
+    print(f"Page Count: {totals['page_count']} ({totals['textract_pages']} via Textract)")
+    print(f"Tables: {totals['tables']}")
+
+    print_header("🏷️  ENTITY DETECTION")
+    print(f"Total Entities: {totals['entities_found']}")
+    print(f"Average Confidence: {summary['avg_entity_confidence']}%")
+    if summary['sentiments']:
+        print("\nSentiment:")
+        for sentiment, count in sorted(summary['sentiments'].items()):
+            print(f"  • {sentiment}: {count}")
+
+    display_cost(summary['cost'])
+    print(f"Cost per document: ${summary['cost_per_document']:.6f}\n")
+
+    if summary['missing']:
+        print(f"⚠️  No results yet for {len(summary['missing'])} document(s):")
+        for filename in summary['missing'][:10]:
+            print(f"  • {filename}")
+    for filename, error in list(summary['errors'].items())[:10]:
+        print(f"❌ {filename}: {error}")
+
+def run_bulk(manifest_path=None, workers=DEFAULT_WORKERS, fresh=False, report=False, baseline=None):
+    """
+    Check every document in a manifest (or every processed result when there is
+    no manifest); resumable through the checkpoint file.
+    """
+    RESULTS_DIR.mkdir(exist_ok=True)
+    if fresh and CHECKPOINT_FILE.exists():
+        CHECKPOINT_FILE.unlink()
+
+    print_header(f"🔍 CHECKING DOCUMENTS FROM: {manifest_path or PROCESSED_BUCKET}")
+    print("\n⏳ Listing processed results...\n")
+    try:
+        index = list_processed_results()
+        uploads = list_upload_times() if report else {}
+    except ClientError as e:
+        print(f"❌ Error checking S3: {e}")
         sys.exit(1)
-    
-    filename = sys.argv[1]
-    
+
+    if manifest_path:
+        filenames = load_manifest(manifest_path)
+    else:
+        filenames = sorted({info['name'] for info in index.values()})
+
+    checkpoint = load_checkpoint()
+    entries = {}
+    pending = []
+    for filename in filenames:
+        result_info = index.get(filename)
+        if result_info is None:
+            entries[filename] = {'filename': filename, 'status': 'missing'}
+            continue
+        # Skip documents whose result has not changed since the last run
+        done = checkpoint.get(filename)
+        if (done and done['key'] == result_info['key'] and 'timing' in done
+                and done['last_modified'] == result_info['last_modified'].isoformat()):
+            entries[filename] = done
+            continue
+        pending.append((filename, result_info))
+
+    resumed = sum(1 for e in entries.values() if e['status'] == 'checked')
+    print(f"Found {len(index)} results; {resumed} already checked, {len(pending)} to download")
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(check_document, filename, info) for filename, info in pending]
+        for done_count, future in enumerate(as_completed(futures), 1):
+            entry = future.result()
+            entries[entry['filename']] = entry
+            # Errors are not checkpointed so the next run retries them
+            if entry['status'] == 'checked':
+                append_checkpoint(entry)
+            if done_count % 25 == 0 or done_count == len(futures):
+                print(f"   {done_count}/{len(futures)} downloaded ({time.time() - start:.1f}s)")
+
+    summary = aggregate_entries([entries[filename] for filename in filenames if filename in entries])
+    with open(SUMMARY_FILE, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    display_bulk_summary(summary)
+    print(f"📁 Summary saved to: {SUMMARY_FILE}\n")
+
+    if report:
+        previous = None
+        if baseline:
+            with open(baseline) as f:
+                previous = json.load(f)
+
+        checked = [entries[f] for f in filenames if entries.get(f, {}).get('status') == 'checked']
+        latency_report = build_report(checked, uploads, summary)
+        report_file = RESULTS_DIR / f"latency_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        with open(report_file, 'w') as f:
+            json.dump(latency_report, f, indent=2)
+        display_report(latency_report, previous)
+        print(f"📁 Report saved to: {report_file}\n")
+
+    print("✅ Bulk analysis complete!")
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (None when empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))  # ceil without floats
+    return ordered[int(rank) - 1]
+
+def distribution(values):
+    """p50/p90/p99/max/mean of a list of numbers."""
+    values = [v for v in values if v is not None]
+    if not values:
+        return {'count': 0, 'p50': None, 'p90': None, 'p99': None, 'max': None, 'mean': None}
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values),
+        'mean': round(sum(values) / len(values), 3)
+    }
+
+def build_report(entries, uploads, summary):
+    """Latency percentiles, throughput and cost per page for checked entries."""
+    latencies = []
+    uploaded_times = []
+    processed_times = []
+    stage_values = {}
+
+    for entry in entries:
+        timing = entry['timing']
+        processed_at = parse_timestamp(timing['processed_at'])
+        processed_times.append(processed_at)
+
+        # The result is named after the upload, so this is a straight join
+        uploaded_at = uploads.get(entry['key'][len('processed/'):].rsplit('.', 1)[0])
+        if uploaded_at is not None:
+            uploaded_at = parse_timestamp(uploaded_at)
+            uploaded_times.append(uploaded_at)
+            latencies.append(round((processed_at - uploaded_at).total_seconds(), 3))
+
+        for name, wall_ms in timing['stages_ms'].items():
+            stage_values.setdefault(name, []).append(wall_ms)
+
+    # Throughput over the batch window: first upload (or result) to last result
+    window_minutes = None
+    if processed_times:
+        window_start = min(uploaded_times or processed_times)
+        window_minutes = (max(processed_times) - window_start).total_seconds() / 60
+
+    totals = summary['totals']
+    pages = sum(e['metrics']['page_count'] for e in entries)
+    cost = sum(e['cost']['total'] for e in entries)
+
+    return {
+        'generated_at': datetime.now().isoformat(),
+        'bucket': PROCESSED_BUCKET,
+        'documents': len(entries),
+        'pages': pages,
+        'missing': totals['missing'],
+        'errors': totals['errors'],
+        'cache_hits': sum(1 for e in entries if e['timing'].get('cache_hit')),
+        'without_upload_time': len(entries) - len(latencies),
+        'latency_s': distribution(latencies),
+        'processing_ms': distribution([e['timing']['processing_ms'] for e in entries]),
+        'stages_ms': {name: distribution(values) for name, values in sorted(stage_values.items())},
+        'window_minutes': round(window_minutes, 3) if window_minutes is not None else None,
+        'documents_per_minute': round(len(entries) / window_minutes, 3) if window_minutes else None,
+        'pages_per_minute': round(pages / window_minutes, 3) if window_minutes else None,
+        'cost_total': cost,
+        'cost_per_page': cost / pages if pages else None
+    }
+
+def format_value(value, digits=2):
+    """A number for the report table, or - when missing."""
+    return '-' if value is None else f"{value:,.{digits}f}"
+
+def display_report(report, baseline=None):
+    """Print the latency report as a table, with deltas against a baseline report."""
+    print_header("⏱️  LATENCY REPORT")
+    print(f"\nDocuments: {report['documents']} ({report['pages']} pages, "
+          f"{report['cache_hits']} cache hits, {report['without_upload_time']} without upload time)")
+
+    rows = [('End-to-end latency (s)', report['latency_s'], (baseline or {}).get('latency_s')),
+            ('Processing (ms)', report['processing_ms'], (baseline or {}).get('processing_ms'))]
+    baseline_stages = (baseline or {}).get('stages_ms', {})
+    for name, values in report['stages_ms'].items():
+        rows.append((f"  {name} (ms)", values, baseline_stages.get(name)))
+
+    print(f"\n{'Metric':<26}{'n':>6}{'p50':>12}{'p90':>12}{'p99':>12}{'max':>12}")
+    print("-" * 80)
+    for label, values, previous in rows:
+        print(f"{label:<26}{values['count']:>6}" + ''.join(
+            f"{format_value(values[field]):>12}" for field in ('p50', 'p90', 'p99', 'max')))
+        if previous and previous.get('count'):
+            deltas = []
+            for field in ('p50', 'p90', 'p99', 'max'):
+                if values[field] is None or previous.get(field) is None:
+                    deltas.append(f"{'-':>12}")
+                else:
+                    deltas.append(f"{values[field] - previous[field]:>+12,.2f}")
+            print(f"{'    vs baseline':<32}" + ''.join(deltas))
+
+    print("-" * 80)
+    print(f"Window: {format_value(report['window_minutes'])} min")
+    print(f"Throughput: {format_value(report['documents_per_minute'])} documents/min, "
+          f"{format_value(report['pages_per_minute'])} pages/min")
+    cost_per_page = report['cost_per_page']
+    print(f"Cost per page: {'-' if cost_per_page is None else f'${cost_per_page:.6f}'}")
+    print("=" * 70 + "\n")
+
+def check_single(filename):
+    """Check one document and print its metrics."""
     print_header(f"🔍 CHECKING RESULTS FOR: {filename}")
     print("\n⏳ Searching for processed results...\n")
     
@@ -272,5 +725,30 @@ def main():
     
     print("✅ Analysis complete!")
 
+def main():
+    parser = argparse.ArgumentParser(description="Check document processing results.")
+    parser.add_argument('filename', nargs='?', help="document to check")
+    parser.add_argument('--manifest', help="check every document in a test manifest")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f"concurrent downloads in bulk mode (default {DEFAULT_WORKERS})")
+    parser.add_argument('--fresh', action='store_true',
+                        help="ignore the bulk checkpoint and recheck everything")
+    parser.add_argument('--report', action='store_true',
+                        help="latency percentiles, throughput and cost per page "
+                             "(every processed result unless --manifest is given)")
+    parser.add_argument('--baseline', help="earlier latency report JSON to compare against")
+    args = parser.parse_args()
+
+    if args.report or args.manifest:
+        run_bulk(args.manifest, args.workers, args.fresh, args.report, args.baseline)
+    elif args.filename:
+        check_single(args.filename)
+    else:
+        print("❌ Error: No filename provided")
+        print("\nUsage: python check-results.py <filename>")
+        print("       python check-results.py --manifest <test_manifest.json>")
+        print("Example: python check-results.py invoice_001_DOC-2025-2288.pdf")
+        sys.exit(1)
+
 if __name__ == '__main__':
     main()
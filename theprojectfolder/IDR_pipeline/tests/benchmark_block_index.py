@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Benchmark Textract key/value parsing: linear Id scans vs BlockIndex.
+
+Builds synthetic FORMS responses of 10k-100k blocks and times the old
+`next(b for b in all_blocks if b['Id'] == ...)` lookup against the shared
+block index. The linear version is quadratic, so it is only run up to
+--legacy-limit blocks.
+
+Usage: python tests/benchmark_block_index.py [--legacy-limit 30000]
+"""
+
+import argparse
+import sys
+import os
+import time
+from unittest.mock import Mock
+
+# document_processor creates boto3 clients at import time
+sys.modules.setdefault('boto3', Mock())
+sys.modules.setdefault('botocore', Mock())
+sys.modules.setdefault('botocore.config', Mock())
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../lambda/document-processor'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../lambda/layers/pypdf2/python'))
+
+import document_processor
+from test_document_processor import make_form_blocks
+
+BLOCKS_PER_PAIR = 7
+
+
+def legacy_key_values(blocks):
+    """The pre-index implementation, kept here for comparison"""
+    def text_of(block):
+        text = []
+        for relationship in block.get('Relationships', []):
+            if relationship['Type'] == 'CHILD':
+                for child_id in relationship['Ids']:
+                    child = next((b for b in blocks if b['Id'] == child_id), None)
+                    if child and child['BlockType'] == 'WORD':
+                        text.append(child['Text'])
+        return ' '.join(text)
+
+    pairs = {}
+    for block in blocks:
+        if block['BlockType'] == 'KEY_VALUE_SET' and 'KEY' in block.get('EntityTypes', []):
+            for relationship in block.get('Relationships', []):
+                if relationship['Type'] == 'VALUE':
+                    value = next((b for b in blocks if b['Id'] == relationship['Ids'][0]), None)
+                    if value:
+                        pairs[text_of(block)] = text_of(value)
+    return pairs
+
+
+def indexed_key_values(blocks):
+    index = document_processor.BlockIndex(blocks)
+    pairs = {}
+    for block in index.of_type('KEY_VALUE_SET'):
+        if 'KEY' in block.get('EntityTypes', []):
+            pairs[document_processor.extract_text_from_relationship(block, index)] = \
+                document_processor.extract_value_text(block, index)
+    return pairs
+
+
+def timed(fn, blocks):
+    start = time.perf_counter()
+    result = fn(blocks)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--legacy-limit', type=int, default=30000)
+    args = parser.parse_args()
+
+    print(f"{'blocks':>8} {'legacy (s)':>12} {'indexed (s)':>12} {'speedup':>9}")
+    for target in (10000, 25000, 50000, 100000):
+        blocks = make_form_blocks(target // BLOCKS_PER_PAIR, pages=max(1, target // 2000))
+        indexed_time, indexed = timed(indexed_key_values, blocks)
+
+        if len(blocks) <= args.legacy_limit:
+            legacy_time, legacy = timed(legacy_key_values, blocks)
+            assert legacy == indexed, "index changed parsing output"
+            print(f"{len(blocks):>8} {legacy_time:>12.3f} {indexed_time:>12.4f} {legacy_time / indexed_time:>8.0f}x")
+        else:
+            print(f"{len(blocks):>8} {'skipped':>12} {indexed_time:>12.4f} {'-':>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Benchmark tag compliance evaluation: the old per-resource loop vs compiled rules.
+
+Builds synthetic get_resources mappings (100k by default) across several
+resource types and times the original `lambda_handler` loop (a dict per
+resource, then a list append per missing REQUIRED_TAGS entry) against
+TagPolicy's compiled rules — once with required tags only, for a like-for-like
+comparison, and once with the full policy from config/tag-policy.json
+(allowed values, patterns and per-type rules).
+
+Usage: python tests/benchmark_tag_rules.py [--resources 100000]
+"""
+
+import argparse
+import random
+import sys
+import os
+import time
+from unittest.mock import Mock
+
+# tag_audit_function creates boto3 clients at import time
+sys.modules.setdefault('boto3', Mock())
+sys.modules.setdefault('botocore', Mock())
+sys.modules.setdefault('botocore.config', Mock())
+os.environ.setdefault('SNS_TOPIC_ARN', 'arn:aws:sns:us-east-1:123456789012:TagAuditNotifications')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../lambda/tag-audit'))
+
+import tag_audit_function
+
+POLICY_PATH = os.path.join(os.path.dirname(__file__), '../config/tag-policy.json')
+
+ARN_TEMPLATES = [
+    'arn:aws:ec2:us-east-1:123456789012:instance/i-{:017x}',
+    'arn:aws:ec2:us-east-1:123456789012:volume/vol-{:017x}',
+    'arn:aws:lambda:us-east-1:123456789012:function:fn-{}',
+    'arn:aws:s3:::bucket-{}',
+    'arn:aws:sns:us-east-1:123456789012:topic-{}',
+    'arn:aws:dynamodb:us-east-1:123456789012:table/table-{}',
+]
+
+STANDARD_TAGS = {
+    'Project': 'doc-processing-pipeline',
+    'CostCenter': 'Project1',
+    'Environment': 'dev',
+    'CreatedDate': '2026-01-16',
+    'ManagedBy': 'manual',
+    'Component': 'processing',
+    'Owner': 'platform',
+}
+
+
+def make_mappings(count, seed=7):
+    """Mostly compliant resources, with tags dropped or values broken at random"""
+    rng = random.Random(seed)
+    mappings = []
+    for i in range(count):
+        tags = dict(STANDARD_TAGS)
+        roll = rng.random()
+        if roll < 0.2:
+            for key in rng.sample(sorted(tags), rng.randint(1, 3)):
+                del tags[key]
+        elif roll < 0.3:
+            tags['Environment'] = 'production'
+        elif roll < 0.35:
+            tags['CostCenter'] = 'project-1'
+        mappings.append({
+            'ResourceARN': ARN_TEMPLATES[i % len(ARN_TEMPLATES)].format(i),
+            'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()]
+        })
+    return mappings
+
+
+def legacy_audit(mappings):
+    """The pre-policy lambda_handler loop, kept here for comparison"""
+    non_compliant = []
+    for resource in mappings:
+        existing_tags = {tag['Key']: tag['Value'] for tag in resource.get('Tags', [])}
+        missing_tags = []
+        for required_tag in tag_audit_function.REQUIRED_TAGS:
+            if required_tag not in existing_tags:
+                missing_tags.append(required_tag)
+        if missing_tags:
+            non_compliant.append({
+                'arn': resource['ResourceARN'],
+                'type': tag_audit_function.extract_resource_type(resource['ResourceARN']),
+                'missing_tags': missing_tags,
+                'existing_tags': existing_tags
+            })
+    return non_compliant
+
+
+def compiled_audit(mappings, policy):
+    tag_audit_function.tag_policy = policy
+    counters = tag_audit_function.AuditCounters()
+    for start in range(0, len(mappings), tag_audit_function.RESOURCES_PER_PAGE):
+        counters.add_page(mappings[start:start + tag_audit_function.RESOURCES_PER_PAGE])
+    return counters
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--resources', type=int, default=100000)
+    args = parser.parse_args()
+
+    mappings = make_mappings(args.resources)
+    required_only = tag_audit_function.TagPolicy({'required': tag_audit_function.REQUIRED_TAGS})
+    full_policy = tag_audit_function.load_tag_policy(POLICY_PATH)
+
+    legacy_time, legacy = timed(legacy_audit, mappings)
+    required_time, required = timed(compiled_audit, mappings, required_only)
+    assert required.non_compliant == len(legacy), "compiled rules changed required-tag results"
+    full_time, full = timed(compiled_audit, mappings, full_policy)
+
+    print(f"{len(mappings):,} mappings")
+    print(f"{'evaluation':<28} {'seconds':>9} {'per 100k':>9} {'non-compliant':>14}")
+    for label, seconds, non_compliant in (
+        ('legacy loop', legacy_time, len(legacy)),
+        ('compiled, required only', required_time, required.non_compliant),
+        ('compiled, full policy', full_time, full.non_compliant),
+    ):
+        print(f"{label:<28} {seconds:>9.3f} {seconds * 100000 / len(mappings):>9.3f} {non_compliant:>14,}")
+
+    print("\nViolations by rule (full policy):")
+    for rule, count in sorted(full.rule_violations.items(), key=lambda item: -item[1]):
+        print(f"  {rule:<24} {count:>8,}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+import json
+import gzip
+import importlib.util
+import pytest
+from unittest.mock import Mock
+import sys
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from types import ModuleType, SimpleNamespace
+
+# Mock boto3 and botocore BEFORE loading check-results.py
+sys.modules.setdefault('boto3', Mock())
+sys.modules.setdefault('botocore', Mock())
+sys.modules.setdefault('botocore.config', Mock())
+if 'botocore.exceptions' not in sys.modules:
+    exceptions = ModuleType('botocore.exceptions')
+    exceptions.ClientError = type('ClientError', (Exception,), {})
+    sys.modules['botocore.exceptions'] = exceptions
+os.environ.setdefault('ACCOUNT_ID', '123456789012')
+
+# The script's name has a hyphen, so it is loaded from its path
+SCRIPT_PATH = os.path.join(os.path.dirname(__file__), '../scripts/check-results.py')
+spec = importlib.util.spec_from_file_location('check_results', SCRIPT_PATH)
+check_results = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(check_results)
+
+PROCESSED = check_results.PROCESSED_BUCKET
+UPLOADS = check_results.UPLOAD_BUCKET
+T0 = datetime(2026, 3, 2, 9, 0, tzinfo=timezone.utc)
+
+
+# -------------------------------------------------------
+# Local stand-in for S3
+# -------------------------------------------------------
+
+class FakeS3:
+    """
+    In-memory S3 with ListObjectsV2 pages of at most 1,000 keys. The
+    paginator follows NextContinuationToken the way boto3's does.
+    """
+
+    def __init__(self):
+        self.objects = {}   # (bucket, key) -> (body, last modified, content encoding)
+        self.list_calls = []
+        self.gets = []
+        self.lock = threading.Lock()
+
+    def put(self, bucket, key, body, last_modified=T0, content_encoding=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.objects[(bucket, key)] = (body, last_modified, content_encoding)
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000):
+        self.list_calls.append(ContinuationToken)
+        keys = sorted(k for b, k in self.objects if b == Bucket and k.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + MaxKeys]
+        response = {
+            'KeyCount': len(page),
+            'Contents': [
+                {'Key': k, 'LastModified': self.objects[(Bucket, k)][1], 'Size': len(self.objects[(Bucket, k)][0])}
+                for k in page
+            ]
+        }
+        if start + MaxKeys < len(keys):
+            response['IsTruncated'] = True
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
+
+    def get_paginator(self, name):
+        assert name == 'list_objects_v2'
+        return SimpleNamespace(paginate=self.paginate)
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page = self.list_objects_v2(**kwargs, **({'ContinuationToken': token} if token else {}))
+            yield page
+            token = page.get('NextContinuationToken')
+            if not token:
+                return
+
+    def get_object(self, Bucket, Key):
+        with self.lock:
+            self.gets.append(Key)
+        body, last_modified, content_encoding = self.objects[(Bucket, Key)]
+        response = {'Body': SimpleNamespace(read=lambda: body), 'LastModified': last_modified}
+        if content_encoding:
+            response['ContentEncoding'] = content_encoding
+        return response
+
+
+def make_result(name, processed_at, pages=1, total_ms=1500, stages=None):
+    """A result as document_processor.py saves it"""
+    return {
+        'document_name': f"uploads/phase3/{name}",
+        'processed_at': processed_at.replace(tzinfo=None).isoformat(),
+        'status': 'success',
+        'extraction': {
+            'pages': [{'page': n, 'engine': 'textract', 'lines': [f'Page {n}'], 'key_value_pairs': {}}
+                      for n in range(1, pages + 1)],
+            'page_count': pages,
+            'engines': {'textract': pages}
+        },
+        'analysis': {'entities': [], 'sentiment': {'overall': 'NEUTRAL'}, 'key_phrases': []},
+        'metrics': {
+            'total_ms': total_ms,
+            'stages': {stage: {'wall_ms': ms} for stage, ms in (stages or {'textract': 900}).items()}
+        }
+    }
+
+
+def write_manifest(path, filenames):
+    path.write_text(json.dumps({'documents': [{'filename': f} for f in filenames]}))
+    return str(path)
+
+
+@pytest.fixture
+def s3(monkeypatch, tmp_path):
+    """Install a fake S3 client and point the results directory at tmp_path"""
+    fake = FakeS3()
+    results_dir = tmp_path / 'phase3-results'
+    monkeypatch.setattr(check_results, 's3', fake)
+    monkeypatch.setattr(check_results, 'RESULTS_DIR', results_dir)
+    monkeypatch.setattr(check_results, 'CHECKPOINT_FILE', results_dir / 'bulk_checkpoint.jsonl')
+    monkeypatch.setattr(check_results, 'SUMMARY_FILE', results_dir / 'bulk_summary.json')
+    return fake
+
+
+def add_documents(s3, names, start=T0):
+    """Upload and result objects for each name, uploaded a minute apart"""
+    for i, name in enumerate(names):
+        uploaded_at = start + timedelta(minutes=i)
+        processed_at = uploaded_at + timedelta(seconds=20)
+        s3.put(UPLOADS, f"uploads/phase3/{1760000000 + i}_{name}", b'%PDF-', uploaded_at)
+        s3.put(PROCESSED, f"processed/{1760000000 + i}_{name}.json",
+               json.dumps(make_result(name, processed_at)), processed_at)
+
+
+def checkpoint_lines():
+    return check_results.CHECKPOINT_FILE.read_text().splitlines()
+
+
+# -------------------------------------------------------
+# Tests
+# -------------------------------------------------------
+
+class TestBulkCheck:
+    """Paginated listing, resumable checkpoint and result decoding"""
+
+    def test_listing_follows_continuation_tokens(self, s3):
+        """Test every page of a >1,000 key listing is indexed"""
+        for i in range(2500):
+            s3.put(PROCESSED, f"processed/{1760000000 + i}_doc_{i:04d}.pdf.json", '{}')
+        s3.put(PROCESSED, 'processed/notes.txt', 'ignored')
+
+        index = check_results.list_processed_results()
+
+        assert s3.list_calls == [None, '1000', '2000']
+        # each result under its stored name and its original filename
+        assert len(index) == 5000
+        assert index['doc_2499.pdf']['key'] == 'processed/1760002499_doc_2499.pdf.json'
+
+    def test_latest_result_wins_for_a_reuploaded_file(self, s3):
+        """Test the original filename maps to the newest of several uploads"""
+        s3.put(PROCESSED, 'processed/1760000000_invoice.pdf.json', '{}', T0)
+        s3.put(PROCESSED, 'processed/1760009999_invoice.pdf.json', '{}', T0 + timedelta(hours=1))
+
+        index = check_results.list_processed_results()
+
+        assert index['invoice.pdf']['key'] == 'processed/1760009999_invoice.pdf.json'
+
+    def test_resume_skips_checkpointed_documents(self, s3, tmp_path):
+        """Test a rerun downloads only what the checkpoint does not cover, despite a torn last line"""
+        names = ['a.pdf', 'b.pdf', 'c.pdf', 'd.pdf']
+        add_documents(s3, names)
+        manifest = write_manifest(tmp_path / 'manifest.json', names)
+        check_results.run_bulk(manifest, workers=4)
+        assert len(s3.gets) == 4
+
+        # Interrupted while writing d.pdf's entry, after a.pdf's result changed
+        lines = [line for line in checkpoint_lines() if '"d.pdf"' not in line]
+        torn = next(line for line in checkpoint_lines() if '"d.pdf"' in line)[:40]
+        check_results.CHECKPOINT_FILE.write_text('\n'.join(lines) + '\n' + torn)
+        s3.put(PROCESSED, 'processed/1760000000_a.pdf.json',
+               json.dumps(make_result('a.pdf', T0 + timedelta(minutes=5))), T0 + timedelta(minutes=5))
+        s3.gets.clear()
+
+        check_results.run_bulk(manifest, workers=4)
+
+        assert sorted(s3.gets) == ['processed/1760000000_a.pdf.json', 'processed/1760000003_d.pdf.json']
+        checkpoint = check_results.load_checkpoint()
+        assert sorted(checkpoint) == names
+        assert checkpoint['a.pdf']['last_modified'] == (T0 + timedelta(minutes=5)).isoformat()
+        assert checkpoint['d.pdf']['status'] == 'checked'
+        summary = json.loads(check_results.SUMMARY_FILE.read_text())
+        assert summary['totals']['checked'] == 4
+
+    def test_missing_and_failed_documents_are_not_checkpointed(self, s3, tmp_path):
+        """Test a document without a result, or with an unreadable one, is retried next run"""
+        add_documents(s3, ['a.pdf'])
+        s3.put(PROCESSED, 'processed/1760000001_b.pdf.json', '{not json', T0)
+        manifest = write_manifest(tmp_path / 'manifest.json', ['a.pdf', 'b.pdf', 'late.pdf'])
+
+        check_results.run_bulk(manifest, workers=2)
+
+        assert [json.loads(line)['filename'] for line in checkpoint_lines()] == ['a.pdf']
+        summary = json.loads(check_results.SUMMARY_FILE.read_text())
+        assert summary['missing'] == ['late.pdf']
+        assert list(summary['errors']) == ['b.pdf']
+
+    def test_fresh_rechecks_everything(self, s3, tmp_path):
+        """Test --fresh discards the checkpoint"""
+        add_documents(s3, ['a.pdf', 'b.pdf'])
+        manifest = write_manifest(tmp_path / 'manifest.json', ['a.pdf', 'b.pdf'])
+        check_results.run_bulk(manifest)
+        s3.gets.clear()
+
+        check_results.run_bulk(manifest, fresh=True)
+
+        assert len(s3.gets) == 2
+        assert len(checkpoint_lines()) == 2
+
+    def test_without_manifest_every_result_is_checked(self, s3):
+        """Test bulk mode over the whole bucket checks each result once"""
+        add_documents(s3, ['a.pdf', 'b.pdf', 'c.pdf'])
+
+        check_results.run_bulk()
+
+        assert len(s3.gets) == 3
+
+    @pytest.mark.parametrize('encoding', [None, 'gzip'])
+    def test_decode_ndjson(self, encoding):
+        """Test NDJSON records are folded back into one result, gzipped or not"""
+        result = make_result('a.pdf', T0, pages=3)
+        pages = result['extraction'].pop('pages')
+        lines = [json.dumps({'record': 'document', **result})] + [
+            json.dumps({'record': 'page', **page}) for page in pages
+        ]
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+        if encoding:
+            body = gzip.compress(body)
+
+        decoded = check_results.decode_results(body, 'processed/a.pdf.ndjson', encoding)
+
+        assert decoded['extraction']['pages'] == pages
+        assert decoded['extraction']['page_count'] == 3
+        assert 'record' not in decoded
+        assert check_results.extraction_text(decoded['extraction']) == 'Page 1 Page 2 Page 3'
+
+    def test_gzip_is_detected_without_content_encoding(self):
+        """Test a gzipped body is recognised by its magic bytes"""
+        body = gzip.compress(json.dumps(make_result('a.pdf', T0)).encode('utf-8'))
+
+        decoded = check_results.decode_results(body, 'processed/a.pdf.json')
+
+        assert decoded['document_name'] == 'uploads/phase3/a.pdf'
+
+    def test_gzip_result_round_trip(self, s3):
+        """Test a gzip-encoded result downloads and parses"""
+        body = gzip.compress(json.dumps(make_result('a.pdf', T0)).encode('utf-8'))
+        s3.put(PROCESSED, 'processed/a.pdf.json', body, content_encoding='gzip')
+
+        results, error = check_results.download_results('processed/a.pdf.json')
+
+        assert error is None
+        assert results['status'] == 'success'
+
+
+def report_entries(latencies=(10, 20, 30, 40)):
+    """Checked entries a minute apart, document i having i+1 pages"""
+    entries, uploads = [], {}
+    for i, latency in enumerate(latencies):
+        name = f"{1760000000 + i}_doc{i}.pdf"
+        uploads[name] = T0 + timedelta(minutes=i)
+        entries.append({
+            'filename': f"doc{i}.pdf",
+            'key': f"processed/{name}.json",
+            'status': 'checked',
+            'metrics': {'page_count': i + 1},
+            'cost': {'total': 0.0015 * (i + 1)},
+            'timing': {
+                'processed_at': (uploads[name] + timedelta(seconds=latency)).isoformat(),
+                'processing_ms': 1000 * (i + 1),
+                'stages_ms': {'textract': 500 + 100 * i, 'comprehend': 200},
+                'cache_hit': i == 3
+            }
+        })
+    return entries, uploads
+
+
+SUMMARY = {'totals': {'missing': 1, 'errors': 0}}
+
+
+class TestLatencyReport:
+    """Percentiles, throughput and baseline comparison"""
+
+    @pytest.mark.parametrize('values, pct, expected', [
+        ([], 50, None),
+        ([7], 50, 7),
+        ([7], 99, 7),
+        ([7], 100, 7),
+        ([3, 1, 2], 100, 3),
+        ([3, 1, 2], 0, 1),
+        (list(range(1, 101)), 50, 50),
+        (list(range(1, 101)), 90, 90),
+        (list(range(1, 101)), 99, 99),
+        ([10, 20, 30, 40], 50, 20),
+        ([10, 20, 30, 40], 90, 40),
+    ])
+    def test_percentile_is_nearest_rank(self, values, pct, expected):
+        assert check_results.percentile(values, pct) == expected
+
+    def test_distribution_ignores_missing_values(self):
+        assert check_results.distribution([None, None])['count'] == 0
+        assert check_results.distribution([None, 4, 2]) == {
+            'count': 2, 'p50': 2, 'p90': 4, 'p99': 4, 'max': 4, 'mean': 3.0
+        }
+
+    def test_build_report_on_a_fixed_batch(self):
+        """Test latency, stage timings and throughput for four known documents"""
+        entries, uploads = report_entries()
+
+        report = check_results.build_report(entries, uploads, SUMMARY)
+
+        assert report['documents'] == 4
+        assert report['pages'] == 10
+        assert report['missing'] == 1
+        assert report['cache_hits'] == 1
+        assert report['without_upload_time'] == 0
+        assert report['latency_s'] == {'count': 4, 'p50': 20.0, 'p90': 40.0, 'p99': 40.0, 'max': 40.0, 'mean': 25.0}
+        assert report['processing_ms']['p50'] == 2000
+        assert report['stages_ms']['textract'] == {
+            'count': 4, 'p50': 600, 'p90': 800, 'p99': 800, 'max': 800, 'mean': 650.0
+        }
+        # first upload at T0, last result at T0 + 3 min 40 s
+        assert report['window_minutes'] == 3.667
+        assert report['documents_per_minute'] == 1.091
+        assert report['pages_per_minute'] == 2.727
+        assert report['cost_per_page'] == pytest.approx(0.0015)
+
+    def test_results_without_an_upload_are_counted_but_not_timed(self):
+        entries, uploads = report_entries()
+        del uploads[entries[0]['key'][len('processed/'):-len('.json')]]
+
+        report = check_results.build_report(entries, uploads, SUMMARY)
+
+        assert report['without_upload_time'] == 1
+        assert report['latency_s']['count'] == 3
+
+    def test_empty_batch(self):
+        report = check_results.build_report([], {}, SUMMARY)
+
+        assert report['latency_s']['p50'] is None
+        assert report['documents_per_minute'] is None
+        assert report['cost_per_page'] is None
+
+    def test_baseline_deltas_are_shown(self, capsys):
+        """Test each metric row is followed by its change against the baseline report"""
+        entries, uploads = report_entries()
+        baseline = check_results.build_report(*report_entries(latencies=(5, 10, 15, 20)), SUMMARY)
+        report = check_results.build_report(entries, uploads, SUMMARY)
+
+        check_results.display_report(report, baseline)
+
+        lines = capsys.readouterr().out.splitlines()
+        latency_row = next(i for i, line in enumerate(lines) if line.startswith('End-to-end latency'))
+        assert lines[latency_row + 1].split() == ['vs', 'baseline', '+10.00', '+20.00', '+20.00', '+20.00']
+        assert 'Throughput: 1.09 documents/min, 2.73 pages/min' in lines
+
+    def test_report_run_with_baseline(self, s3, tmp_path, capsys):
+        """Test --report --baseline end to end: the baseline is read before the new report is written"""
+        add_documents(s3, ['a.pdf', 'b.pdf', 'c.pdf'])
+        manifest = write_manifest(tmp_path / 'manifest.json', ['a.pdf', 'b.pdf', 'c.pdf'])
+        check_results.run_bulk(manifest, report=True)
+        (first,) = check_results.RESULTS_DIR.glob('latency_report_*.json')
+        baseline = json.loads(first.read_text())
+        assert baseline['latency_s']['p50'] == 20.0
+        capsys.readouterr()
+
+        check_results.run_bulk(manifest, report=True, baseline=str(first))
+
+        out = capsys.readouterr().out
+        assert 'vs baseline' in out
+        assert '+0.00' in out
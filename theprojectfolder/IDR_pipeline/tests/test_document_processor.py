@@ -0,0 +1,1923 @@
+import json
+import pytest
+from unittest.mock import Mock
+import sys
+import os
+import threading
+import io
+import http.server
+import random
+import urllib.request
+import re
+import hashlib
+import time
+import gzip
+from types import SimpleNamespace
+
+# Mock boto3 and botocore BEFORE importing document_processor
+mock_boto3 = Mock()
+mock_botocore_config = Mock()
+sys.modules['boto3'] = mock_boto3
+sys.modules['botocore'] = Mock()
+sys.modules['botocore.config'] = mock_botocore_config
+
+# Add the lambda directory and the PyPDF2 layer to the path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../lambda/document-processor'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../lambda/layers/pypdf2/python'))
+
+# Now import document_processor (boto3 is already mocked)
+import document_processor
+
+
+# -------------------------------------------------------
+# Local stand-ins for S3, Textract and Comprehend
+# -------------------------------------------------------
+
+class FakeClientError(Exception):
+    """Shaped like botocore's ClientError: the AWS error code lives in .response"""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+def md5_etag(data):
+    return f'"{hashlib.md5(data).hexdigest()}"'
+
+
+class FakeBody:
+    def __init__(self, data):
+        self._data = data
+
+    def read(self):
+        return self._data
+
+
+def parse_range(header, size):
+    """Resolve a 'bytes=start-end' header against an object size"""
+    start, end = header.split('=')[1].split('-')
+    if start == '':
+        return max(0, size - int(end)), size - 1
+    start = int(start)
+    if start >= size:
+        raise Exception('InvalidRange')
+    return start, min(int(end) if end else size - 1, size - 1)
+
+
+class FakeS3:
+    """In-memory S3 with just the calls the pipeline makes"""
+
+    def __init__(self):
+        self.objects = {}
+        self.headers = {}
+        self.range_requests = []
+        self.full_reads = []
+        self.uploads = {}
+        self.deleted = {}
+        self.min_part_size = 5 * 1024 * 1024
+        self.fail_part = None
+        self.parts_in_flight = 0
+        self.peak_parts_in_flight = 0
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None, IfMatch=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        with self.lock:
+            current = self.objects.get((Bucket, Key))
+            if IfNoneMatch == '*' and current is not None:
+                raise FakeClientError('PreconditionFailed')
+            if IfMatch is not None and (current is None or md5_etag(current) != IfMatch):
+                raise FakeClientError('PreconditionFailed')
+            self.objects[(Bucket, Key)] = Body
+            self.headers[(Bucket, Key)] = kwargs
+        return {'ETag': md5_etag(Body)}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise FakeClientError('NoSuchKey')
+        data = self.objects[(Bucket, Key)]
+        if Range is None:
+            self.full_reads.append(Key)
+            return {'Body': FakeBody(data), 'ETag': md5_etag(data)}
+        start, end = parse_range(Range, len(data))
+        self.range_requests.append((Key, start, end))
+        return {
+            'Body': FakeBody(data[start:end + 1]),
+            'ContentRange': f'bytes {start}-{end}/{len(data)}'
+        }
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        with self.lock:
+            upload_id = f'upload-{len(self.uploads)}'
+            self.uploads[upload_id] = {'key': (Bucket, Key), 'parts': {}, 'state': 'open'}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        upload = self.uploads[UploadId]
+        with self.lock:
+            self.parts_in_flight += 1
+            self.peak_parts_in_flight = max(self.peak_parts_in_flight, self.parts_in_flight)
+        try:
+            if self.fail_part == PartNumber:
+                raise Exception('RequestTimeout')
+            upload['parts'][PartNumber] = bytes(Body)
+            return {'ETag': f'"part-{PartNumber}"'}
+        finally:
+            with self.lock:
+                self.parts_in_flight -= 1
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        upload = self.uploads[UploadId]
+        numbers = [p['PartNumber'] for p in MultipartUpload['Parts']]
+        assert numbers == sorted(upload['parts'])
+        for number in numbers[:-1]:
+            assert len(upload['parts'][number]) >= self.min_part_size, 'EntityTooSmall'
+        upload['state'] = 'completed'
+        self.objects[upload['key']] = b''.join(upload['parts'][n] for n in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads[UploadId]['state'] = 'aborted'
+        self.uploads[UploadId]['parts'].clear()
+
+    def delete_objects(self, Bucket, Delete):
+        with self.lock:
+            for entry in Delete['Objects']:
+                if (Bucket, entry['Key']) in self.objects:
+                    self.deleted[(Bucket, entry['Key'])] = self.objects.pop((Bucket, entry['Key']))
+        return {}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        data = self.objects.get((Bucket, Key), Key.encode('utf-8'))
+        return {'ETag': md5_etag(data), 'ContentLength': len(data)}
+
+
+def saved_result(aws, response, index=0):
+    """Load the result file the handler wrote for one record"""
+    entry = json.loads(response['body'])['results'][index]
+    body = aws.s3.objects[('processed-bucket', entry['result_key'])]
+    return json.loads(body)
+
+
+def make_textract_blocks(lines, page=1):
+    """Build a minimal Textract block list with one LINE per entry"""
+    blocks = [{'Id': f'page-{page}', 'BlockType': 'PAGE', 'Page': page, 'Confidence': 99.0}]
+    for i, text in enumerate(lines):
+        blocks.append({
+            'Id': f'line-{page}-{i}',
+            'BlockType': 'LINE',
+            'Text': text,
+            'Page': page,
+            'Confidence': 95.0
+        })
+    return blocks
+
+
+def make_form_blocks(pair_count, pages=1):
+    """Build a Textract FORMS response with `pair_count` key/value pairs"""
+    blocks = []
+    for i in range(pair_count):
+        page = i % pages + 1
+        key_words = [f'k{i}-w0', f'k{i}-w1']
+        value_words = [f'v{i}-w0', f'v{i}-w1']
+        for word in key_words + value_words:
+            blocks.append({'Id': word, 'BlockType': 'WORD', 'Text': word, 'Page': page, 'Confidence': 90.0})
+        blocks.append({
+            'Id': f'key-{i}', 'BlockType': 'KEY_VALUE_SET', 'EntityTypes': ['KEY'], 'Page': page,
+            'Confidence': 90.0,
+            'Relationships': [
+                {'Type': 'VALUE', 'Ids': [f'value-{i}']},
+                {'Type': 'CHILD', 'Ids': key_words}
+            ]
+        })
+        blocks.append({
+            'Id': f'value-{i}', 'BlockType': 'KEY_VALUE_SET', 'EntityTypes': ['VALUE'], 'Page': page,
+            'Confidence': 90.0,
+            'Relationships': [{'Type': 'CHILD', 'Ids': value_words}]
+        })
+        blocks.append({
+            'Id': f'line-{i}', 'BlockType': 'LINE', 'Text': ' '.join(key_words + value_words),
+            'Page': page, 'Confidence': 90.0
+        })
+    return blocks
+
+
+def make_table_blocks(rows, columns, page=1, table_id='table', merged=()):
+    """
+    Build a Textract TABLES response with one WORD per cell ('r<row>c<col>').
+
+    `merged` lists (row, column, row_span, column_span) MERGED_CELL areas.
+    The first row's cells are tagged as column headers.
+    """
+    blocks = [{'Id': table_id, 'BlockType': 'TABLE', 'Page': page, 'Confidence': 97.0, 'Relationships': []}]
+    cell_ids = []
+    for row in range(1, rows + 1):
+        for column in range(1, columns + 1):
+            word_id = f'{table_id}-w{row}-{column}'
+            cell_id = f'{table_id}-c{row}-{column}'
+            cell_ids.append(cell_id)
+            blocks.append({'Id': word_id, 'BlockType': 'WORD', 'Text': f'r{row}c{column}', 'Page': page})
+            blocks.append({
+                'Id': cell_id, 'BlockType': 'CELL', 'Page': page, 'RowIndex': row, 'ColumnIndex': column,
+                'RowSpan': 1, 'ColumnSpan': 1, 'EntityTypes': ['COLUMN_HEADER'] if row == 1 else [],
+                'Relationships': [{'Type': 'CHILD', 'Ids': [word_id]}]
+            })
+    blocks[0]['Relationships'].append({'Type': 'CHILD', 'Ids': cell_ids})
+
+    merged_ids = []
+    for i, (row, column, row_span, column_span) in enumerate(merged):
+        merged_ids.append(f'{table_id}-m{i}')
+        blocks.append({
+            'Id': merged_ids[-1], 'BlockType': 'MERGED_CELL', 'Page': page, 'RowIndex': row,
+            'ColumnIndex': column, 'RowSpan': row_span, 'ColumnSpan': column_span,
+            'Relationships': [{'Type': 'CHILD', 'Ids': [
+                f'{table_id}-c{r}-{c}'
+                for r in range(row, row + row_span) for c in range(column, column + column_span)
+            ]}]
+        })
+    if merged_ids:
+        blocks[0]['Relationships'].append({'Type': 'MERGED_CELL', 'Ids': merged_ids})
+    return blocks
+
+
+def make_pdf(page_count, user_password=None):
+    """Build a small, valid PDF with blank pages"""
+    writer = document_processor.PyPDF2.PdfWriter()
+    for _ in range(page_count):
+        writer.add_blank_page(width=612, height=792)
+    if user_password is not None:
+        writer.encrypt(user_password)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def make_text_pdf(pages):
+    """Build a born-digital PDF; each entry is a page's lines, or None for a page with no text layer"""
+    generic = document_processor.PyPDF2.generic
+    writer = document_processor.PyPDF2.PdfWriter()
+    font = writer._add_object(generic.DictionaryObject({
+        generic.NameObject('/Type'): generic.NameObject('/Font'),
+        generic.NameObject('/Subtype'): generic.NameObject('/Type1'),
+        generic.NameObject('/BaseFont'): generic.NameObject('/Helvetica'),
+    }))
+    for i, lines in enumerate(pages):
+        writer.add_blank_page(width=612, height=792)
+        if not lines:
+            continue
+        content = generic.DecodedStreamObject()
+        content.set_data(b'BT /F1 12 Tf 14 TL 72 720 Td\n' +
+                         b''.join(b'(' + line.encode('latin-1') + b') Tj T*\n' for line in lines) + b'ET')
+        page = writer.pages[i]
+        page[generic.NameObject('/Contents')] = writer._add_object(content)
+        page[generic.NameObject('/Resources')] = generic.DictionaryObject({
+            generic.NameObject('/Font'): generic.DictionaryObject({generic.NameObject('/F1'): font})
+        })
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+INVOICE_LINES = ['Invoice Number: INV-2025-0001', 'Bill To: Acme Corporation', 'Total due: 1,250.00']
+
+
+def make_heavy_pdf(page_count, content_bytes):
+    """Build a PDF whose pages carry large content streams"""
+    generic = document_processor.PyPDF2.generic
+    writer = document_processor.PyPDF2.PdfWriter()
+    for i in range(page_count):
+        writer.add_blank_page(width=612, height=792)
+        page = writer.pages[i]
+        content = generic.DecodedStreamObject()
+        # Hex of random bytes so the stream stays large if it gets compressed
+        noise = random.Random(i).randbytes(content_bytes // 2).hex().encode('ascii')
+        content.set_data(b'% ' + noise + b'\n')
+        page[generic.NameObject('/Contents')] = writer._add_object(content)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves `server.payload` with single-range support, like S3"""
+
+    def do_GET(self):
+        data = self.server.payload
+        start, end = parse_range(self.headers['Range'], len(data))
+        self.server.requests.append((start, end))
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(data[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def range_server():
+    """Local HTTP range server standing in for S3 ranged GETs"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    server.payload = b''
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def fetch_range(start, end):
+        url = f'http://127.0.0.1:{server.server_address[1]}/document.pdf'
+        request = urllib.request.Request(url, headers={'Range': f'bytes={start}-{end}'})
+        with urllib.request.urlopen(request) as response:
+            total = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+            return response.read(), total
+
+    server.fetch_range = fetch_range
+    yield server
+    server.shutdown()
+
+
+# Shard keys carry a random run id; the fakes and assertions use them without it
+SHARD_RUN = re.compile(r'(preprocessed/shards/[^/]+)-[0-9a-f]{12}/')
+
+
+def without_run(key):
+    return SHARD_RUN.sub(r'\1/', key)
+
+
+class FakeTextract:
+    def __init__(self, blocks_by_key=None, fail_keys=(), page_size=1000, polls_before_done=2):
+        self.blocks_by_key = blocks_by_key or {}
+        self.fail_keys = set(fail_keys)
+        self.page_size = page_size
+        self.polls_before_done = polls_before_done
+        self.calls = []
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def analyze_document(self, Document, FeatureTypes):
+        key = without_run(Document['S3Object']['Name'])
+        self.calls.append(key)
+        if key in self.fail_keys:
+            raise Exception(f"UnsupportedDocumentException: {key}")
+        return {'Blocks': self.blocks_by_key.get(key, make_textract_blocks([f'Invoice {key}']))}
+
+    def start_document_analysis(self, DocumentLocation, FeatureTypes, **kwargs):
+        key = without_run(DocumentLocation['S3Object']['Name'])
+        with self.lock:
+            self.calls.append(key)
+            job_id = f'job-{len(self.jobs)}'
+            self.jobs[job_id] = {'key': key, 'polls': 0}
+        return {'JobId': job_id}
+
+    def get_document_analysis(self, JobId, NextToken=None, **kwargs):
+        job = self.jobs[JobId]
+        if job['key'] in self.fail_keys:
+            return {'JobStatus': 'FAILED', 'StatusMessage': 'InvalidS3ObjectException'}
+        if job['polls'] < self.polls_before_done:
+            job['polls'] += 1
+            return {'JobStatus': 'IN_PROGRESS'}
+
+        blocks = self.blocks_by_key.get(job['key'], [])
+        start = int(NextToken or 0)
+        response = {'JobStatus': 'SUCCEEDED', 'Blocks': blocks[start:start + self.page_size]}
+        if start + self.page_size < len(blocks):
+            response['NextToken'] = str(start + self.page_size)
+        return response
+
+
+class FakeComprehend:
+    def __init__(self):
+        self.calls = []
+        self.failing_texts = set()
+        self.lock = threading.Lock()
+
+    def _record(self, name, count=1):
+        with self.lock:
+            self.calls.append((name, count))
+
+    def _entities(self, text):
+        # Every capitalised word is an ORGANIZATION, with chunk-relative offsets
+        return [
+            {'Text': m.group(), 'Type': 'ORGANIZATION', 'Score': 0.99,
+             'BeginOffset': m.start(), 'EndOffset': m.end()}
+            for m in re.finditer(r'[A-Z][a-z]+', text)
+        ]
+
+    def _sentiment(self, text):
+        if 'great' in text:
+            return {'Sentiment': 'POSITIVE',
+                    'SentimentScore': {'Positive': 0.9, 'Negative': 0.0, 'Neutral': 0.1, 'Mixed': 0.0}}
+        return {'Sentiment': 'NEUTRAL',
+                'SentimentScore': {'Positive': 0.1, 'Negative': 0.0, 'Neutral': 0.9, 'Mixed': 0.0}}
+
+    def _key_phrases(self, text):
+        return [{'Text': 'total due', 'Score': 0.97}]
+
+    def _batch(self, name, texts, build):
+        assert len(texts) <= 25
+        assert all(len(t.encode('utf-8')) <= 5000 for t in texts)
+        self._record(name, len(texts))
+        response = {'ResultList': [], 'ErrorList': []}
+        for i, text in enumerate(texts):
+            if text in self.failing_texts:
+                response['ErrorList'].append(
+                    {'Index': i, 'ErrorCode': 'TEXT_SIZE_LIMIT_EXCEEDED', 'ErrorMessage': 'too long'})
+            else:
+                item = build(text)
+                item['Index'] = i
+                response['ResultList'].append(item)
+        return response
+
+    def batch_detect_entities(self, TextList, LanguageCode):
+        return self._batch('batch_detect_entities', TextList, lambda t: {'Entities': self._entities(t)})
+
+    def batch_detect_sentiment(self, TextList, LanguageCode):
+        return self._batch('batch_detect_sentiment', TextList, self._sentiment)
+
+    def batch_detect_key_phrases(self, TextList, LanguageCode):
+        return self._batch('batch_detect_key_phrases', TextList, lambda t: {'KeyPhrases': self._key_phrases(t)})
+
+
+def s3_record(key, bucket='uploads', etag=None):
+    s3_object = {'key': key}
+    if etag:
+        s3_object['eTag'] = etag
+    return {'s3': {'bucket': {'name': bucket}, 'object': s3_object}}
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """Swap the module-level clients for local stand-ins"""
+    fakes = SimpleNamespace()
+    fakes.s3 = FakeS3()
+    fakes.textract = FakeTextract()
+    fakes.comprehend = FakeComprehend()
+    monkeypatch.setattr(document_processor, 's3_client', fakes.s3)
+    monkeypatch.setattr(document_processor, 'textract_client', fakes.textract)
+    monkeypatch.setattr(document_processor, 'comprehend_client', fakes.comprehend)
+    monkeypatch.setattr(document_processor, 'PROCESSED_BUCKET', 'processed-bucket')
+    monkeypatch.setattr(document_processor, 'result_cache', document_processor.MemoryResultCache())
+    monkeypatch.setattr(document_processor, 'ledger',
+                        document_processor.ProcessingLedger(document_processor.MemoryLedgerStore()))
+    yield fakes
+
+
+class TestBatchHandler:
+    """Tests for multi-record S3 events"""
+
+    def test_every_record_is_processed(self, aws):
+        """Test all records in one notification get a result"""
+        keys = [f'uploads/receipt_{i:03d}.png' for i in range(20)]
+        event = {'Records': [s3_record(k) for k in keys]}
+
+        response = document_processor.lambda_handler(event, None)
+
+        assert response['statusCode'] == 200
+        body = json.loads(response['body'])
+        assert body['total'] == 20
+        assert body['succeeded'] == 20
+        assert [r['document_name'] for r in body['results']] == keys
+        assert sorted(aws.textract.calls) == sorted(keys)
+        for k in keys:
+            name = k.split('/')[-1]
+            assert ('processed-bucket', f'processed/{name}.json') in aws.s3.objects
+
+    def test_one_failure_does_not_drop_the_batch(self, aws):
+        """Test a failing record gets its own error entry"""
+        aws.s3.put_object = Mock(side_effect=[
+            {'ETag': '"a"'}, Exception('AccessDenied'), {'ETag': '"c"'}
+        ])
+        event = {'Records': [s3_record(f'uploads/doc_{i}.png') for i in range(3)]}
+
+        response = document_processor.lambda_handler(event, None)
+
+        assert response['statusCode'] == 500
+        body = json.loads(response['body'])
+        assert body['succeeded'] == 2
+        assert body['failed'] == 1
+        errors = [r for r in body['results'] if r['status'] == 'error']
+        assert 'AccessDenied' in errors[0]['error']
+
+    def test_worker_pool_is_bounded(self, aws, monkeypatch):
+        """Test no more than MAX_WORKERS records run at once"""
+        monkeypatch.setattr(document_processor, 'MAX_WORKERS', 3)
+        active = {'now': 0, 'peak': 0}
+        lock = threading.Lock()
+        barrier_release = threading.Event()
+        original = aws.textract.analyze_document
+
+        def slow_analyze(**kwargs):
+            with lock:
+                active['now'] += 1
+                active['peak'] = max(active['peak'], active['now'])
+            barrier_release.wait(0.05)
+            with lock:
+                active['now'] -= 1
+            return original(**kwargs)
+
+        aws.textract.analyze_document = slow_analyze
+        event = {'Records': [s3_record(f'uploads/doc_{i}.png') for i in range(12)]}
+
+        response = document_processor.lambda_handler(event, None)
+
+        assert response['statusCode'] == 200
+        assert active['peak'] <= 3
+
+    def test_empty_event_returns_400(self, aws):
+        """Test an event without records is rejected"""
+        response = document_processor.lambda_handler({'Records': []}, None)
+
+        assert response['statusCode'] == 400
+        assert 'error' in json.loads(response['body'])
+
+
+class TestResultOutput:
+    """Tests for the saved result encodings and the handler summary"""
+
+    def test_default_output_is_compact_json_with_summary_response(self, aws):
+        """Test results are saved without indentation and only summarised in the response"""
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/a.png')]}, None)
+
+        entry = json.loads(response['body'])['results'][0]
+        assert 'result' not in entry
+        assert entry['result_key'] == 'processed/a.png.json'
+        assert entry['summary']['page_count'] == 1
+        assert entry['summary']['textract_mode'] == 'sync'
+        body = aws.s3.objects[('processed-bucket', 'processed/a.png.json')]
+        assert b'\n' not in body and b': ' not in body
+        assert aws.s3.headers[('processed-bucket', 'processed/a.png.json')] == {'ContentType': 'application/json'}
+        assert document_processor.extraction_text(saved_result(aws, response)['extraction']) == 'Invoice uploads/a.png'
+
+    def test_gzip_output_sets_content_encoding(self, aws, monkeypatch):
+        """Test RESULT_COMPRESSION=gzip stores a gzip body with Content-Encoding"""
+        monkeypatch.setattr(document_processor, 'RESULT_COMPRESSION', 'gzip')
+
+        document_processor.lambda_handler({'Records': [s3_record('uploads/a.png')]}, None)
+
+        headers = aws.s3.headers[('processed-bucket', 'processed/a.png.json')]
+        assert headers == {'ContentType': 'application/json', 'ContentEncoding': 'gzip'}
+        body = gzip.decompress(aws.s3.objects[('processed-bucket', 'processed/a.png.json')])
+        assert json.loads(body)['document_name'] == 'uploads/a.png'
+
+    def test_ndjson_writes_a_record_per_page(self):
+        """Test NDJSON puts the document first and each page on its own line"""
+        result = {
+            'document_name': 'a.pdf',
+            'extraction': {'page_count': 2, 'pages': [{'page': 1, 'lines': ['One']},
+                                                      {'page': 2, 'lines': ['Two']}]},
+        }
+
+        body, extension, headers = document_processor.encode_result(result, 'ndjson')
+
+        records = [json.loads(line) for line in body.decode('utf-8').splitlines()]
+        assert extension == '.ndjson'
+        assert headers['ContentType'] == 'application/x-ndjson'
+        assert records[0] == {'record': 'document', 'document_name': 'a.pdf', 'extraction': {'page_count': 2}}
+        assert records[1:] == [{'record': 'page', 'page': 1, 'lines': ['One']},
+                               {'record': 'page', 'page': 2, 'lines': ['Two']}]
+
+    def test_unknown_format_is_a_record_error(self, aws, monkeypatch):
+        """Test a misconfigured RESULT_FORMAT fails the record instead of writing junk"""
+        monkeypatch.setattr(document_processor, 'RESULT_FORMAT', 'xml')
+
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/a.png')]}, None)
+
+        entry = json.loads(response['body'])['results'][0]
+        assert entry['status'] == 'error'
+        assert 'RESULT_FORMAT' in entry['error']
+
+
+class TestBlockIndex:
+    """Tests for Textract response parsing"""
+
+    def test_key_value_pairs_resolved_through_index(self, aws):
+        """Test keys and values are joined from their WORD children"""
+        aws.textract.blocks_by_key['form.png'] = make_form_blocks(50, pages=3)
+
+        extracted = document_processor.extract_text_from_document('uploads', 'form.png')
+
+        assert len(document_processor.extraction_key_values(extracted)) == 50
+        assert document_processor.extraction_key_values(extracted)['k7-w0 k7-w1'] == 'v7-w0 v7-w1'
+        assert extracted['page_count'] == 3
+        assert document_processor.extraction_text(extracted).startswith('k0-w0 k0-w1 v0-w0 v0-w1')
+
+    def test_missing_relationship_targets_are_skipped(self):
+        """Test dangling Ids do not raise"""
+        blocks = [
+            {'Id': 'w1', 'BlockType': 'WORD', 'Text': 'Total'},
+            {'Id': 'k', 'BlockType': 'KEY_VALUE_SET', 'EntityTypes': ['KEY'],
+             'Relationships': [{'Type': 'CHILD', 'Ids': ['w1', 'gone']},
+                               {'Type': 'VALUE', 'Ids': ['also-gone']}]}
+        ]
+        index = document_processor.BlockIndex(blocks)
+
+        assert document_processor.extract_text_from_relationship(blocks[1], index) == 'Total'
+        assert document_processor.extract_value_text(blocks[1], index) is None
+
+    def test_index_buckets(self):
+        """Test per-page and per-type buckets keep document order"""
+        index = document_processor.BlockIndex(make_form_blocks(4, pages=2))
+
+        assert index.page_count == 2
+        assert [b['Id'] for b in index.of_type('LINE')] == ['line-0', 'line-1', 'line-2', 'line-3']
+        assert all(b['Page'] == 2 for b in index.on_page(2))
+        assert index.of_type('TABLE') == []
+
+
+class TestPageRecords:
+    """Tests for the page-structured extraction model"""
+
+    def test_lines_pairs_and_confidence_are_kept_per_page(self, aws, monkeypatch):
+        """Test each page carries its own lines, key/value pairs and confidence"""
+        monkeypatch.setattr(document_processor.time, 'sleep', lambda seconds: None)
+        blocks = make_form_blocks(4, pages=2)
+        blocks[0]['Confidence'] = 50.0  # first WORD of page 1
+        aws.textract.blocks_by_key['form.pdf'] = blocks
+
+        extracted = document_processor.extract_text_from_document('uploads', 'form.pdf', page_count=2)
+
+        first, second = extracted['pages']
+        assert [first['page'], second['page']] == [1, 2]
+        assert first['lines'] == ['k0-w0 k0-w1 v0-w0 v0-w1', 'k2-w0 k2-w1 v2-w0 v2-w1']
+        assert set(first['key_value_pairs']) == {'k0-w0 k0-w1', 'k2-w0 k2-w1'}
+        assert set(second['key_value_pairs']) == {'k1-w0 k1-w1', 'k3-w0 k3-w1'}
+        assert first['confidence'] < second['confidence'] == 90.0
+        assert 'full_text' not in extracted
+
+    def test_full_text_is_derived_in_page_order(self):
+        """Test the flat text joins pages in order, whatever order blocks arrived"""
+        accumulator = document_processor.TextractAccumulator()
+        for block in make_textract_blocks(['Second'], page=2) + make_textract_blocks(['First'], page=1):
+            accumulator.add(block)
+
+        extraction = accumulator.result()
+
+        assert [page['page'] for page in extraction['pages']] == [1, 2]
+        assert document_processor.extraction_text(extraction) == 'First Second'
+
+    def test_ndjson_result_has_one_line_per_page(self, aws, monkeypatch):
+        """Test NDJSON output streams the page records after the document record"""
+        monkeypatch.setattr(document_processor, 'RESULT_FORMAT', 'ndjson')
+        aws.s3.objects[('uploads', 'uploads/statement.pdf')] = make_pdf(2)
+        aws.textract.blocks_by_key['uploads/statement.pdf'] = (
+            make_textract_blocks(['Page one'], page=1) + make_textract_blocks(['Page two'], page=2)
+        )
+        monkeypatch.setattr(document_processor.time, 'sleep', lambda seconds: None)
+
+        document_processor.lambda_handler({'Records': [s3_record('uploads/statement.pdf')]}, None)
+
+        body = aws.s3.objects[('processed-bucket', 'processed/statement.pdf.ndjson')]
+        records = [json.loads(line) for line in body.decode('utf-8').splitlines()]
+        assert [r['record'] for r in records] == ['document', 'page', 'page']
+        assert 'pages' not in records[0]['extraction']
+        assert [r['lines'] for r in records[1:]] == [['Page one'], ['Page two']]
+
+
+class TestTables:
+    """Tests for TABLE/CELL reconstruction"""
+
+    def test_table_grid_is_rebuilt_on_its_page(self, aws):
+        """Test cells land in a row/column grid on the table's page record"""
+        aws.textract.blocks_by_key['uploads/invoice.png'] = make_table_blocks(3, 2)
+
+        extracted = document_processor.extract_text_from_document('uploads', 'uploads/invoice.png')
+
+        table, = extracted['pages'][0]['tables']
+        assert (table['rows'], table['columns']) == (3, 2)
+        assert table['cells'] == [['r1c1', 'r1c2'], ['r2c1', 'r2c2'], ['r3c1', 'r3c2']]
+        assert table['header_rows'] == [1]
+        assert table['merged'] == []
+        assert table['confidence'] == 97.0
+
+    def test_merged_cells_keep_text_in_top_left(self, aws):
+        """Test a MERGED_CELL joins its cells' text and blanks the positions it covers"""
+        aws.textract.blocks_by_key['uploads/invoice.png'] = make_table_blocks(3, 3, merged=[(2, 1, 2, 2)])
+
+        extracted = document_processor.extract_text_from_document('uploads', 'uploads/invoice.png')
+
+        table = extracted['pages'][0]['tables'][0]
+        assert table['cells'][1] == ['r2c1 r2c2 r3c1 r3c2', '', 'r2c3']
+        assert table['cells'][2] == ['', '', 'r3c3']
+        assert table['merged'] == [{'row': 2, 'column': 1, 'row_span': 2, 'column_span': 2}]
+
+    def test_tables_resolve_when_cells_arrive_on_later_result_pages(self, aws, monkeypatch):
+        """Test TABLE blocks seen before their CELLs are still rebuilt (async pagination)"""
+        monkeypatch.setattr(document_processor.time, 'sleep', lambda seconds: None)
+        aws.textract.page_size = 7
+        aws.textract.blocks_by_key['statement.pdf'] = (
+            make_table_blocks(4, 3, page=1, table_id='t1') + make_table_blocks(2, 2, page=2, table_id='t2')
+        )
+
+        extracted = document_processor.extract_text_from_document('uploads', 'statement.pdf', page_count=2)
+
+        assert [len(page['tables']) for page in extracted['pages']] == [1, 1]
+        assert extracted['pages'][0]['tables'][0]['cells'][3] == ['r4c1', 'r4c2', 'r4c3']
+        assert extracted['pages'][1]['tables'][0]['cells'] == [['r1c1', 'r1c2'], ['r2c1', 'r2c2']]
+
+    def test_large_statement_is_linear(self, aws):
+        """Test 50 pages of 200-cell tables parse without per-cell block scans"""
+        blocks = []
+        for page in range(1, 51):
+            blocks.extend(make_table_blocks(40, 5, page=page, table_id=f'p{page}'))
+        accumulator = document_processor.TextractAccumulator()
+        lookups = []
+        get = document_processor.BlockIndex.related
+
+        for block in blocks:
+            accumulator.add(block)
+        with pytest.MonkeyPatch.context() as patch:
+            patch.setattr(document_processor.BlockIndex, 'related',
+                          lambda self, block, kind: (lookups.append(kind), get(self, block, kind))[1])
+            extraction = accumulator.result()
+
+        assert sum(len(page['tables'][0]['cells']) for page in extraction['pages']) == 50 * 40
+        # One CHILD and one MERGED_CELL lookup per table, one CHILD lookup per cell
+        assert len(lookups) == 50 * (2 + 200)
+
+    def test_summary_counts_tables(self, aws):
+        """Test the handler summary reports how many tables were found"""
+        aws.textract.blocks_by_key['uploads/a.png'] = make_table_blocks(2, 2)
+
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/a.png')]}, None)
+
+        assert json.loads(response['body'])['results'][0]['summary']['tables'] == 1
+        assert saved_result(aws, response)['extraction']['pages'][0]['tables'][0]['rows'] == 2
+
+
+class TestLocalText:
+    """Tests for the PyPDF2 text-layer fast path"""
+
+    @pytest.fixture(autouse=True)
+    def no_sleep(self, monkeypatch):
+        monkeypatch.setattr(document_processor.time, 'sleep', lambda seconds: None)
+
+    @pytest.fixture
+    def local_text(self, monkeypatch):
+        monkeypatch.setattr(document_processor, 'LOCAL_TEXT_EXTRACTION', True)
+
+    def test_born_digital_pdf_skips_textract(self, aws, local_text):
+        """Test a PDF whose every page has a text layer never reaches Textract"""
+        aws.s3.objects[('uploads', 'uploads/invoice.pdf')] = make_text_pdf([INVOICE_LINES, INVOICE_LINES])
+
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/invoice.pdf')]}, None)
+
+        extraction = saved_result(aws, response)['extraction']
+        assert aws.textract.calls == []
+        assert extraction['textract_mode'] == 'none'
+        assert extraction['engines'] == {'pypdf2': 2}
+        assert extraction['pages'][0]['lines'] == INVOICE_LINES
+        assert document_processor.extraction_text(extraction).startswith('Invoice Number: INV-2025-0001 Bill To')
+        assert json.loads(response['body'])['results'][0]['summary']['engines'] == {'pypdf2': 2}
+
+    def test_text_layer_reuses_the_preprocessed_download(self, aws, local_text, monkeypatch):
+        """Test the PDF preprocessing fetched is read again from memory, not from S3"""
+        monkeypatch.setattr(document_processor, 'PDF_FULL_READ_MAX_BYTES', 10 * 1024 * 1024)
+        aws.s3.objects[('uploads', 'uploads/invoice.pdf')] = make_text_pdf([INVOICE_LINES, INVOICE_LINES])
+
+        document_processor.lambda_handler({'Records': [s3_record('uploads/invoice.pdf')]}, None)
+
+        assert aws.s3.full_reads == ['uploads/invoice.pdf']
+        assert aws.s3.range_requests == []
+
+    def test_only_scanned_pages_go_to_textract(self, aws, local_text):
+        """Test pages without a text layer are cut out and sent to Textract on their own"""
+        aws.s3.objects[('uploads', 'uploads/mixed.pdf')] = make_text_pdf([INVOICE_LINES, None, INVOICE_LINES])
+        aws.textract.blocks_by_key['preprocessed/shards/mixed/pages-00002-00002.pdf'] = (
+            make_textract_blocks(['Scanned signature page'])
+        )
+
+        extracted = document_processor.extract_document('uploads', 'uploads/mixed.pdf', page_count=3)
+
+        assert aws.textract.calls == ['preprocessed/shards/mixed/pages-00002-00002.pdf']
+        assert [page['engine'] for page in extracted['pages']] == ['pypdf2', 'textract', 'pypdf2']
+        assert extracted['pages'][1]['page'] == 2
+        assert extracted['pages'][1]['lines'] == ['Scanned signature page']
+        assert extracted['engines'] == {'pypdf2': 2, 'textract': 1}
+        assert extracted['page_count'] == 3
+
+    def test_text_layer_heuristics(self, monkeypatch):
+        """Test density and glyph-mapping checks reject unusable text layers"""
+        monkeypatch.setattr(document_processor, 'LOCAL_TEXT_MIN_CHARS', 40)
+        good = ' '.join(INVOICE_LINES)
+
+        assert document_processor.has_text_layer(good)
+        assert not document_processor.has_text_layer('Page 1')
+        assert not document_processor.has_text_layer(good + ' (cid:12)(cid:40)(cid:7)')
+        assert not document_processor.has_text_layer(good + '\ue001\ue002')
+        assert not document_processor.has_text_layer('%$#@! ' * 20)
+
+    def test_text_layer_pdf_keeps_forms_and_tables_by_default(self, aws):
+        """Test a born-digital invoice still gets Textract key/value pairs and tables"""
+        assert document_processor.LOCAL_TEXT_EXTRACTION is False
+        aws.s3.objects[('uploads', 'uploads/invoice.pdf')] = make_text_pdf([INVOICE_LINES])
+        aws.textract.blocks_by_key['uploads/invoice.pdf'] = (
+            make_textract_blocks(INVOICE_LINES) + make_form_blocks(2) + make_table_blocks(2, 3)
+        )
+
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/invoice.pdf')]}, None)
+
+        extraction = saved_result(aws, response)['extraction']
+        assert aws.textract.calls == ['uploads/invoice.pdf']
+        assert extraction['engines'] == {'textract': 1}
+        assert extraction['pages'][0]['key_value_pairs'] == {'k0-w0 k0-w1': 'v0-w0 v0-w1', 'k1-w0 k1-w1': 'v1-w0 v1-w1'}
+        assert len(extraction['pages'][0]['tables']) == 1
+        summary = json.loads(response['body'])['results'][0]['summary']
+        assert summary['key_value_pairs'] == 2
+        assert summary['tables'] == 1
+
+
+class TestAsyncTextract:
+    """Tests for the multi-page StartDocumentAnalysis path"""
+
+    @pytest.fixture(autouse=True)
+    def no_sleep(self, monkeypatch):
+        sleeps = []
+        monkeypatch.setattr(document_processor.time, 'sleep', sleeps.append)
+        yield sleeps
+
+    def test_multi_page_pdf_uses_async_job(self, aws):
+        """Test a 3-page PDF is routed to StartDocumentAnalysis by page count"""
+        aws.s3.objects[('uploads', 'uploads/statement.pdf')] = make_pdf(3)
+        aws.textract.blocks_by_key['uploads/statement.pdf'] = (
+            make_textract_blocks(['Page one'], page=1) +
+            make_textract_blocks(['Page two'], page=2) +
+            make_textract_blocks(['Page three'], page=3)
+        )
+
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/statement.pdf')]}, None)
+
+        result = saved_result(aws, response)
+        assert result['extraction']['textract_mode'] == 'async'
+        assert result['extraction']['page_count'] == 3
+        assert document_processor.extraction_text(result['extraction']) == 'Page one Page two Page three'
+        assert aws.textract.jobs
+
+    def test_single_page_pdf_stays_sync(self, aws):
+        """Test single-page PDFs keep using AnalyzeDocument"""
+        aws.s3.objects[('uploads', 'uploads/receipt.pdf')] = make_pdf(1)
+
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/receipt.pdf')]}, None)
+
+        result = saved_result(aws, response)
+        assert result['extraction']['textract_mode'] == 'sync'
+        assert not aws.textract.jobs
+
+    def test_results_are_paginated_and_keys_span_pages(self, aws, no_sleep):
+        """Test NextToken pages are followed and KEY children resolve across pages"""
+        aws.textract.page_size = 5
+        blocks = make_form_blocks(40, pages=4)
+        # Put every KEY block before its WORD children so they land on later pages
+        blocks.sort(key=lambda b: b['BlockType'] != 'KEY_VALUE_SET')
+        aws.textract.blocks_by_key['big.pdf'] = blocks
+
+        extracted = document_processor.extract_text_from_document('uploads', 'big.pdf', page_count=4)
+
+        assert len(document_processor.extraction_key_values(extracted)) == 40
+        assert document_processor.extraction_key_values(extracted)['k39-w0 k39-w1'] == 'v39-w0 v39-w1'
+        assert extracted['page_count'] == 4
+        # Exponential backoff with jitter between polls
+        assert no_sleep[0] == 1
+        assert 1 <= no_sleep[1] <= 2
+
+    def test_blocks_are_consumed_as_a_stream(self, aws, monkeypatch):
+        """Test the accumulator sees blocks before the job is fully paged"""
+        aws.textract.page_size = 10
+        aws.textract.blocks_by_key['big.pdf'] = make_form_blocks(20, pages=2)
+        fetches = []
+        seen = []
+        get = aws.textract.get_document_analysis
+
+        def tracking_get(**kwargs):
+            fetches.append(len(seen))
+            return get(**kwargs)
+
+        original_add = document_processor.TextractAccumulator.add
+        monkeypatch.setattr(aws.textract, 'get_document_analysis', tracking_get)
+        monkeypatch.setattr(document_processor.TextractAccumulator, 'add',
+                            lambda self, block: (seen.append(block['Id']), original_add(self, block)))
+
+        document_processor.extract_text_from_document('uploads', 'big.pdf', page_count=2)
+
+        # Later result pages are requested only after earlier blocks were consumed
+        assert fetches[-1] > 0
+
+    def test_failed_job_returns_error_entry(self, aws):
+        """Test a FAILED job surfaces as an extraction error"""
+        aws.textract.fail_keys.add('broken.pdf')
+
+        extracted = document_processor.extract_text_from_document('uploads', 'broken.pdf', page_count=5)
+
+        assert extracted['page_count'] == 0
+        assert 'InvalidS3ObjectException' in extracted['error']
+
+    def test_job_timeout(self, aws, monkeypatch):
+        """Test polling gives up after TEXTRACT_ASYNC_TIMEOUT"""
+        aws.textract.polls_before_done = 10 ** 6
+        monkeypatch.setattr(document_processor, 'TEXTRACT_ASYNC_TIMEOUT', 0)
+
+        extracted = document_processor.extract_text_from_document('uploads', 'slow.pdf', page_count=2)
+
+        assert 'still IN_PROGRESS' in extracted['error']
+
+
+class TestShardedTextract:
+    """Tests for splitting large PDFs into parallel Textract shards"""
+
+    @pytest.fixture(autouse=True)
+    def small_shards(self, monkeypatch):
+        monkeypatch.setattr(document_processor, 'SHARD_THRESHOLD_PAGES', 4)
+        monkeypatch.setattr(document_processor, 'SHARD_PAGES', 3)
+        monkeypatch.setattr(document_processor.time, 'sleep', lambda seconds: None)
+
+    def shard_blocks(self, aws, name, ranges):
+        """Give every shard page-local blocks whose text names the document page"""
+        for first, last in ranges:
+            key = f'preprocessed/shards/{name}/pages-{first:05d}-{last:05d}.pdf'
+            aws.textract.blocks_by_key[key] = [
+                block
+                for page in range(first, last + 1)
+                for block in make_textract_blocks([f'Page {page}'], page=page - first + 1)
+            ]
+
+    def test_large_pdf_is_split_and_reassembled_in_page_order(self, aws):
+        """Test shards are uploaded, analyzed and merged with rebased page numbers"""
+        aws.s3.objects[('uploads', 'uploads/ledger.pdf')] = make_pdf(7)
+        self.shard_blocks(aws, 'ledger', [(1, 3), (4, 6), (7, 7)])
+
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/ledger.pdf')]}, None)
+
+        result = saved_result(aws, response)
+        extraction = result['extraction']
+        assert extraction['textract_mode'] == 'sharded'
+        assert extraction['shards'] == 3
+        assert extraction['page_count'] == 7
+        assert document_processor.extraction_text(extraction) == ' '.join(f'Page {page}' for page in range(1, 8))
+
+        # Shards are written next to the upload and deleted once analyzed
+        assert not any(k.startswith('preprocessed/shards/') for _, k in aws.s3.objects)
+        shard_keys = sorted(k for _, k in aws.s3.deleted if k.startswith('preprocessed/shards/ledger-'))
+        assert [without_run(k) for k in shard_keys] == [
+            'preprocessed/shards/ledger/pages-00001-00003.pdf',
+            'preprocessed/shards/ledger/pages-00004-00006.pdf',
+            'preprocessed/shards/ledger/pages-00007-00007.pdf',
+        ]
+        page_counts = [
+            len(document_processor.PyPDF2.PdfReader(io.BytesIO(aws.s3.deleted[('uploads', k)])).pages)
+            for k in shard_keys
+        ]
+        assert page_counts == [3, 3, 1]
+        # The single-page shard goes through the synchronous API
+        assert len(aws.textract.jobs) == 2
+
+    def test_documents_with_the_same_name_keep_their_own_shards(self, aws):
+        """Test same-named uploads never overwrite, or delete, each other's shards"""
+        aws.s3.objects[('uploads', 'team-a/ledger.pdf')] = make_pdf(7)
+        aws.s3.objects[('uploads', 'team-b/ledger.pdf')] = make_pdf(5)
+
+        first = document_processor.split_pdf('uploads', 'team-a/ledger.pdf', list(range(1, 8)))
+        second = document_processor.split_pdf('uploads', 'team-b/ledger.pdf', list(range(1, 6)))
+        document_processor.delete_shards('uploads', first)
+
+        assert not {k for k, _ in first} & {k for k, _ in second}
+        page_counts = [
+            len(document_processor.PyPDF2.PdfReader(io.BytesIO(aws.s3.objects[('uploads', k)])).pages)
+            for k, _ in second
+        ]
+        assert page_counts == [3, 2]
+
+    def test_shard_concurrency_is_bounded(self, aws, monkeypatch):
+        """Test no more than SHARD_CONCURRENCY shards are analyzed at once"""
+        monkeypatch.setattr(document_processor, 'SHARD_CONCURRENCY', 2)
+        monkeypatch.setattr(document_processor, 'SHARD_PAGES', 1)
+        aws.s3.objects[('uploads', 'uploads/scan.pdf')] = make_pdf(6)
+        lock = threading.Lock()
+        in_flight = [0]
+        peak = [0]
+        analyze_shard = document_processor.analyze_shard
+        pause = threading.Event()
+
+        def tracking_analyze(*args):
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            pause.wait(0.02)
+            try:
+                return analyze_shard(*args)
+            finally:
+                with lock:
+                    in_flight[0] -= 1
+
+        monkeypatch.setattr(document_processor, 'analyze_shard', tracking_analyze)
+
+        extracted = document_processor.extract_text_from_document('uploads', 'uploads/scan.pdf', page_count=6)
+
+        assert extracted['shards'] == 6
+        assert peak[0] == 2
+
+    def test_failed_shard_keeps_other_pages(self, aws):
+        """Test one failing shard reports its page range without losing the rest"""
+        aws.s3.objects[('uploads', 'uploads/ledger.pdf')] = make_pdf(6)
+        self.shard_blocks(aws, 'ledger', [(1, 3), (4, 6)])
+        aws.textract.fail_keys.add('preprocessed/shards/ledger/pages-00004-00006.pdf')
+
+        extracted = document_processor.extract_text_from_document('uploads', 'uploads/ledger.pdf', page_count=6)
+
+        assert document_processor.extraction_text(extracted) == 'Page 1 Page 2 Page 3'
+        assert extracted['error'].startswith('pages 4-6:')
+        assert len(aws.s3.deleted) == 2
+        assert not any(k.startswith('preprocessed/shards/') for _, k in aws.s3.objects)
+
+    def test_unsplittable_pdf_falls_back_to_one_job(self, aws):
+        """Test a PDF PyPDF2 cannot split is analyzed as a single async job"""
+        aws.s3.objects[('uploads', 'uploads/odd.pdf')] = b'not a pdf at all'
+        aws.textract.blocks_by_key['uploads/odd.pdf'] = make_textract_blocks(['Whole document'])
+
+        extracted = document_processor.extract_text_from_document('uploads', 'uploads/odd.pdf', page_count=9)
+
+        assert extracted['textract_mode'] == 'async'
+        assert document_processor.extraction_text(extracted) == 'Whole document'
+
+
+class TestPdfTriage:
+    """Tests for the skip-if-clean preprocessing fast path"""
+
+    def test_clean_pdf_skips_rewrite_and_upload(self, aws):
+        """Test a clean PDF goes to Textract under its original key"""
+        aws.s3.objects[('uploads', 'uploads/invoice.pdf')] = make_pdf(1)
+
+        result = document_processor.preprocess_document('uploads', 'uploads/invoice.pdf')
+
+        assert result == ('uploads', 'uploads/invoice.pdf', 1)
+        assert ('uploads', 'preprocessed/invoice.pdf') not in aws.s3.objects
+
+    def test_always_normalize_forces_rewrite(self, aws, monkeypatch):
+        """Test ALWAYS_NORMALIZE restores the unconditional rewrite"""
+        monkeypatch.setattr(document_processor, 'ALWAYS_NORMALIZE', True)
+        aws.s3.objects[('uploads', 'uploads/invoice.pdf')] = make_pdf(2)
+
+        result = document_processor.preprocess_document('uploads', 'uploads/invoice.pdf')
+
+        assert result == ('uploads', 'preprocessed/invoice.pdf', 2)
+        assert ('uploads', 'preprocessed/invoice.pdf') in aws.s3.objects
+
+    def test_encrypted_pdf_is_normalized(self, aws):
+        """Test an empty-password encrypted PDF is decrypted and rewritten"""
+        pdf = make_pdf(1, user_password='')
+        assert document_processor.triage_pdf(pdf, 'locked.pdf') == (['encrypted'], 0)
+        aws.s3.objects[('uploads', 'uploads/locked.pdf')] = pdf
+
+        result = document_processor.preprocess_document('uploads', 'uploads/locked.pdf')
+
+        assert result == ('uploads', 'preprocessed/locked.pdf', 1)
+
+    def test_broken_startxref_is_flagged(self):
+        """Test a stale startxref offset needs a rewrite"""
+        pdf = make_pdf(1)
+        # Shift every object by prepending junk after the header line
+        broken = pdf.replace(b'\n', b'\n%junk-comment-line\n', 1)
+
+        issues, _ = document_processor.triage_pdf(broken, 'broken.pdf')
+
+        assert issues == ['startxref does not point at an xref table']
+
+    def test_indirect_page_count_is_resolved(self):
+        """Test a /Count stored as an indirect object is compared as a number"""
+        generic = document_processor.PyPDF2.generic
+        writer = document_processor.PyPDF2.PdfWriter()
+        for _ in range(2):
+            writer.add_blank_page(width=612, height=792)
+        writer._root_object['/Pages'][generic.NameObject('/Count')] = writer._add_object(generic.NumberObject(2))
+        buffer = io.BytesIO()
+        writer.write(buffer)
+
+        assert document_processor.triage_pdf(buffer.getvalue(), 'indirect.pdf') == ([], 2)
+
+    def test_bad_header_and_trailer_are_flagged(self):
+        """Test header/version and trailer checks"""
+        pdf = make_pdf(1)
+
+        assert document_processor.triage_pdf(b'GIF89a' + pdf, 'x.pdf')[0] == ['missing %PDF header']
+        assert 'unsupported PDF version 9.9' in document_processor.triage_pdf(
+            pdf.replace(b'%PDF-1.3', b'%PDF-9.9', 1), 'x.pdf')[0]
+        assert document_processor.triage_pdf(pdf[:-200], 'x.pdf')[0] == ['missing startxref/%%EOF trailer']
+
+    def test_clean_pdf_reports_page_count(self):
+        """Test triage returns the page count used for Textract routing"""
+        assert document_processor.triage_pdf(make_pdf(4), 'x.pdf') == ([], 4)
+
+
+class TestResultCache:
+    """Tests for content-addressed result reuse"""
+
+    def test_identical_upload_skips_paid_calls(self, aws):
+        """Test a repeated ETag is served from cache under the new key"""
+        first = {'Records': [s3_record('uploads/a.png', etag='abc123')]}
+        second = {'Records': [s3_record('uploads/copy-of-a.png', etag='abc123')]}
+
+        document_processor.lambda_handler(first, None)
+        response = document_processor.lambda_handler(second, None)
+
+        assert aws.textract.calls == ['uploads/a.png']
+        saved = json.loads(aws.s3.objects[('processed-bucket', 'processed/copy-of-a.png.json')])
+        assert saved['cache_hit'] is True
+        assert saved['document_name'] == 'uploads/copy-of-a.png'
+        assert document_processor.extraction_text(saved['extraction']) == 'Invoice uploads/a.png'
+        cache = json.loads(response['body'])['cache']
+        assert cache['hits'] == 1
+        assert cache['misses'] == 1
+
+    def test_pipeline_version_is_part_of_key(self, aws, monkeypatch):
+        """Test a config change invalidates earlier results"""
+        monkeypatch.setattr(document_processor, 'ledger', None)
+        document_processor.lambda_handler({'Records': [s3_record('uploads/a.png', etag='abc')]}, None)
+        monkeypatch.setattr(document_processor, 'PIPELINE_VERSION', 'next')
+        document_processor.lambda_handler({'Records': [s3_record('uploads/a.png', etag='abc')]}, None)
+
+        assert len(aws.textract.calls) == 2
+
+    @pytest.mark.parametrize('setting, change', [
+        ('COMPREHEND_MODE', lambda mode: 'truncate' if mode == 'full' else 'full'),
+        ('LOCAL_TEXT_EXTRACTION', lambda enabled: not enabled),
+        ('SHARD_PAGES', lambda pages: pages + 1),
+    ])
+    def test_output_settings_are_part_of_key(self, setting, change, monkeypatch):
+        """Test an env setting that changes the result also changes the key"""
+        before = document_processor.document_cache_key('uploads', 'uploads/a.png', 'abc')
+        monkeypatch.setattr(document_processor, setting, change(getattr(document_processor, setting)))
+
+        after = document_processor.document_cache_key('uploads', 'uploads/a.png', 'abc')
+
+        assert after != before
+        assert after.startswith(document_processor.PIPELINE_VERSION + '-')
+
+    def test_missing_etag_falls_back_to_head_object(self, aws):
+        """Test records without eTag use HeadObject"""
+        aws.s3.objects[('uploads', 'uploads/a.png')] = b'png-bytes'
+
+        key = document_processor.document_cache_key('uploads', 'uploads/a.png')
+
+        assert key == f"{document_processor.pipeline_fingerprint()}/{hashlib.md5(b'png-bytes').hexdigest()}"
+
+    def test_errors_are_not_cached(self, aws):
+        """Test a Textract failure is retried on the next upload"""
+        aws.textract.fail_keys.add('uploads/a.png')
+        document_processor.lambda_handler({'Records': [s3_record('uploads/a.png', etag='e')]}, None)
+        aws.textract.fail_keys.clear()
+        document_processor.lambda_handler({'Records': [s3_record('uploads/a.png', etag='e')]}, None)
+
+        assert len(aws.textract.calls) == 2
+
+    def test_memory_lru_evicts_oldest(self):
+        """Test the in-memory store is bounded"""
+        cache = document_processor.MemoryResultCache(max_entries=2)
+        cache.put('a', {'n': 1})
+        cache.put('b', {'n': 2})
+        cache.get('a')
+        cache.put('c', {'n': 3})
+
+        assert cache.get('b') is None
+        assert cache.get('a') == {'n': 1}
+        assert cache.stats()['size'] == 2
+
+    def test_memory_cache_evicts_by_size(self):
+        """Test large results push older ones out by bytes, and one over the budget is never kept"""
+        cache = document_processor.MemoryResultCache(max_entries=100, max_bytes=250)
+        cache.put('a', {'text': 'a' * 100})
+        cache.put('b', {'text': 'b' * 100})
+        cache.put('c', {'text': 'c' * 100})
+
+        assert cache.get('a') is None
+        assert cache.get('b') and cache.get('c')
+        assert cache.stats()['bytes'] == 2 * len('{"text":""}') + 200
+
+        cache.put('huge', {'text': 'x' * 1000})
+        assert cache.get('huge') is None
+        assert cache.stats()['size'] == 2
+
+        cache.put('b', {'text': 'small'})
+        assert cache.stats()['bytes'] == len('{"text":"small"}') + len('{"text":""}') + 100
+
+    def test_sqlite_backend_persists_across_instances(self, tmp_path):
+        """Test the persistent stand-in survives a cold start"""
+        path = str(tmp_path / 'cache.sqlite3')
+        document_processor.SQLiteResultCache(path).put('v1/etag', {'status': 'success'})
+
+        cold = document_processor.TieredResultCache(
+            document_processor.MemoryResultCache(), document_processor.SQLiteResultCache(path)
+        )
+
+        assert cold.get('v1/etag') == {'status': 'success'}
+        assert cold.get('v1/etag') == {'status': 'success'}
+        stats = cold.stats()
+        assert stats['persistent']['hits'] == 1
+        assert stats['memory']['hits'] == 1
+
+    def test_s3_backend_round_trip(self, aws):
+        """Test the S3 backend stores results under the cache prefix"""
+        cache = document_processor.S3ResultCache(bucket='processed-bucket')
+
+        assert cache.get('v1/etag') is None
+        cache.put('v1/etag', {'status': 'success'})
+
+        assert ('processed-bucket', 'cache/v1/etag.json') in aws.s3.objects
+        assert cache.get('v1/etag') == {'status': 'success'}
+        assert cache.stats() == {'backend': 's3', 'hits': 1, 'misses': 1}
+
+    def test_disabled_cache(self, aws, monkeypatch):
+        """Test RESULT_CACHE_BACKEND=none processes every upload"""
+        monkeypatch.setattr(document_processor, 'result_cache', document_processor.build_result_cache('none'))
+        monkeypatch.setattr(document_processor, 'ledger', None)
+        for _ in range(2):
+            document_processor.lambda_handler({'Records': [s3_record('uploads/a.png', etag='e')]}, None)
+
+        assert len(aws.textract.calls) == 2
+
+
+class TestProcessingLedger:
+    """Tests for at-most-once processing of redelivered S3 events"""
+
+    @pytest.fixture(params=['memory', 'sqlite', 's3'])
+    def store(self, request, aws, tmp_path):
+        if request.param == 'memory':
+            return document_processor.MemoryLedgerStore()
+        if request.param == 'sqlite':
+            return document_processor.SQLiteLedgerStore(str(tmp_path / 'ledger.sqlite3'))
+        return document_processor.S3LedgerStore(bucket='processed-bucket')
+
+    def test_duplicate_in_one_batch_is_processed_once(self, aws):
+        """Test two deliveries of the same object version in one event pay once"""
+        record = s3_record('uploads/a.png', etag='abc')
+
+        response = document_processor.lambda_handler({'Records': [record, dict(record)]}, None)
+
+        body = json.loads(response['body'])
+        assert response['statusCode'] == 200
+        assert aws.textract.calls == ['uploads/a.png']
+        assert sorted(r['status'] for r in body['results']) == ['duplicate', 'success']
+        assert (body['succeeded'], body['duplicates'], body['failed']) == (1, 1, 0)
+
+    def test_redelivery_after_done_is_skipped_but_new_version_is_not(self, aws, monkeypatch):
+        """Test the ledger key follows the object version, not just the key"""
+        monkeypatch.setattr(document_processor, 'result_cache', None)
+        document_processor.lambda_handler({'Records': [s3_record('uploads/a.png', etag='v1')]}, None)
+
+        retry = document_processor.lambda_handler({'Records': [s3_record('uploads/a.png', etag='v1')]}, None)
+        document_processor.lambda_handler({'Records': [s3_record('uploads/a.png', etag='v2')]}, None)
+
+        assert json.loads(retry['body'])['results'][0] == {
+            'document_name': 'uploads/a.png', 'status': 'duplicate', 'ledger_state': 'done'
+        }
+        assert aws.textract.calls == ['uploads/a.png', 'uploads/a.png']
+
+    def test_version_id_takes_precedence_over_etag(self, aws):
+        """Test versioned buckets key the ledger by versionId"""
+        s3_object = {'key': 'a.png', 'eTag': 'abc', 'versionId': 'v7'}
+
+        assert document_processor.document_ledger_key('uploads', 'a.png', s3_object) == (
+            f"{document_processor.PIPELINE_VERSION}/uploads/a.png@v7"
+        )
+
+    def test_pipeline_version_bump_reprocesses_done_documents(self, aws, monkeypatch):
+        """Test a done entry only blocks redeliveries under the same PIPELINE_VERSION"""
+        monkeypatch.setattr(document_processor, 'result_cache', None)
+        document_processor.lambda_handler({'Records': [s3_record('uploads/a.png', etag='v1')]}, None)
+        monkeypatch.setattr(document_processor, 'PIPELINE_VERSION', 'next')
+
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/a.png', etag='v1')]}, None)
+
+        assert json.loads(response['body'])['results'][0]['status'] == 'success'
+        assert aws.textract.calls == ['uploads/a.png', 'uploads/a.png']
+
+    def test_memory_store_keeps_only_recent_entries(self):
+        """Test the warm-container ledger is bounded, dropping the least recently written"""
+        store = document_processor.MemoryLedgerStore(max_entries=2)
+        store.create('a', {'state': 'done'})
+        store.create('b', {'state': 'done'})
+        _, version = store.get('a')
+        store.replace('a', {'state': 'done', 'result_key': 'k'}, version)
+        store.create('c', {'state': 'claimed'})
+
+        assert store.get('b') == (None, None)
+        assert store.get('a')[0]['result_key'] == 'k'
+        assert len(store.entries) == 2
+
+    def test_failed_start_releases_the_claim(self, aws, monkeypatch):
+        """Test a claim whose start fails is marked failed instead of blocking until the lease ends"""
+        ledger = document_processor.ledger
+
+        def failing_start(ledger_key, owner, lease_seconds=None):
+            raise Exception('ServiceUnavailable')
+
+        monkeypatch.setattr(ledger, 'start', failing_start)
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/a.png', etag='abc')]}, None)
+
+        assert json.loads(response['body'])['results'][0]['status'] == 'success'
+        ledger_key = document_processor.document_ledger_key('uploads', 'uploads/a.png', {'eTag': 'abc'})
+        entry, _ = ledger.store.get(ledger_key)
+        assert entry['state'] == 'failed'
+        assert entry['error'] == 'ledger error: ServiceUnavailable'
+        assert ledger.claim(ledger_key, 'redelivery')[0]
+
+    def test_retry_after_a_timeout_takes_the_claim_over(self, aws, monkeypatch):
+        """Test Lambda's retry a few minutes after a timed-out invocation reprocesses the document"""
+        monkeypatch.setattr(document_processor, 'result_cache', None)
+        settle = document_processor.settle_document
+        # The first invocation dies at its 60 s timeout, before settling the claim
+        monkeypatch.setattr(document_processor, 'settle_document', lambda *args, **kwargs: None)
+        context = SimpleNamespace(get_remaining_time_in_millis=lambda: 60000)
+        record = s3_record('uploads/a.png', etag='abc')
+        document_processor.lambda_handler({'Records': [record]}, context)
+        ledger_key = document_processor.document_ledger_key('uploads', 'uploads/a.png', {'eTag': 'abc'})
+        entry, _ = document_processor.ledger.store.get(ledger_key)
+        assert entry['state'] == 'in_progress'
+        assert entry['lease_expires'] <= time.time() + 60 + document_processor.LEDGER_LEASE_MARGIN
+        monkeypatch.setattr(document_processor, 'settle_document', settle)
+
+        # Lambda's second retry, about three minutes later
+        started = time.time()
+        monkeypatch.setattr(document_processor.time, 'time', lambda: started + 180)
+        response = document_processor.lambda_handler({'Records': [record]}, context)
+
+        assert json.loads(response['body'])['results'][0]['status'] == 'success'
+        assert aws.textract.calls == ['uploads/a.png', 'uploads/a.png']
+
+    def test_lease_without_a_context_is_the_function_timeout(self, aws):
+        """Test claims made outside Lambda fall back to LEDGER_LEASE_SECONDS"""
+        ledger = document_processor.ProcessingLedger(document_processor.MemoryLedgerStore())
+
+        _, entry = ledger.claim('b/k@e', 'owner-a')
+
+        assert entry['lease_expires'] - entry['updated_at'] == document_processor.LEDGER_LEASE_SECONDS
+        assert ledger.claim('b/k@f', 'owner-a', lease_seconds=5)[1]['lease_expires'] < entry['lease_expires']
+
+    def test_lifecycle_and_conditional_transitions(self, store):
+        """Test claimed -> in_progress -> done, with only the owner able to move it"""
+        ledger = document_processor.ProcessingLedger(store)
+
+        assert ledger.claim('b/k@e', 'owner-a')[0]
+        ledger.start('b/k@e', 'owner-a')
+        claimed, entry = ledger.claim('b/k@e', 'owner-b')
+        assert not claimed and entry['state'] == 'in_progress'
+        with pytest.raises(document_processor.LedgerConflict):
+            ledger.complete('b/k@e', 'owner-b')
+        ledger.complete('b/k@e', 'owner-a', result_key='processed/k.json')
+
+        entry, _ = store.get('b/k@e')
+        assert (entry['state'], entry['result_key']) == ('done', 'processed/k.json')
+        assert not ledger.claim('b/k@e', 'owner-c')[0]
+
+    def test_failed_and_expired_claims_can_be_retaken(self, store):
+        """Test a failed entry or a lapsed lease is reclaimed and the old owner is fenced out"""
+        ledger = document_processor.ProcessingLedger(store)
+        ledger.claim('b/failed@e', 'owner-a')
+        ledger.fail('b/failed@e', 'owner-a', error='Textract throttled')
+        ledger.claim('b/stale@e', 'owner-a')
+        entry, version = store.get('b/stale@e')
+        store.replace('b/stale@e', dict(entry, lease_expires=time.time() - 1), version)
+
+        claimed, entry = ledger.claim('b/failed@e', 'owner-b')
+        assert claimed and entry['attempts'] == 2
+        assert ledger.claim('b/stale@e', 'owner-b')[0]
+        with pytest.raises(document_processor.LedgerConflict):
+            ledger.complete('b/stale@e', 'owner-a')
+        assert ledger.stats()['reclaimed'] == 2
+
+    def test_racing_claims_have_one_winner(self, store):
+        """Test concurrent claims for one document: exactly one succeeds"""
+        ledger = document_processor.ProcessingLedger(store)
+        barrier = threading.Barrier(8)
+
+        def claim(owner):
+            barrier.wait()
+            return ledger.claim('b/k@e', owner)[0]
+
+        with document_processor.ThreadPoolExecutor(max_workers=8) as executor:
+            outcomes = list(executor.map(claim, [f'owner-{i}' for i in range(8)]))
+
+        assert outcomes.count(True) == 1
+
+    def test_unreachable_ledger_does_not_block_processing(self, aws, monkeypatch):
+        """Test ledger errors fail open"""
+        def broken(*args):
+            raise FakeClientError('ServiceUnavailable')
+
+        monkeypatch.setattr(document_processor.ledger.store, 'get', broken)
+
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/a.png')]}, None)
+
+        assert json.loads(response['body'])['results'][0]['status'] == 'success'
+
+
+class TestBatchComprehend:
+    """Tests for BatchDetect* analysis across documents"""
+
+    def test_burst_uses_one_call_per_feature_per_25_docs(self, aws):
+        """Test 60 documents cost 3 batches x 3 features"""
+        event = {'Records': [s3_record(f'uploads/doc_{i}.png') for i in range(60)]}
+
+        response = document_processor.lambda_handler(event, None)
+
+        assert json.loads(response['body'])['succeeded'] == 60
+        names = [name for name, _ in aws.comprehend.calls]
+        assert sorted(set(names)) == ['batch_detect_entities', 'batch_detect_key_phrases', 'batch_detect_sentiment']
+        assert len(names) == 9
+        assert sorted(count for name, count in aws.comprehend.calls if name == 'batch_detect_entities') == [10, 25, 25]
+
+    def test_results_map_back_to_their_documents(self, aws):
+        """Test per-item results and errors land on the right document"""
+        texts = ['Acme invoice', 'xx', 'second invoice', 'third invoice']
+        aws.comprehend.failing_texts.add('second invoice')
+
+        analyses = document_processor.analyze_texts_batch(texts)
+
+        assert analyses[0]['entities'][0]['text'] == 'Acme'
+        assert analyses[0]['sentiment']['overall'] == 'NEUTRAL'
+        assert analyses[0]['key_phrases'][0]['text'] == 'total due'
+        assert analyses[1] == {'error': 'Text too short for analysis'}
+        assert 'TEXT_SIZE_LIMIT_EXCEEDED' in analyses[2]['error']
+        assert 'entities' not in analyses[2]
+        assert 'error' not in analyses[3]
+
+    def test_failed_batch_call_marks_only_that_feature(self, aws, monkeypatch):
+        """Test a throttled feature call does not drop the other features"""
+        def throttled(**kwargs):
+            raise Exception('ThrottlingException')
+        monkeypatch.setattr(aws.comprehend, 'batch_detect_sentiment', throttled)
+
+        analyses = document_processor.analyze_texts_batch(['Acme invoice', 'Globex receipt'])
+
+        for analysis in analyses:
+            assert 'sentiment: ThrottlingException' in analysis['error']
+            assert analysis['entities']
+            assert analysis['key_phrases']
+
+    def test_single_document_wrapper(self, aws):
+        """Test analyze_text returns the same shape as the batch API"""
+        single = document_processor.analyze_text('Invoice from Acme, total due $40')
+
+        assert single == document_processor.analyze_texts_batch(['Invoice from Acme, total due $40'])[0]
+        assert single['entities'][1] == {
+            'text': 'Acme', 'type': 'ORGANIZATION', 'score': 0.99, 'begin_offset': 13, 'end_offset': 17
+        }
+
+
+class TestComprehendChunking:
+    """Tests for full-text analysis of long documents"""
+
+    def test_chunks_respect_byte_limit_and_rejoin(self):
+        """Test chunks stay under the UTF-8 limit and cover the whole text"""
+        text = ' '.join(f'Sentence {i} costs €{i}.' for i in range(2000)) + '\nTrailing line'
+
+        chunks = document_processor.chunk_text(text, max_bytes=500)
+
+        assert all(len(chunk.encode('utf-8')) <= 500 for _, chunk in chunks)
+        assert ''.join(chunk for _, chunk in chunks) == text
+        for offset, chunk in chunks:
+            assert text[offset:offset + len(chunk)] == chunk
+            # Cuts fall on sentence boundaries when they exist
+            assert chunk.rstrip().endswith('.') or chunk.endswith('Trailing line')
+
+    def test_oversized_words_are_split_on_character_boundaries(self):
+        """Test a single word over the limit is cut without breaking UTF-8"""
+        text = 'é' * 400
+
+        chunks = document_processor.chunk_text(text, max_bytes=101)
+
+        assert ''.join(chunk for _, chunk in chunks) == text
+        assert all(len(chunk.encode('utf-8')) <= 101 for _, chunk in chunks)
+
+    def test_long_document_is_fully_analyzed(self, aws):
+        """Test entities past the old 5,000-char cut are found with full-text offsets"""
+        filler = 'the amount is listed below. ' * 400
+        text = filler + 'Payable to Initech before the due date.'
+
+        analysis = document_processor.analyze_text(text)
+
+        initech = [e for e in analysis['entities'] if e['text'] == 'Initech']
+        assert len(initech) == 1
+        assert text[initech[0]['begin_offset']:initech[0]['end_offset']] == 'Initech'
+        # 'total due' is returned for every chunk but reported once
+        assert [p['text'] for p in analysis['key_phrases']] == ['total due']
+
+    def test_truncate_mode_keeps_old_behaviour(self, aws):
+        """Test truncate mode only sends the first chunk"""
+        text = 'the amount is listed below. ' * 400 + 'Payable to Initech.'
+
+        analysis = document_processor.analyze_text(text, mode='truncate')
+
+        assert not any(e['text'] == 'Initech' for e in analysis['entities'])
+        assert sum(count for _, count in aws.comprehend.calls) == 3
+
+    def test_sentiment_is_length_weighted(self, aws, monkeypatch):
+        """Test a short positive chunk does not outvote a long neutral one"""
+        monkeypatch.setattr(document_processor, 'COMPREHEND_MAX_BYTES', 100)
+        text = 'great. ' + 'plain words here. ' * 20
+
+        chunks = [chunk for _, chunk in document_processor.chunk_text(text)]
+        positive = [len(c) for c in chunks if 'great' in c]
+        expected = (0.9 * sum(positive) + 0.1 * (len(text) - sum(positive))) / len(text)
+
+        sentiment = document_processor.analyze_text(text)['sentiment']
+
+        assert len(chunks) > 2
+        assert sentiment['overall'] == 'NEUTRAL'
+        assert sentiment['scores']['Positive'] == round(expected, 2)
+
+
+class TestRangeReader:
+    """Tests for streaming PDFs through ranged reads"""
+
+    def test_behaves_like_bytesio(self):
+        """Test random seeks and reads match an in-memory buffer"""
+        data = bytes(random.Random(7).randrange(256) for _ in range(10000))
+        reader = document_processor.RangeReader(
+            lambda start, end: (data[start:end + 1], len(data)),
+            block_size=256, memory_budget=1024, readahead=1
+        )
+        expected = io.BytesIO(data)
+        rng = random.Random(11)
+
+        for _ in range(500):
+            whence = rng.choice([io.SEEK_SET, io.SEEK_CUR, io.SEEK_END])
+            offset = {io.SEEK_SET: rng.randrange(10500), io.SEEK_CUR: rng.randrange(-100, 100),
+                      io.SEEK_END: -rng.randrange(10000)}[whence]
+            if whence == io.SEEK_CUR and expected.tell() + offset < 0:
+                continue
+            assert reader.seek(offset, whence) == expected.seek(offset, whence)
+            size = rng.choice([-1, 0, 1, 17, 300, 2000])
+            assert reader.read(size) == expected.read(size)
+            assert reader.tell() == expected.tell()
+            assert len(reader.blocks) <= reader.max_blocks
+
+    def test_pdf_reader_fetches_only_what_it_touches(self, range_server):
+        """Test triage over HTTP ranges pulls a fraction of a large PDF"""
+        range_server.payload = make_heavy_pdf(40, 100000)
+        reader = document_processor.RangeReader(
+            range_server.fetch_range, block_size=4096, memory_budget=1024 * 1024, readahead=0
+        )
+
+        issues, page_count = document_processor.triage_pdf(reader, 'heavy.pdf')
+
+        assert (issues, page_count) == ([], 40)
+        stats = reader.stats()
+        assert stats['size'] == len(range_server.payload)
+        assert stats['bytes_fetched'] < len(range_server.payload) / 4
+        assert stats['requests'] == len(range_server.requests)
+
+    def test_normalization_over_bounded_cache(self, range_server):
+        """Test a full rewrite works even when the cache is much smaller than the file"""
+        range_server.payload = make_heavy_pdf(12, 50000)
+        reader = document_processor.RangeReader(
+            range_server.fetch_range, block_size=16 * 1024, memory_budget=64 * 1024, readahead=1
+        )
+
+        normalized, page_count = document_processor.validate_and_normalize_pdf(reader, 'heavy.pdf')
+
+        assert page_count == 12
+        assert len(document_processor.PyPDF2.PdfReader(io.BytesIO(normalized)).pages) == 12
+        assert len(reader.blocks) <= reader.max_blocks
+
+    def test_preprocess_uses_ranged_gets(self, aws, monkeypatch):
+        """Test preprocessing never downloads the whole object at once"""
+        monkeypatch.setattr(document_processor, 'PDF_FULL_READ_MAX_BYTES', 0)
+        monkeypatch.setattr(document_processor, 'PDF_STREAM_BLOCK_SIZE', 4096)
+        monkeypatch.setattr(document_processor, 'PDF_STREAM_READAHEAD', 0)
+        pdf = make_heavy_pdf(20, 40000)
+        aws.s3.objects[('uploads', 'uploads/scan.pdf')] = pdf
+
+        result = document_processor.preprocess_document('uploads', 'uploads/scan.pdf')
+
+        assert result == ('uploads', 'uploads/scan.pdf', 20)
+        fetched = sum(end - start + 1 for _, start, end in aws.s3.range_requests)
+        assert 0 < fetched < len(pdf) / 4
+
+
+class TestResourceGovernor:
+    """Tests for size/page limits and per-document strategies"""
+
+    @pytest.fixture(autouse=True)
+    def no_sleep(self, monkeypatch):
+        monkeypatch.setattr(document_processor.time, 'sleep', lambda seconds: None)
+
+    def handle(self, key, size=None, context=None):
+        record = s3_record(key)
+        if size is not None:
+            record['s3']['object']['size'] = size
+        response = document_processor.lambda_handler({'Records': [record]}, context)
+        return json.loads(response['body'])['results'][0]
+
+    def test_oversized_object_is_rejected_before_reading(self, aws, monkeypatch):
+        """Test the event's object size alone rejects a document over DOCUMENT_MAX_BYTES"""
+        monkeypatch.setattr(document_processor, 'DOCUMENT_MAX_BYTES', 1000)
+        aws.s3.objects[('uploads', 'uploads/huge.pdf')] = make_pdf(1)
+
+        entry = self.handle('uploads/huge.pdf', size=5000)
+
+        assert entry['status'] == 'error'
+        assert 'over the 1000 byte limit' in entry['error']
+        assert aws.s3.range_requests == [] and aws.textract.calls == []
+
+    def test_too_many_pages_is_rejected_from_the_declared_count(self, aws, monkeypatch):
+        """Test the page tree /Count probe rejects documents over DOCUMENT_MAX_PAGES"""
+        monkeypatch.setattr(document_processor, 'DOCUMENT_MAX_PAGES', 3)
+        aws.s3.objects[('uploads', 'uploads/book.pdf')] = make_pdf(5)
+
+        entry = self.handle('uploads/book.pdf')
+
+        assert entry['status'] == 'error'
+        assert '5 pages is over the 3 page limit' in entry['error']
+        assert aws.textract.calls == []
+
+    def test_small_pdf_is_read_in_one_get(self, aws):
+        """Test small PDFs skip ranged reads and record the chosen strategy"""
+        aws.s3.objects[('uploads', 'uploads/invoice.pdf')] = make_pdf(1)
+        budget = document_processor.DocumentBudget()
+
+        with document_processor.use_budget(budget):
+            document_processor.preprocess_document('uploads', 'uploads/invoice.pdf')
+        assert aws.s3.range_requests == []
+
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/invoice.pdf')]}, None)
+        assert saved_result(aws, response)['preprocessing'] == {'strategy': 'clean', 'reasons': []}
+
+    def test_rewrite_over_memory_budget_is_skipped(self, aws, monkeypatch):
+        """Test a rewrite projected past the memory budget sends the original instead"""
+        monkeypatch.setattr(document_processor, 'ALWAYS_NORMALIZE', True)
+        monkeypatch.setattr(document_processor, 'DOCUMENT_MEMORY_BUDGET', 100 * 1024)
+        aws.s3.objects[('uploads', 'uploads/scan.pdf')] = make_heavy_pdf(4, 40000)
+        budget = document_processor.DocumentBudget()
+
+        with document_processor.use_budget(budget):
+            result = document_processor.preprocess_document('uploads', 'uploads/scan.pdf')
+
+        assert result == ('uploads', 'uploads/scan.pdf', 4)
+        assert budget.strategy == 'skip_normalization'
+        assert ('uploads', 'preprocessed/scan.pdf') not in aws.s3.objects
+
+    @pytest.mark.parametrize('records', [1, 3])
+    def test_memory_budget_is_split_across_the_records_in_the_event(self, aws, monkeypatch, records):
+        """Test a single-record event gives its document half of a 512 MB function"""
+        monkeypatch.setattr(document_processor, 'FUNCTION_MEMORY_BYTES', 512 * 1024 * 1024)
+        budgets = []
+        new_budget = document_processor.new_document_budget
+
+        def recording_budget(*args):
+            budgets.append(new_budget(*args))
+            return budgets[-1]
+
+        monkeypatch.setattr(document_processor, 'new_document_budget', recording_budget)
+        document_processor.lambda_handler(
+            {'Records': [s3_record(f'uploads/{i}.png', etag=str(i)) for i in range(records)]}, None)
+
+        available = 512 * 1024 * 1024 - document_processor.RESULT_CACHE_MAX_BYTES
+        assert [b.memory_bytes for b in budgets] == [available // (2 * records)] * records
+
+    def test_large_encrypted_pdf_is_decrypted_in_a_single_record_event(self, monkeypatch):
+        """Test a 12 MiB encrypted PDF fits the budget of a 512 MB function processing one record"""
+        monkeypatch.setattr(document_processor, 'FUNCTION_MEMORY_BYTES', 512 * 1024 * 1024)
+        budget = document_processor.new_document_budget(None, 1)
+
+        assert document_processor.plan_normalization(12 * 1024 * 1024, 3, ['encrypted'], budget)
+        assert budget.strategy == 'streaming'
+
+    def test_encrypted_pdf_over_budget_is_rejected_not_sent_as_is(self, aws, monkeypatch):
+        """Test decryption is never skipped silently: the document fails with the reason"""
+        monkeypatch.setattr(document_processor, 'DOCUMENT_MEMORY_BUDGET', 1024 * 1024)
+        budget = document_processor.DocumentBudget()
+
+        with pytest.raises(document_processor.DocumentRejected, match='cannot be decrypted'):
+            document_processor.plan_normalization(12 * 1024 * 1024, 3, ['encrypted'], budget)
+        assert budget.strategy == 'rejected'
+        assert not document_processor.plan_normalization(
+            12 * 1024 * 1024, 3, ['missing startxref/%%EOF trailer'], document_processor.DocumentBudget())
+
+    def test_shardable_pdf_leaves_rewrite_to_shards(self, aws, monkeypatch):
+        """Test documents that will be sharded are not rewritten as a whole first"""
+        monkeypatch.setattr(document_processor, 'ALWAYS_NORMALIZE', True)
+        monkeypatch.setattr(document_processor, 'SHARD_THRESHOLD_PAGES', 2)
+        aws.s3.objects[('uploads', 'uploads/ledger.pdf')] = make_pdf(4)
+        budget = document_processor.DocumentBudget()
+
+        with document_processor.use_budget(budget):
+            result = document_processor.preprocess_document('uploads', 'uploads/ledger.pdf')
+
+        assert result == ('uploads', 'uploads/ledger.pdf', 4)
+        assert budget.strategy == 'sharded'
+
+    def test_textract_polling_stops_at_the_invocation_deadline(self, aws):
+        """Test a nearly expired Lambda context cuts async polling short"""
+        aws.textract.polls_before_done = 10 ** 6
+        aws.s3.objects[('uploads', 'uploads/statement.pdf')] = make_pdf(3)
+        reserve_ms = document_processor.LAMBDA_RESERVE_SECONDS * 1000
+        context = SimpleNamespace(get_remaining_time_in_millis=lambda: reserve_ms)
+
+        entry = self.handle('uploads/statement.pdf', context=context)
+
+        assert entry['status'] == 'success'
+        assert 'still IN_PROGRESS after 0s' in entry['summary']['errors'][0]
+
+
+class TestMultipartUpload:
+    """Tests for streaming normalized PDFs into S3 multipart uploads"""
+
+    @pytest.fixture
+    def small_parts(self, aws, monkeypatch):
+        aws.s3.min_part_size = 64 * 1024
+        monkeypatch.setattr(document_processor, 'MULTIPART_PART_SIZE', 64 * 1024)
+        monkeypatch.setattr(document_processor, 'ALWAYS_NORMALIZE', True)
+        yield aws
+
+    def test_large_output_is_uploaded_in_parts(self, small_parts):
+        """Test PdfWriter output streams into several parts and reassembles"""
+        aws = small_parts
+        aws.s3.objects[('uploads', 'uploads/scan.pdf')] = make_heavy_pdf(10, 50000)
+
+        result = document_processor.preprocess_document('uploads', 'uploads/scan.pdf')
+
+        assert result == ('uploads', 'preprocessed/scan.pdf', 10)
+        upload = list(aws.s3.uploads.values())[0]
+        assert upload['state'] == 'completed'
+        assert len(upload['parts']) > 5
+        normalized = aws.s3.objects[('uploads', 'preprocessed/scan.pdf')]
+        assert len(document_processor.PyPDF2.PdfReader(io.BytesIO(normalized)).pages) == 10
+        assert aws.s3.peak_parts_in_flight <= document_processor.MULTIPART_CONCURRENCY
+
+    def test_small_output_uses_single_put(self, small_parts):
+        """Test outputs under one part skip the multipart API"""
+        aws = small_parts
+        aws.s3.objects[('uploads', 'uploads/receipt.pdf')] = make_pdf(1)
+
+        result = document_processor.preprocess_document('uploads', 'uploads/receipt.pdf')
+
+        assert result == ('uploads', 'preprocessed/receipt.pdf', 1)
+        assert aws.s3.uploads == {}
+
+    def test_failed_part_aborts_and_falls_back(self, small_parts):
+        """Test a part failure aborts the upload and keeps the original key"""
+        aws = small_parts
+        aws.s3.fail_part = 2
+        aws.s3.objects[('uploads', 'uploads/scan.pdf')] = make_heavy_pdf(10, 50000)
+
+        result = document_processor.preprocess_document('uploads', 'uploads/scan.pdf')
+
+        assert result == ('uploads', 'uploads/scan.pdf', None)
+        assert [u['state'] for u in aws.s3.uploads.values()] == ['aborted']
+        assert ('uploads', 'preprocessed/scan.pdf') not in aws.s3.objects
+
+    def test_buffer_never_exceeds_one_part(self, aws):
+        """Test large single writes are cut into parts immediately"""
+        aws.s3.min_part_size = 1000
+        writer = document_processor.S3MultipartWriter('b', 'k', part_size=1000, concurrency=2)
+
+        with writer:
+            writer.write(b'x' * 5500)
+            assert len(writer.buffer) < 1000
+            writer.write(b'y' * 10)
+
+        assert writer.tell() == 5510
+        assert aws.s3.objects[('b', 'k')] == b'x' * 5500 + b'y' * 10
+        assert writer.parts_uploaded == 6
+
+    def test_exception_inside_with_aborts(self, aws):
+        """Test leaving the block with an error aborts the upload"""
+        writer = document_processor.S3MultipartWriter('b', 'k', part_size=1000)
+
+        with pytest.raises(RuntimeError):
+            with writer:
+                writer.write(b'x' * 2500)
+                raise RuntimeError('PdfWriter failed')
+
+        assert [u['state'] for u in aws.s3.uploads.values()] == ['aborted']
+        assert ('b', 'k') not in aws.s3.objects
+
+
+class TestMetrics:
+    """Tests for per-stage instrumentation"""
+
+    def emf_records(self, output):
+        return [json.loads(line) for line in output.splitlines() if line.startswith('{"_aws"')]
+
+    def test_stages_in_result_and_emf(self, aws, capsys):
+        """Test each document gets stage metrics in its result and one EMF line"""
+        aws.s3.objects[('uploads', 'uploads/invoice.pdf')] = make_pdf(1)
+
+        document_processor.lambda_handler({'Records': [s3_record('uploads/invoice.pdf')]}, None)
+
+        saved = json.loads(aws.s3.objects[('processed-bucket', 'processed/invoice.pdf.json')])
+        stages = saved['metrics']['stages']
+        assert {'cache_lookup', 'preprocess', 'triage', 'textract', 'comprehend'} <= set(stages)
+        assert stages['triage']['bytes_in'] > 0
+        assert stages['textract']['pages'] == 1
+        assert stages['comprehend']['batch_documents'] == 1
+        assert all('wall_ms' in fields and 'peak_rss_delta_bytes' in fields for fields in stages.values())
+
+        records = self.emf_records(capsys.readouterr().out)
+        assert len(records) == 1
+        record = records[0]
+        assert record['document_name'] == 'uploads/invoice.pdf'
+        assert record['Status'] == 'success'
+        assert 'save' in record['stages']
+        names = {m['Name'] for m in record['_aws']['CloudWatchMetrics'][0]['Metrics']}
+        assert {'total_ms', 'textract_wall_ms', 'save_bytes_out', 'triage_bytes_in'} <= names
+        assert all(name in record for name in names)
+
+    def test_retries_are_counted(self, aws):
+        """Test botocore RetryAttempts are attributed to the open stage"""
+        original = aws.textract.analyze_document
+
+        def retried(**kwargs):
+            response = original(**kwargs)
+            response['ResponseMetadata'] = {'RetryAttempts': 2}
+            return response
+
+        aws.textract.analyze_document = retried
+
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/a.png')]}, None)
+
+        stages = saved_result(aws, response)['metrics']['stages']
+        assert stages['textract']['retries'] == 2
+
+    def test_disabled_metrics_are_silent(self, aws, monkeypatch, capsys):
+        """Test METRICS_ENABLED=false adds nothing to results or logs"""
+        monkeypatch.setattr(document_processor, 'METRICS_ENABLED', False)
+
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/a.png')]}, None)
+
+        result = saved_result(aws, response)
+        assert 'metrics' not in result
+        assert self.emf_records(capsys.readouterr().out) == []
+        assert document_processor.stage('anything') is document_processor.NULL_SPAN
+
+    def test_error_documents_still_emit(self, aws, capsys):
+        """Test failed records produce an error EMF record"""
+        aws.s3.put_object = Mock(side_effect=Exception('AccessDenied'))
+
+        document_processor.lambda_handler({'Records': [s3_record('uploads/a.png')]}, None)
+
+        records = self.emf_records(capsys.readouterr().out)
+        assert [r['Status'] for r in records] == ['error']
+
+
+class TestClientFactory:
+    """Tests for shared, tuned AWS clients"""
+
+    def test_clients_use_adaptive_retries_and_sized_pools(self, monkeypatch):
+        """Test pool sizing, retry mode and timeouts are passed to botocore"""
+        mock_botocore_config.Config.reset_mock()
+        monkeypatch.setitem(document_processor.CLIENT_POOL_SIZES, 's3', 48)
+
+        document_processor.create_client('s3')
+
+        config_kwargs = mock_botocore_config.Config.call_args.kwargs
+        assert config_kwargs['max_pool_connections'] == 48
+        assert config_kwargs['retries']['mode'] == 'adaptive'
+        assert config_kwargs['read_timeout'] == document_processor.CLIENT_READ_TIMEOUTS['s3']
+        assert mock_boto3.client.call_args.kwargs['config'] is mock_botocore_config.Config.return_value
+        event, handler = mock_boto3.client.return_value.meta.events.register.call_args.args
+        assert event == 'needs-retry'
+
+    def test_pools_follow_worker_width(self):
+        """Test the pool is never narrower than the worker fan-out"""
+        sizes = document_processor.CLIENT_POOL_SIZES
+
+        assert sizes['textract'] >= document_processor.MAX_WORKERS * document_processor.SHARD_CONCURRENCY
+        assert sizes['comprehend'] >= document_processor.COMPREHEND_WORKERS
+        assert sizes['s3'] >= document_processor.MAX_WORKERS * (document_processor.MULTIPART_CONCURRENCY + 1)
+
+    def test_throttles_are_counted(self, monkeypatch):
+        """Test the needs-retry hook tallies throttles and other retryable errors"""
+        monkeypatch.setattr(document_processor, 'client_stats',
+                            {'textract': {'throttles': 0, 'retryable_errors': 0}})
+        throttled = (SimpleNamespace(status_code=400), {'Error': {'Code': 'ProvisionedThroughputExceededException'}})
+        server_error = (SimpleNamespace(status_code=503), {'Error': {'Code': 'ServiceUnavailable'}})
+        ok = (SimpleNamespace(status_code=200), {})
+        metrics = document_processor.DocumentMetrics('doc')
+
+        with document_processor.use_metrics(metrics), document_processor.stage('textract'):
+            for response in (throttled, throttled, server_error, ok):
+                assert document_processor.count_retryable_error('textract', response=response) is None
+            document_processor.count_retryable_error('textract', caught_exception=ConnectionError())
+
+        assert document_processor.client_stats['textract'] == {'throttles': 2, 'retryable_errors': 2}
+        assert metrics.stages['textract']['throttles'] == 2
+        assert metrics.stages['textract']['retryable_errors'] == 2
+
+    def test_client_errors_are_not_counted(self, monkeypatch):
+        """Test cache/ledger misses and conditional-write conflicts are not retryable errors"""
+        monkeypatch.setattr(document_processor, 'client_stats',
+                            {'s3': {'throttles': 0, 'retryable_errors': 0}})
+        not_found = (SimpleNamespace(status_code=404), {'Error': {'Code': 'NoSuchKey'}})
+        conflict = (SimpleNamespace(status_code=412), {'Error': {'Code': 'PreconditionFailed'}})
+        timeout = (SimpleNamespace(status_code=400), {'Error': {'Code': 'RequestTimeout'}})
+
+        for response in (not_found, conflict, not_found, timeout):
+            assert document_processor.count_retryable_error('s3', response=response) is None
+
+        assert document_processor.client_stats['s3'] == {'throttles': 0, 'retryable_errors': 1}
+
+    def test_handler_reports_client_stats(self, aws):
+        """Test the response summary exposes per-service counters"""
+        response = document_processor.lambda_handler({'Records': [s3_record('uploads/a.png')]}, None)
+
+        clients = json.loads(response['body'])['clients']
+        assert set(clients) >= {'s3', 'textract', 'comprehend'}
@@ -0,0 +1,828 @@
+import csv
+import json
+import gzip
+import hashlib
+import pytest
+from unittest.mock import Mock
+import sys
+import os
+import threading
+from types import SimpleNamespace
+
+# Mock boto3 and botocore BEFORE importing tag_audit_function
+sys.modules.setdefault('boto3', Mock())
+sys.modules.setdefault('botocore', Mock())
+sys.modules.setdefault('botocore.config', Mock())
+os.environ.setdefault('SNS_TOPIC_ARN', 'arn:aws:sns:us-east-1:123456789012:TagAuditNotifications')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../lambda/tag-audit'))
+
+import tag_audit_function
+
+
+# -------------------------------------------------------
+# Local stand-in for the Resource Groups Tagging API
+# -------------------------------------------------------
+
+ALL_TAGS = {
+    'Project': 'doc-processing-pipeline',
+    'CostCenter': 'Project1',
+    'Environment': 'dev',
+    'CreatedDate': '2026-01-16',
+    'ManagedBy': 'manual'
+}
+
+
+def make_resource(arn, **tags):
+    return {'ResourceARN': arn, 'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()]}
+
+
+def instance_resources(count, region='us-east-1', missing=(), start=0):
+    """EC2 instance mappings; every one lacks the tags named in `missing`"""
+    tags = {k: v for k, v in ALL_TAGS.items() if k not in missing}
+    return (
+        make_resource(f"arn:aws:ec2:{region}:123456789012:instance/i-{i:017x}", **tags)
+        for i in range(start, start + count)
+    )
+
+
+class FakeTaggingClient:
+    """
+    get_resources paginator over a resource iterable, honouring
+    ResourceTypeFilters. Pages are built lazily, so a test can see how far
+    ahead of the audit the paginator ran.
+    """
+
+    def __init__(self, resources, fail_after_pages=None):
+        self.resources = resources
+        self.fail_after_pages = fail_after_pages
+        self.pages_served = 0
+        self.paginate_kwargs = None
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def get_paginator(self, name):
+        assert name == 'get_resources'
+        return self
+
+    def paginate(self, **kwargs):
+        self.paginate_kwargs = kwargs
+        with self.lock:
+            self.calls.append(kwargs)
+        page_size = kwargs.get('ResourcesPerPage', 50)
+        type_filters = kwargs.get('ResourceTypeFilters')
+        page = []
+        for resource in self.resources:
+            resource_type = tag_audit_function.extract_resource_type(resource['ResourceARN'])
+            if type_filters and not any(tag_audit_function.type_matches(resource_type, f) for f in type_filters):
+                continue
+            page.append(resource)
+            if len(page) == page_size:
+                yield self._serve(page)
+                page = []
+        if page:
+            yield self._serve(page)
+
+    def _serve(self, page):
+        with self.lock:
+            if self.fail_after_pages is not None and self.pages_served >= self.fail_after_pages:
+                raise Exception('AccessDeniedException')
+            self.pages_served += 1
+        return {'ResourceTagMappingList': page, 'PaginationToken': ''}
+
+
+class FakeSNS:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, **kwargs):
+        self.messages.append(kwargs)
+        return {'MessageId': f"msg-{len(self.messages)}"}
+
+
+class FakeClientError(Exception):
+    """Shaped like botocore's ClientError: the AWS error code lives in .response"""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3:
+    """In-memory S3 with conditional puts, for the snapshot store and reports"""
+
+    def __init__(self):
+        self.objects = {}
+        self.before_put = None
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise FakeClientError('NoSuchKey')
+        data = self.objects[(Bucket, Key)]
+        return {'Body': SimpleNamespace(read=lambda: data), 'ETag': self.etag(data)}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        if self.before_put:
+            hook, self.before_put = self.before_put, None
+            hook()
+        current = self.objects.get((Bucket, Key))
+        if IfNoneMatch == '*' and current is not None:
+            raise FakeClientError('PreconditionFailed')
+        if IfMatch is not None and (current is None or self.etag(current) != IfMatch):
+            raise FakeClientError('PreconditionFailed')
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        self.objects[(Bucket, Key)] = Body
+        return {'ETag': self.etag(Body)}
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
+
+    def get_text(self, bucket, suffix):
+        matches = [data for (b, key), data in self.objects.items() if b == bucket and key.endswith(suffix)]
+        assert len(matches) == 1
+        return matches[0].decode('utf-8')
+
+    @staticmethod
+    def etag(data):
+        return f'"{hashlib.md5(data).hexdigest()}"'
+
+
+@pytest.fixture
+def tagging(monkeypatch):
+    """Install per-region fake tagging clients and a fake SNS client"""
+    clients = {}
+    sns = FakeSNS()
+    monkeypatch.setattr(tag_audit_function, 'tagging_clients', clients)
+    monkeypatch.setattr(tag_audit_function, 'sns_client', sns)
+    monkeypatch.setattr(tag_audit_function, 'AUDIT_SNAPSHOT_BACKEND', 'none')
+
+    def install(regions, resource_types=(), exempt_types=()):
+        clients.update(regions)
+        monkeypatch.setattr(tag_audit_function, 'AUDIT_REGIONS', list(regions))
+        monkeypatch.setattr(tag_audit_function, 'AUDIT_RESOURCE_TYPES', list(resource_types))
+        monkeypatch.setattr(tag_audit_function, 'EXEMPT_RESOURCE_TYPES', set(exempt_types))
+
+    return SimpleNamespace(clients=clients, sns=sns, install=install)
+
+
+def mixed_resources(region='us-east-1'):
+    """A few resources of several services, none of them tagged"""
+    account = '123456789012'
+    return [
+        make_resource(f"arn:aws:ec2:{region}:{account}:instance/i-0001"),
+        make_resource(f"arn:aws:ec2:{region}:{account}:vpc/vpc-0001"),
+        make_resource(f"arn:aws:ec2:{region}:{account}:subnet/subnet-0001"),
+        make_resource(f"arn:aws:s3:::uploads-{region}"),
+        make_resource(f"arn:aws:s3:::processed-{region}"),
+        make_resource(f"arn:aws:lambda:{region}:{account}:function:document-processor"),
+        make_resource(f"arn:aws:sns:{region}:{account}:TagAuditNotifications"),
+    ]
+
+
+def run_plan(regions, resource_types=(), exempt_types=()):
+    plan = tag_audit_function.build_audit_plan(regions, list(resource_types), set(exempt_types))
+    return tag_audit_function.run_audit_plan(plan)
+
+
+def make_context(remaining_ms):
+    return SimpleNamespace(get_remaining_time_in_millis=lambda: remaining_ms)
+
+
+# -------------------------------------------------------
+# Tests
+# -------------------------------------------------------
+
+class TestTagAudit:
+    """Region-parallel, streaming compliance audit"""
+
+    def test_counts_and_report_for_one_region(self, tagging):
+        resources = list(instance_resources(3)) + list(instance_resources(2, missing=('CostCenter',), start=3))
+        tagging.install({'us-east-1': FakeTaggingClient(resources)})
+
+        response = tag_audit_function.lambda_handler({}, None)
+        body = json.loads(response['body'])
+
+        assert response['statusCode'] == 200
+        assert body['total_resources'] == 5
+        assert body['compliant'] == 3
+        assert body['non_compliant'] == 2
+        assert body['compliance_rate'] == '60.0%'
+        assert body['complete'] is True
+        assert body['missing_by_tag'] == {'CostCenter': 2}
+
+        report = tagging.sns.messages[0]['Message']
+        assert f"arn:aws:ec2:us-east-1:123456789012:instance/i-{3:017x}" in report
+        assert 'Missing Tags: CostCenter' in report
+        assert 'ec2:instance (2 resources)' in report
+
+    def test_requests_full_pages(self, tagging):
+        client = FakeTaggingClient(list(instance_resources(1)))
+        tagging.install({'us-east-1': client})
+
+        tag_audit_function.lambda_handler({}, None)
+
+        assert client.paginate_kwargs == {'ResourcesPerPage': 100}
+
+    def test_regions_merge_into_one_set_of_counters(self, tagging):
+        tagging.install({
+            'us-east-1': FakeTaggingClient(list(instance_resources(250, 'us-east-1', missing=('Project',)))),
+            'eu-west-1': FakeTaggingClient(list(instance_resources(120, 'eu-west-1'))),
+            'ap-south-1': FakeTaggingClient(list(instance_resources(30, 'ap-south-1', missing=('Project', 'ManagedBy')))),
+        })
+
+        body = json.loads(tag_audit_function.lambda_handler({}, None)['body'])
+
+        assert body['total_resources'] == 400
+        assert body['non_compliant'] == 280
+        assert body['missing_by_tag'] == {'Project': 280, 'ManagedBy': 30}
+        assert body['regions']['us-east-1'] == {
+            'total': 250, 'non_compliant': 250, 'exempt': 0, 'pages': 3, 'complete': True
+        }
+        assert body['regions']['eu-west-1']['non_compliant'] == 0
+        assert body['regions']['ap-south-1']['total'] == 30
+
+        report = tagging.sns.messages[0]['Message']
+        for region in ('us-east-1', 'eu-west-1', 'ap-south-1'):
+            assert f"{region}:" in report
+
+    def test_regions_are_audited_side_by_side(self, tagging):
+        started = threading.Barrier(3, timeout=5)
+
+        class BlockingClient(FakeTaggingClient):
+            def paginate(self, **kwargs):
+                started.wait()  # only passes once all three regions are paging
+                yield from super().paginate(**kwargs)
+
+        tagging.install({
+            region: BlockingClient(list(instance_resources(10, region)))
+            for region in ('us-east-1', 'us-west-2', 'eu-central-1')
+        })
+
+        body = json.loads(tag_audit_function.lambda_handler({}, None)['body'])
+
+        assert body['total_resources'] == 30
+
+    def test_pages_are_evaluated_as_they_arrive(self, tagging, monkeypatch):
+        client = FakeTaggingClient(instance_resources(1000))
+        seen = []
+
+        # The audit sees each page before the paginator has fetched the next
+        original_add_page = tag_audit_function.AuditCounters.add_page
+
+        def add_page(self, resources, *args):
+            seen.append((client.pages_served, len(resources)))
+            original_add_page(self, resources, *args)
+
+        tagging.install({'us-east-1': client})
+        monkeypatch.setattr(tag_audit_function.AuditCounters, 'add_page', add_page)
+        tag_audit_function.lambda_handler({}, None)
+
+        assert seen == [(page, 100) for page in range(1, 11)]
+
+    def test_large_account_keeps_only_report_samples(self, tagging):
+        # 120k mappings generated on the fly; never held as one list
+        tagging.install({
+            'us-east-1': FakeTaggingClient(instance_resources(60000, 'us-east-1', missing=('ManagedBy',))),
+            'us-west-2': FakeTaggingClient(instance_resources(60000, 'us-west-2')),
+        })
+
+        counters = run_plan(['us-east-1', 'us-west-2'])
+
+        assert counters.total == 120000
+        assert counters.non_compliant == 60000
+        assert counters.by_type == {'ec2:instance': 60000}
+        assert len(counters.samples['ec2:instance']) == tag_audit_function.REPORT_SAMPLES_PER_TYPE
+
+    def test_failed_region_does_not_sink_the_audit(self, tagging):
+        tagging.install({
+            'us-east-1': FakeTaggingClient(list(instance_resources(150)), fail_after_pages=1),
+            'eu-west-1': FakeTaggingClient(list(instance_resources(40, 'eu-west-1'))),
+        })
+
+        body = json.loads(tag_audit_function.lambda_handler({}, None)['body'])
+
+        assert body['total_resources'] == 140
+        assert body['complete'] is False
+        assert body['regions']['us-east-1']['errors'] == {'us-east-1/*': 'AccessDeniedException'}
+        assert body['regions']['us-east-1']['pages'] == 1
+        assert body['regions']['eu-west-1']['complete'] is True
+        assert 'us-east-1: 100 resources, 0 non-compliant (FAILED' in tagging.sns.messages[0]['Message']
+
+    def test_stops_paging_near_the_lambda_deadline(self, tagging, monkeypatch):
+        client = FakeTaggingClient(instance_resources(1000))
+        tagging.install({'us-east-1': client})
+        clock = iter(range(0, 10000, 10))
+        monkeypatch.setattr(tag_audit_function.time, 'monotonic', lambda: next(clock))
+
+        # 30s reserve leaves 35s; the fake clock advances 10s per check
+        body = json.loads(tag_audit_function.lambda_handler({}, make_context(65000))['body'])
+
+        assert body['complete'] is False
+        assert body['regions']['us-east-1']['pages'] < 10
+        assert body['total_resources'] == body['regions']['us-east-1']['pages'] * 100
+        assert 'INCOMPLETE' in tagging.sns.messages[0]['Message']
+
+    def test_report_samples_are_bounded_per_type(self, tagging):
+        tagging.install({
+            'us-east-1': FakeTaggingClient(list(instance_resources(8, 'us-east-1', missing=('Project',)))),
+            'us-west-2': FakeTaggingClient(list(instance_resources(8, 'us-west-2', missing=('Project',)))),
+        })
+
+        tag_audit_function.lambda_handler({}, None)
+        report = tagging.sns.messages[0]['Message']
+
+        assert report.count('ARN: ') == tag_audit_function.REPORT_SAMPLES_PER_TYPE
+        assert 'ec2:instance (16 resources)' in report
+        assert '... and 11 more ec2:instance resources' in report
+
+    def test_empty_account(self, tagging):
+        tagging.install({'us-east-1': FakeTaggingClient([])})
+
+        body = json.loads(tag_audit_function.lambda_handler({}, None)['body'])
+
+        assert body['total_resources'] == 0
+        assert body['compliance_rate'] == '0.0%'
+        assert 'ALL RESOURCES ARE COMPLIANT' in tagging.sns.messages[0]['Message']
+
+
+class TestAuditPlan:
+    """ResourceTypeFilters shards, exempt types and TagFilters"""
+
+    def test_without_resource_types_each_region_is_one_shard(self):
+        plan = tag_audit_function.build_audit_plan(['us-east-1', 'eu-west-1'], [], {'ec2:vpc'})
+
+        assert plan == [
+            {'region': 'us-east-1', 'service': '*', 'resource_types': [], 'skip_types': ['ec2:vpc']},
+            {'region': 'eu-west-1', 'service': '*', 'resource_types': [], 'skip_types': ['ec2:vpc']},
+        ]
+
+    def test_resource_types_split_into_service_shards(self):
+        plan = tag_audit_function.build_audit_plan(
+            ['us-east-1'],
+            ['s3', 'ec2:instance', 'ec2:volume', 'lambda:function', 'ec2:vpc'],
+            {'ec2:vpc'}
+        )
+
+        assert [(s['service'], s['resource_types'], s['skip_types']) for s in plan] == [
+            ('ec2', ['ec2:instance', 'ec2:volume'], []),
+            ('lambda', ['lambda:function'], []),
+            ('s3', ['s3'], []),
+        ]
+
+    def test_broad_filters_keep_exempt_types_to_skip(self):
+        plan = tag_audit_function.build_audit_plan(['us-east-1'], ['ec2', 's3'], {'ec2:vpc', 'ec2:subnet'})
+
+        assert {s['service']: s['skip_types'] for s in plan} == {'ec2': ['ec2:subnet', 'ec2:vpc'], 's3': []}
+
+    def test_large_type_lists_are_chunked(self):
+        types = [f"ec2:type{i}" for i in range(250)]
+
+        plan = tag_audit_function.build_audit_plan(['us-east-1'], types, set())
+
+        assert [len(s['resource_types']) for s in plan] == [100, 100, 50]
+
+    def test_shards_send_resource_type_filters(self, tagging):
+        client = FakeTaggingClient(mixed_resources())
+        tagging.install({'us-east-1': client}, resource_types=['s3', 'lambda:function'])
+
+        body = json.loads(tag_audit_function.lambda_handler({}, None)['body'])
+
+        assert sorted(tuple(c['ResourceTypeFilters']) for c in client.calls) == [('lambda:function',), ('s3',)]
+        assert body['total_resources'] == 3
+        assert sorted(body['shards']) == ['us-east-1/lambda', 'us-east-1/s3']
+        assert body['shards']['us-east-1/s3']['non_compliant'] == 2
+
+    def test_exempt_types_are_skipped_client_side(self, tagging):
+        tagging.install({'us-east-1': FakeTaggingClient(mixed_resources())}, exempt_types=['ec2:vpc', 'ec2:subnet'])
+
+        body = json.loads(tag_audit_function.lambda_handler({}, None)['body'])
+
+        assert body['total_resources'] == 5
+        assert body['exempt'] == 2
+        report = tagging.sns.messages[0]['Message']
+        assert 'arn:aws:ec2:us-east-1:123456789012:vpc/vpc-0001' not in report
+        assert 'Exempt Types: ec2:subnet, ec2:vpc' in report
+
+    def test_nothing_is_exempt_by_default(self):
+        """Test project-created subnets and security groups stay in the audit unless exempted"""
+        assert 'EXEMPT_RESOURCE_TYPES' not in os.environ
+        assert tag_audit_function.EXEMPT_RESOURCE_TYPES == set()
+
+        plan = tag_audit_function.build_audit_plan(['us-east-1'], [])
+
+        assert all(not shard['skip_types'] for shard in plan)
+
+    def test_exempt_types_never_requested_when_filtered(self, tagging):
+        client = FakeTaggingClient(mixed_resources())
+        tagging.install({'us-east-1': client}, resource_types=['ec2:instance', 'ec2:vpc'], exempt_types=['ec2:vpc'])
+
+        body = json.loads(tag_audit_function.lambda_handler({}, None)['body'])
+
+        assert [c['ResourceTypeFilters'] for c in client.calls] == [['ec2:instance']]
+        assert body['total_resources'] == 1
+        assert body['exempt'] == 0
+
+    def test_event_selects_a_single_shard(self, tagging):
+        east = FakeTaggingClient(mixed_resources('us-east-1'))
+        west = FakeTaggingClient(mixed_resources('eu-west-1'))
+        tagging.install({'us-east-1': east, 'eu-west-1': west}, resource_types=['s3', 'ec2:instance'])
+
+        event = {'regions': ['eu-west-1'], 'resource_types': ['sns']}
+        body = json.loads(tag_audit_function.lambda_handler(event, None)['body'])
+
+        assert east.calls == []
+        assert [c['ResourceTypeFilters'] for c in west.calls] == [['sns']]
+        assert body['total_resources'] == 1
+        assert list(body['shards']) == ['eu-west-1/sns']
+
+    def test_tag_filters_are_passed_through(self, tagging, monkeypatch):
+        client = FakeTaggingClient(mixed_resources())
+        tagging.install({'us-east-1': client})
+        tag_filters = [{'Key': 'Environment', 'Values': ['prod']}]
+        monkeypatch.setattr(tag_audit_function, 'AUDIT_TAG_FILTERS', tag_filters)
+
+        tag_audit_function.lambda_handler({}, None)
+
+        assert client.calls[0]['TagFilters'] == tag_filters
+
+    @pytest.mark.parametrize('arn, expected', [
+        ('arn:aws:s3:::my-bucket', 's3:bucket'),
+        ('arn:aws:sns:us-east-1:123456789012:alerts', 'sns:topic'),
+        ('arn:aws:sqs:us-east-1:123456789012:jobs', 'sqs:queue'),
+        ('arn:aws:lambda:us-east-1:123456789012:function:processor', 'lambda:function'),
+        ('arn:aws:ec2:us-east-1:123456789012:instance/i-0001', 'ec2:instance'),
+        ('arn:aws:events:us-east-1:123456789012:rule/weekly', 'events:rule'),
+    ])
+    def test_resource_types_match_filter_syntax(self, arn, expected):
+        assert tag_audit_function.extract_resource_type(arn) == expected
+
+
+@pytest.fixture(params=['file', 's3'])
+def snapshots(request, tagging, monkeypatch, tmp_path):
+    """Enable incremental audits on each snapshot backend"""
+    s3 = FakeS3()
+    monkeypatch.setattr(tag_audit_function, 'AUDIT_SNAPSHOT_BACKEND', request.param)
+    monkeypatch.setattr(tag_audit_function, 'AUDIT_SNAPSHOT_PATH', str(tmp_path / 'snapshot.json.gz'))
+    monkeypatch.setattr(tag_audit_function, 'AUDIT_SNAPSHOT_BUCKET', 'audit-bucket')
+    monkeypatch.setattr(tag_audit_function, 's3_client', s3)
+    tagging.s3 = s3
+    return tagging
+
+
+def run_audit(event=None):
+    return json.loads(tag_audit_function.lambda_handler(event or {}, None)['body'])
+
+
+def saved_snapshot():
+    store = tag_audit_function.build_snapshot_store()
+    return store.load()[0]
+
+
+class TestIncrementalAudit:
+    """Snapshot of ARN -> tag-set hash and diff-only reports"""
+
+    def test_first_run_reports_in_full_and_saves_a_baseline(self, snapshots):
+        resources = list(instance_resources(3)) + list(instance_resources(2, missing=('Project',), start=3))
+        snapshots.install({'us-east-1': FakeTaggingClient(resources)})
+
+        body = run_audit()
+
+        assert body['incremental'] is False
+        assert body['notified'] is True
+        assert 'ARN: ' in snapshots.sns.messages[0]['Message']
+        snapshot = saved_snapshot()
+        assert len(snapshot) == 5
+        assert sum(1 for _, compliant, _ in snapshot.values() if not compliant) == 2
+        assert {region for _, _, region in snapshot.values()} == {'us-east-1'}
+
+    def test_unchanged_account_sends_nothing(self, snapshots):
+        resources = list(instance_resources(5, missing=('Project',)))
+        snapshots.install({'us-east-1': FakeTaggingClient(resources)})
+        run_audit()
+
+        body = run_audit()
+
+        assert body['incremental'] is True
+        assert body['notified'] is False
+        assert body['changes'] == {'newly_non_compliant': 0, 'newly_fixed': 0, 'deleted': 0, 'tags_changed': 0}
+        assert len(snapshots.sns.messages) == 1
+
+    def test_unchanged_account_can_still_notify(self, snapshots, monkeypatch):
+        snapshots.install({'us-east-1': FakeTaggingClient(list(instance_resources(2)))})
+        monkeypatch.setattr(tag_audit_function, 'NOTIFY_UNCHANGED', True)
+        run_audit()
+
+        body = run_audit()
+
+        assert body['notified'] is True
+        assert 'Newly Non-Compliant: 0' in snapshots.sns.messages[1]['Message']
+
+    def test_reports_only_what_changed(self, snapshots):
+        arn = "arn:aws:ec2:us-east-1:123456789012:instance/i-{:017x}".format
+        client = FakeTaggingClient(
+            list(instance_resources(4)) + list(instance_resources(2, missing=('Project',), start=4))
+        )
+        snapshots.install({'us-east-1': client})
+        run_audit()
+
+        client.resources = [
+            make_resource(arn(0), **ALL_TAGS),                                        # unchanged
+            make_resource(arn(1), **dict(ALL_TAGS, ManagedBy='terraform')),           # retagged, still compliant
+            make_resource(arn(2), **{k: v for k, v in ALL_TAGS.items() if k != 'CostCenter'}),  # lost a tag
+            # arn(3) deleted
+            make_resource(arn(4), **ALL_TAGS),                                        # fixed
+            make_resource(arn(5), **{k: v for k, v in ALL_TAGS.items() if k != 'Project'}),     # still broken
+            make_resource(arn(6)),                                                    # new and untagged
+        ]
+        body = run_audit()
+
+        assert body['changes'] == {'newly_non_compliant': 2, 'newly_fixed': 1, 'deleted': 1, 'tags_changed': 3}
+        report = snapshots.sns.messages[1]['Message']
+        assert 'CHANGES SINCE LAST AUDIT' in report
+        assert f"{arn(2)}\n  Missing Tags: CostCenter" in report
+        assert arn(6) in report
+        assert arn(4) in report
+        assert arn(3) in report
+        assert arn(5) not in report   # unchanged non-compliance is only counted
+        assert 'ARN: ' not in report
+        assert 'ec2:instance: 3' in report
+
+        snapshot = saved_snapshot()
+        assert arn(3) not in snapshot
+        assert snapshot[arn(4)][1] is True
+        assert snapshot[arn(6)][1] is False
+
+    def test_failed_shard_reports_no_deletions(self, snapshots):
+        client = FakeTaggingClient(list(instance_resources(150)))
+        snapshots.install({'us-east-1': client})
+        run_audit()
+
+        client.fail_after_pages = client.pages_served + 1
+        body = run_audit()
+
+        assert body['complete'] is False
+        assert body['changes']['deleted'] == 0
+        assert len(saved_snapshot()) == 150
+
+    def test_single_shard_run_keeps_other_shards(self, snapshots):
+        client = FakeTaggingClient(mixed_resources())
+        snapshots.install({'us-east-1': client}, resource_types=['s3', 'ec2:instance', 'lambda:function'])
+        run_audit()
+        assert len(saved_snapshot()) == 4
+
+        # The instance and function go away, but only the s3 shard runs
+        client.resources = [r for r in mixed_resources() if ':s3:' in r['ResourceARN']]
+        body = run_audit({'resource_types': ['s3']})
+
+        assert body['changes']['deleted'] == 0
+        assert len(saved_snapshot()) == 4
+
+        body = run_audit()
+
+        assert body['changes']['deleted'] == 2
+        assert len(saved_snapshot()) == 2
+
+    def test_concurrent_save_is_merged(self, snapshots):
+        if tag_audit_function.AUDIT_SNAPSHOT_BACKEND != 's3':
+            pytest.skip('conditional writes are exercised on the s3 backend')
+        east = FakeTaggingClient(list(instance_resources(3, 'us-east-1')))
+        west = FakeTaggingClient(list(instance_resources(2, 'eu-west-1')))
+        snapshots.install({'us-east-1': east, 'eu-west-1': west})
+        run_audit()
+
+        # Another run (west only, with a new resource) saves while this one audits east
+        def other_run():
+            west.resources = list(instance_resources(3, 'eu-west-1'))
+            run_audit({'regions': ['eu-west-1']})
+        snapshots.s3.before_put = other_run
+
+        east.resources = list(instance_resources(4, 'us-east-1'))
+        run_audit({'regions': ['us-east-1']})
+
+        snapshot = saved_snapshot()
+        assert sum(1 for *_, region in snapshot.values() if region == 'us-east-1') == 4
+        assert sum(1 for *_, region in snapshot.values() if region == 'eu-west-1') == 3
+
+    def test_unreadable_snapshot_falls_back_to_full_report(self, snapshots):
+        snapshots.install({'us-east-1': FakeTaggingClient(list(instance_resources(2, missing=('Project',))))})
+        run_audit()
+        store = tag_audit_function.build_snapshot_store()
+        if store.backend == 'file':
+            with open(store.path, 'wb') as f:
+                f.write(b'not a snapshot')
+        else:
+            snapshots.s3.objects[(store.bucket, store.key)] = b'not a snapshot'
+
+        body = run_audit()
+
+        assert body['incremental'] is False
+        assert 'ARN: ' in snapshots.sns.messages[-1]['Message']
+
+    def test_snapshot_is_compact(self):
+        resources = {
+            f"arn:aws:ec2:us-east-1:123456789012:instance/i-{i:017x}": (
+                tag_audit_function.tag_set_hash({'Project': 'p', 'Index': str(i)}), i % 3 != 0, 'us-east-1'
+            )
+            for i in range(10000)
+        }
+
+        body = tag_audit_function.encode_snapshot(resources)
+
+        assert tag_audit_function.decode_snapshot(body) == resources
+        assert len(body) < 40 * len(resources)
+        assert json.loads(gzip.decompress(body))['regions'] == ['us-east-1']
+
+    def test_tag_hash_ignores_tag_order(self):
+        first = tag_audit_function.tag_set_hash({'Project': 'p', 'Environment': 'dev'})
+        second = tag_audit_function.tag_set_hash({'Environment': 'dev', 'Project': 'p'})
+
+        assert first == second
+        assert first != tag_audit_function.tag_set_hash({'Environment': 'prod', 'Project': 'p'})
+
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '../config/resource-tags.json')
+POLICY_PATH = os.path.join(os.path.dirname(__file__), '../config/tag-policy.json')
+
+POLICY = {
+    'required': ['Project', 'CostCenter', 'Environment'],
+    'allowed_values': {'Environment': ['dev', 'staging', 'prod']},
+    'patterns': {'CostCenter': 'Project[0-9]+'},
+    'resource_types': {
+        'lambda': {'required': ['Component']},
+        'lambda:function': {'allowed_values': {'Component': ['processing', 'api']}},
+        's3': {'allowed_values': {'Environment': ['prod']}},
+    }
+}
+
+
+class TestTagPolicy:
+    """Compiled per-type rules from tag-policy.json"""
+
+    def test_type_rules_build_on_service_and_default_rules(self):
+        policy = tag_audit_function.TagPolicy(POLICY)
+
+        rules = policy.rules_for('lambda:function')
+
+        assert rules.required_order == ('Project', 'CostCenter', 'Environment', 'Component')
+        assert rules.allowed == {
+            'Environment': frozenset({'dev', 'staging', 'prod'}),
+            'Component': frozenset({'processing', 'api'})
+        }
+        assert policy.rules_for('ec2:instance').required_order == ('Project', 'CostCenter', 'Environment')
+        # Type-level values replace the defaults for that tag
+        assert policy.rules_for('s3:bucket').allowed['Environment'] == frozenset({'prod'})
+
+    def test_rules_are_compiled_once_per_type(self):
+        policy = tag_audit_function.TagPolicy(POLICY)
+
+        assert policy.rules_for('lambda:function') is policy.rules_for('lambda:function')
+
+    @pytest.mark.parametrize('tags, missing, invalid', [
+        ({'Project': 'p', 'CostCenter': 'Project1', 'Environment': 'dev'}, [], []),
+        ({'Project': 'p', 'Environment': 'dev'}, ['CostCenter'], []),
+        ({}, ['Project', 'CostCenter', 'Environment'], []),
+        ({'Project': 'p', 'CostCenter': 'Project1', 'Environment': 'production'},
+         [], [('allowed', 'Environment', 'production')]),
+        ({'Project': 'p', 'CostCenter': 'project-one', 'Environment': 'Dev'},
+         [], [('allowed', 'Environment', 'Dev'), ('pattern', 'CostCenter', 'project-one')]),
+        ({'Project': 'p', 'CostCenter': 'Project1x', 'Environment': 'dev'},
+         [], [('pattern', 'CostCenter', 'Project1x')]),
+    ])
+    def test_evaluate(self, tags, missing, invalid):
+        rules = tag_audit_function.TagPolicy(POLICY).rules_for('ec2:instance')
+
+        assert rules.evaluate(tags) == (missing, invalid)
+
+    def test_bad_pattern_fails_at_load(self):
+        with pytest.raises(Exception):
+            tag_audit_function.TagPolicy({'resource_types': {'s3': {'patterns': {'Project': '('}}}})
+
+    def test_without_a_policy_file_required_tags_apply(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tag_audit_function, 'TAG_POLICY_CANDIDATES', [str(tmp_path / 'tag-policy.json')])
+
+        policy = tag_audit_function.load_tag_policy()
+
+        assert policy.required_tags == tag_audit_function.REQUIRED_TAGS
+        assert policy.rules_for('s3:bucket').evaluate({}) == (tag_audit_function.REQUIRED_TAGS, [])
+
+    def test_repo_policy_accepts_the_standard_tag_set(self):
+        with open(CONFIG_PATH) as f:
+            config = json.load(f)
+        standard_tags = {tag['Key']: tag['Value'] for tag in config['TagSet']}
+
+        policy = tag_audit_function.load_tag_policy(POLICY_PATH)
+
+        assert policy.rules_for('ec2:instance').evaluate(standard_tags) == ([], [])
+        assert policy.rules_for('lambda:function').evaluate(standard_tags) == (['Component'], [])
+        assert policy.rules_for('s3:bucket').evaluate(dict(standard_tags, Component='uploads')) == ([], [])
+
+    def test_audit_counts_violations_per_rule(self, tagging, monkeypatch):
+        monkeypatch.setattr(tag_audit_function, 'tag_policy', tag_audit_function.TagPolicy(POLICY))
+        account = '123456789012'
+        good = {'Project': 'p', 'CostCenter': 'Project1', 'Environment': 'dev'}
+        tagging.install({'us-east-1': FakeTaggingClient([
+            make_resource(f"arn:aws:ec2:us-east-1:{account}:instance/i-1", **good),
+            make_resource(f"arn:aws:ec2:us-east-1:{account}:instance/i-2", **dict(good, Environment='qa')),
+            make_resource(f"arn:aws:lambda:us-east-1:{account}:function:processor", **good),
+            make_resource(f"arn:aws:lambda:us-east-1:{account}:function:api", **dict(good, Component='api')),
+            make_resource(f"arn:aws:lambda:us-east-1:{account}:function:old", **dict(good, Component='batch')),
+            make_resource("arn:aws:s3:::uploads", **good),
+            make_resource("arn:aws:s3:::logs", **{'Project': 'p'}),
+        ])})
+
+        body = run_audit()
+
+        assert body['total_resources'] == 7
+        assert body['non_compliant'] == 5
+        assert body['rule_violations'] == {
+            'allowed:Environment': 2,
+            'required:Component': 1,
+            'allowed:Component': 1,
+            'required:CostCenter': 1,
+            'required:Environment': 1,
+        }
+        report = tagging.sns.messages[0]['Message']
+        assert 'VIOLATIONS BY RULE' in report
+        assert 'allowed:Environment: 2 resources' in report
+        assert 'Invalid Tags: Component=batch (not an allowed value)' in report
+        assert 'Required Tags: Project, CostCenter, Environment' in report
+
+
+@pytest.fixture
+def reports(tagging, monkeypatch):
+    """Keep full reports in a fake S3 bucket"""
+    s3 = FakeS3()
+    monkeypatch.setattr(tag_audit_function, 'AUDIT_REPORT_BUCKET', 'report-bucket')
+    monkeypatch.setattr(tag_audit_function, 's3_client', s3)
+    tagging.s3 = s3
+    return tagging
+
+
+class TestReportDelivery:
+    """Size-bounded email report, with the full report overflowing to S3"""
+
+    def test_report_buffer_stops_at_the_budget(self):
+        out = tag_audit_function.ReportBuffer(limit=20, reserve=5)
+
+        assert out.write('0123456789')
+        assert not out.write('é' * 3)  # 6 bytes in UTF-8, over the 15 left to use
+        assert not out.write('x')      # nothing is written after the cut
+        assert out.write('!' * 10, force=True)
+
+        assert out.truncated
+        assert out.getvalue() == '0123456789' + '!' * 10
+
+    def test_oversized_report_is_cut_to_fit_the_email(self, tagging, monkeypatch):
+        monkeypatch.setattr(tag_audit_function, 'SNS_MESSAGE_BUDGET', 8192)
+        monkeypatch.setattr(tag_audit_function, 'REPORT_SAMPLES_PER_TYPE', 500)
+        tagging.install({'us-east-1': FakeTaggingClient(list(instance_resources(500, missing=('Project',))))})
+
+        tag_audit_function.lambda_handler({}, None)
+        report = tagging.sns.messages[0]['Message']
+
+        assert len(report.encode('utf-8')) <= 8192
+        assert 'report cut at' in report
+        assert 'set AUDIT_REPORT_BUCKET' in report
+        assert 0 < report.count('ARN: ') == report.count('Existing Tags: ') < 500  # whole entries only
+        assert report.rstrip().endswith('3. Update TAGGING_STRATEGY.md if needed')
+        assert 'Next audit' not in report
+
+    def test_full_report_goes_to_s3_and_email_links_to_it(self, reports):
+        reports.install({
+            'us-east-1': FakeTaggingClient(list(instance_resources(150, 'us-east-1', missing=('Project',)))),
+            'eu-west-1': FakeTaggingClient(
+                list(instance_resources(40, 'eu-west-1')) + list(instance_resources(60, 'eu-west-1', missing=('ManagedBy',), start=40))
+            ),
+        })
+
+        body = run_audit()
+
+        rows = list(csv.DictReader(reports.s3.get_text('report-bucket', 'non_compliant.csv').splitlines()))
+        assert len(rows) == body['non_compliant'] == 210
+        assert {row['region'] for row in rows} == {'us-east-1', 'eu-west-1'}
+        assert rows[0]['type'] == 'ec2:instance'
+        assert json.loads(rows[0]['tags'])['CostCenter'] == 'Project1'
+        assert json.loads(reports.s3.get_text('report-bucket', 'summary.json'))['non_compliant'] == 210
+        assert 'ARN: ' in reports.s3.get_text('report-bucket', 'report.txt')
+
+        message = reports.sns.messages[0]['Message']
+        assert 'ARN: ' not in message
+        assert 'ec2:instance: 210 resources' in message
+        assert body['report_location'].startswith('s3://report-bucket/tag-audit/reports/')
+        assert body['report_location'] in message
+        assert 'https://report-bucket.s3.amazonaws.com/tag-audit/reports/' in message
+
+    def test_failed_upload_falls_back_to_the_emailed_report(self, reports):
+        def refuse(**kwargs):
+            raise FakeClientError('AccessDenied')
+
+        reports.s3.put_object = refuse
+        reports.install({'us-east-1': FakeTaggingClient(list(instance_resources(3, missing=('Project',))))})
+
+        body = run_audit()
+
+        assert 'report_location' not in body
+        message = reports.sns.messages[0]['Message']
+        assert message.count('ARN: ') == 3
+        assert 'FULL REPORT' not in message